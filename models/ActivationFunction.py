@@ -6,7 +6,46 @@ from torchvision import models
 import pdb
 
 
-# asymmetric gaussian shaped activation function g_A 
+# asymmetric gaussian shaped activation function g_A, fused into one autograd function,
+# only the input is saved and backward recomputes the rest
+class GaussActivationFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, inputFeatures, a, mu, sigma1, sigma2):
+        ctx.save_for_backward(inputFeatures, a, mu, sigma1, sigma2)
+
+        # left: a * exp(-sigma1 * (x - mu)^2), right: 1 + (a - 1) * exp(-sigma2 * (x - mu)^2)
+        lowerThanMu = inputFeatures < mu
+        output = inputFeatures - mu
+        output.square_().mul_(torch.where(lowerThanMu, -sigma1, -sigma2)).exp_()
+        output.mul_(torch.where(lowerThanMu, a, a - 1)).add_(~lowerThanMu)
+
+        return output
+
+    @staticmethod
+    def backward(ctx, gradOutput):
+        inputFeatures, a, mu, sigma1, sigma2 = ctx.saved_tensors
+
+        lowerThanMu = inputFeatures < mu
+        diff = inputFeatures - mu
+        sigma = torch.where(lowerThanMu, sigma1, sigma2)
+        scale = torch.where(lowerThanMu, a, a - 1)
+        gradExp = gradOutput * torch.exp(-sigma * diff * diff)
+
+        gradInput = gradA = gradMu = gradSigma1 = gradSigma2 = None
+        if ctx.needs_input_grad[1]:
+            gradA = gradExp.sum()
+        gradExp = gradExp * scale
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[2]:
+            gradInput = -2 * sigma * diff * gradExp
+            if ctx.needs_input_grad[2]:
+                gradMu = -gradInput.sum()
+        if ctx.needs_input_grad[3] or ctx.needs_input_grad[4]:
+            gradSigma = -diff * diff * gradExp
+            gradSigma1 = torch.where(lowerThanMu, gradSigma, 0).sum()
+            gradSigma2 = torch.where(lowerThanMu, 0, gradSigma).sum()
+
+        return gradInput, gradA, gradMu, gradSigma1, gradSigma2
+
 class GaussActivation(nn.Module):
     def __init__(self, a, mu, sigma1, sigma2):
         super(GaussActivation, self).__init__()
@@ -23,38 +62,41 @@ class GaussActivation(nn.Module):
 
         # pdb.set_trace()
 
-        self.a.data = torch.clamp(self.a.data, 1.01, 6.0)
-        self.mu.data = torch.clamp(self.mu.data, 0.1, 3.0)
-        self.sigma1.data = torch.clamp(self.sigma1.data, 0.5, 2.0)
-        self.sigma2.data = torch.clamp(self.sigma2.data, 0.5, 2.0)
+        self.a.data.clamp_(1.01, 6.0)
+        self.mu.data.clamp_(0.1, 3.0)
+        self.sigma1.data.clamp_(0.5, 2.0)
+        self.sigma2.data.clamp_(0.5, 2.0)
 
-        lowerThanMu = inputFeatures < self.mu
-        largerThanMu = inputFeatures >= self.mu
+        return GaussActivationFunction.apply(inputFeatures, self.a, self.mu, self.sigma1, self.sigma2)
 
-        # pdb.set_trace()
-
-        leftValuesActiv = self.a * torch.exp(- self.sigma1 * ( (inputFeatures - self.mu) ** 2 ) )
-        leftValuesActiv.masked_fill_(largerThanMu, 0.0)
+# relu(x) ** alpha, only the input is saved
+class MaskUpdateFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, inputMaskMap, alpha):
+        ctx.save_for_backward(inputMaskMap)
+        ctx.alpha = alpha
 
-        rightValueActiv = 1 + (self.a - 1) * torch.exp(- self.sigma2 * ( (inputFeatures - self.mu) ** 2 ) )
-        rightValueActiv.masked_fill_(lowerThanMu, 0.0)
+        return torch.relu(inputMaskMap).pow_(alpha)
 
-        output = leftValuesActiv + rightValueActiv
+    @staticmethod
+    def backward(ctx, gradOutput):
+        inputMaskMap, = ctx.saved_tensors
 
-        # pdb.set_trace()
+        # gradient is zero for x <= 0, pow(0, alpha - 1) there is not used
+        gradInput = gradOutput * ctx.alpha * torch.relu(inputMaskMap).pow_(ctx.alpha - 1)
+        gradInput = torch.where(inputMaskMap > 0, gradInput, 0)
 
-        return output
+        return gradInput, None
 
 # mask updating functions, we recommand using alpha that is larger than 0 and lower than 1.0
 class MaskUpdate(nn.Module):
     def __init__(self, alpha):
         super(MaskUpdate, self).__init__()
 
-        self.updateFunc = nn.ReLU(True)
         #self.alpha = Parameter(torch.tensor(alpha, dtype=torch.float32))
         self.alpha = alpha
     def forward(self, inputMaskMap):
         """ self.alpha.data = torch.clamp(self.alpha.data, 0.6, 0.8)
         print(self.alpha) """
 
-        return torch.pow(self.updateFunc(inputMaskMap), self.alpha)
+        return MaskUpdateFunction.apply(inputMaskMap, self.alpha)
@@ -0,0 +1,320 @@
+"""Host autotuner, threads, loader workers, batch size, layout and tile size."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# python autotune.py --data dataset/train
+# python autotune.py --show
+#
+# Best values are saved to AUTOTUNE_FILE ($IMAGEPATCH_AUTOTUNE overrides it) together
+# with a host fingerprint. train.py, ../train.py, predict.py and server.py read them at
+# startup, command line arguments still win. Batch size is tuned for inference only,
+# training batch size changes the optimization, not just speed.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import time
+
+import torch
+
+AUTOTUNE_FILE = os.path.expanduser("~/.cache/ImagePatch/autotune.json")
+
+# Throughput within this ratio of the best counts as tie, fewer threads, workers
+# or smaller batch wins
+AUTOTUNE_TIE = 0.03
+
+
+def autotune_file():
+    return os.environ.get("IMAGEPATCH_AUTOTUNE", AUTOTUNE_FILE)
+
+
+def autotune_host():
+    """Host fingerprint, values tuned on another host or torch are not used."""
+    processor = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    processor = line.split(":", 1)[1].strip()
+                    break
+    return {'machine': platform.machine(), 'processor': processor,
+            'cpus': len(os.sched_getaffinity(0)), 'torch': torch.__version__,
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else ""}
+
+
+def autotune_load(section, path=None):
+    """Tuned values of section ('inference' or 'train'), {} if not tuned on this host."""
+    path = path or autotune_file()
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        config = json.load(f)
+    if config.get('host') != autotune_host():
+        print("Autotune file '{}' is for another host, ignored.".format(path))
+        return {}
+    return config.get(section, {})
+
+
+def autotune_threads(config):
+    """Set tuned intra-op and inter-op threads, call before any parallel work."""
+    if config.get('threads', 0) > 0:
+        torch.set_num_threads(config['threads'])
+    if config.get('interop_threads', 0) > 0:
+        try:
+            torch.set_num_interop_threads(config['interop_threads'])
+        except RuntimeError:
+            # inter-op pool already started, keep it
+            pass
+
+
+def thread_candidates(cores):
+    """1, 2, 4 ... and cores."""
+    return sorted(set([1 << i for i in range(cores.bit_length())] + [cores]))
+
+
+def tie_break(trials, key):
+    """Trial with the smallest key among those within AUTOTUNE_TIE of best throughput."""
+    best = max(t['throughput'] for t in trials)
+    return min((t for t in trials if t['throughput'] >= best * (1.0 - AUTOTUNE_TIE)),
+               key=lambda t: t[key])
+
+
+def record(trials, section, stage, **values):
+    """Append and print one trial."""
+    trials.append(dict(section=section, stage=stage, **values))
+    print("{} {}: {}".format(section, stage, ", ".join(
+        "{}={:.2f}".format(k, v) if isinstance(v, float) else "{}={}".format(k, v)
+        for k, v in values.items())))
+    return trials[-1]
+
+
+def measure(function, repeat=3):
+    """Median seconds of function() after one untimed call."""
+    function()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        seconds.append(time.perf_counter() - start)
+    return sorted(seconds)[len(seconds) // 2]
+
+
+def set_layout(model, channels_last):
+    from model import model_channels_last
+
+    if channels_last:
+        return model_channels_last(model)
+    model.memoryFormat = torch.contiguous_format
+    return model.to(memory_format=torch.contiguous_format)
+
+
+def inference_throughput(model, size, batch_size, repeat, tile_size=0):
+    """Images/s of size x size inputs, tile_size > 0 runs model_forward_tiled."""
+    from benchmark import benchmark_inputs
+    from data import image_with_mask
+    from model import model_device, model_forward_tiled
+
+    device = model_device()
+    images, masks = image_with_mask(*[t.to(device) for t in benchmark_inputs(size, batch_size, 0)],
+                                    model.memoryFormat)
+    with torch.no_grad():
+        if tile_size > 0:
+            seconds = measure(lambda: model_forward_tiled(model, images, masks, tile_size=tile_size),
+                              repeat)
+        else:
+            seconds = measure(lambda: model(images, masks), repeat)
+    return batch_size / seconds
+
+
+def measure_interop(queue, interop_threads, threads, size, repeat, checkpoint):
+    """Child process: inter-op threads can only be set once per process."""
+    from model import get_model, model_device, model_freeze
+
+    torch.set_num_interop_threads(interop_threads)
+    torch.set_num_threads(threads)
+    model = model_freeze(get_model(checkpoint).to(model_device()))
+    queue.put(inference_throughput(model, size, 1, repeat))
+
+
+def tune_inference(args, trials):
+    """Coordinate search: threads, inter-op threads, layout, batch size, then tile size."""
+    from model import get_model, model_cost, model_device, model_freeze
+
+    model = model_freeze(get_model(args.checkpoint).to(model_device()))
+    cores = len(os.sched_getaffinity(0))
+    best = {'size': args.size}
+
+    def trial(stage, **values):
+        return record(trials, 'inference', stage, **values)
+
+    stage = []
+    for threads in thread_candidates(cores):
+        torch.set_num_threads(threads)
+        stage.append(trial('threads', threads=threads,
+                           throughput=inference_throughput(model, args.size, 1, args.repeat)))
+    best['threads'] = tie_break(stage, 'threads')['threads']
+    torch.set_num_threads(best['threads'])
+
+    stage = []
+    context = multiprocessing.get_context('spawn')
+    for interop_threads in [n for n in thread_candidates(cores) if n <= 4]:
+        queue = context.Queue()
+        process = context.Process(target=measure_interop, args=(
+            queue, interop_threads, best['threads'], args.size, args.repeat, args.checkpoint))
+        process.start()
+        stage.append(trial('interop_threads', interop_threads=interop_threads,
+                           throughput=queue.get()))
+        process.join()
+    best['interop_threads'] = tie_break(stage, 'interop_threads')['interop_threads']
+
+    stage = []
+    for channels_last in (False, True):
+        set_layout(model, channels_last)
+        stage.append(trial('layout', channels_last=channels_last,
+                           throughput=inference_throughput(model, args.size, 1, args.repeat)))
+    # contiguous wins ties
+    best['channels_last'] = tie_break(stage, 'channels_last')['channels_last']
+    set_layout(model, best['channels_last'])
+
+    stage, batch_size = [], 1
+    while batch_size <= args.max_batch:
+        if args.max_memory > 0 and model_cost(model, batch_size, args.size, args.size)[
+                'peak_bytes'] > args.max_memory * 1024 * 1024:
+            break
+        stage.append(trial('batch_size', batch_size=batch_size, throughput=inference_throughput(
+            model, args.size, batch_size, args.repeat)))
+        # larger batches only get slower once past the best
+        if stage[-1]['throughput'] < max(t['throughput'] for t in stage) * (1.0 - AUTOTUNE_TIE):
+            break
+        batch_size *= 2
+    best['batch_size'] = tie_break(stage, 'batch_size')['batch_size']
+
+    stage = []
+    for tile_size in (256, 384, 512, 768, 1024):
+        if tile_size > args.tile_image or args.max_memory > 0 and model_cost(
+                model, 1, tile_size, tile_size)['peak_bytes'] > args.max_memory * 1024 * 1024:
+            continue
+        stage.append(trial('tile_size', tile_size=tile_size, throughput=inference_throughput(
+            model, args.tile_image, 1, max(1, args.repeat // 2), tile_size)))
+    # larger tiles need more memory, take the smallest within tie
+    best['tile_size'] = tie_break(stage, 'tile_size')['tile_size'] if stage else args.tile_image
+    return best
+
+
+def tune_train(args, trials):
+    """Loader workers on args.data, then training step threads."""
+    import torch.utils.data as data
+
+    from benchmark import benchmark_inputs
+    from data import ImagePatchDataset, get_transform, image_with_mask
+    from model import get_model, model_device
+
+    cores = len(os.sched_getaffinity(0))
+    best = {}
+
+    def trial(stage, **values):
+        return record(trials, 'train', stage, **values)
+
+    if os.path.isdir(os.path.join(args.data, "image")):
+        dataset = ImagePatchDataset(args.data, get_transform(train=True))
+        batches = min(args.loader_batches, len(dataset) // args.train_bs)
+        stage = []
+        for workers in [0] + thread_candidates(min(cores, 16)):
+            loader = iter(data.DataLoader(dataset, batch_size=args.train_bs, shuffle=True,
+                                          num_workers=workers))
+            # worker start up once per epoch, not per batch
+            next(loader)
+            start = time.perf_counter()
+            for _ in range(batches - 1):
+                next(loader)
+            seconds = time.perf_counter() - start
+            del loader
+            stage.append(trial('num_workers', num_workers=workers,
+                               throughput=(batches - 1) * args.train_bs / seconds))
+        best['num_workers'] = tie_break(stage, 'num_workers')['num_workers']
+    else:
+        print("No '{}', loader workers are not tuned.".format(os.path.join(args.data, "image")))
+
+    model = get_model(args.checkpoint).to(model_device())
+    model.train()
+    device = next(model.parameters()).device
+    images, masks = benchmark_inputs(args.train_size, args.train_bs, 0)
+    new_images, new_masks = image_with_mask(images.to(device), masks.to(device))
+    target = images.to(device)
+
+    def step():
+        model.zero_grad()
+        output = model(new_images, new_masks)
+        (output - target).abs().mean().backward()
+
+    stage = []
+    for threads in thread_candidates(cores):
+        torch.set_num_threads(threads)
+        stage.append(trial('threads', threads=threads,
+                           throughput=args.train_bs / measure(step, max(1, args.repeat // 2))))
+    best['threads'] = tie_break(stage, 'threads')['threads']
+    return best
+
+
+if __name__ == "__main__":
+    """Autotune."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help="checkpoint file, default random weights, speed does not depend on it")
+    parser.add_argument('--size', type=int, default=512, help="inference image size")
+    parser.add_argument('--max_batch', type=int, default=16, help="largest inference batch size")
+    parser.add_argument('--max_memory', type=int, default=0,
+                        help="peak memory budget (MB) for batch and tile size, 0 means no limit")
+    parser.add_argument('--tile_image', type=int, default=1024,
+                        help="image size for tile size search")
+    parser.add_argument('--data', type=str, default="dataset/train",
+                        help="training dataset with image and mask folders")
+    parser.add_argument('--train_size', type=int, default=256, help="training image size")
+    parser.add_argument('--train_bs', type=int, default=1, help="training batch size")
+    parser.add_argument('--loader_batches', type=int, default=20, help="batches per loader trial")
+    parser.add_argument('--repeat', type=int, default=3, help="timed calls per trial")
+    parser.add_argument('--skip_train', action="store_true", help="only tune inference")
+    parser.add_argument('--output', type=str, default=autotune_file(), help="autotune file")
+    parser.add_argument('--show', action="store_true", help="print autotune file and exit")
+    args = parser.parse_args()
+
+    if args.show:
+        if not os.path.exists(args.output):
+            print("No autotune file '{}'.".format(args.output))
+        else:
+            with open(args.output) as f:
+                config = json.load(f)
+            print(json.dumps({k: v for k, v in config.items() if k != 'trials'}, indent=2))
+            if config.get('host') != autotune_host():
+                print("Tuned on another host, not used here.")
+        raise SystemExit(0)
+
+    trials = []
+    start = time.time()
+    config = {'host': autotune_host(), 'created': time.strftime("%Y-%m-%d %H:%M:%S")}
+    config['inference'] = tune_inference(args, trials)
+    if not args.skip_train:
+        config['train'] = tune_train(args, trials)
+        config['train']['interop_threads'] = config['inference']['interop_threads']
+    config['seconds'] = time.time() - start
+    config['trials'] = trials
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(json.dumps({k: v for k, v in config.items() if k != 'trials'}, indent=2))
+    print("Autotune saved to '{}' in {:.0f} s.".format(args.output, config['seconds']))
@@ -0,0 +1,757 @@
+"""Model inference benchmark."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# python benchmark.py run --sizes 256,512 --dtypes fp32,bf16 --output output/benchmark.json
+# python benchmark.py compare output/baseline.json output/benchmark.json
+# python benchmark.py cost --sizes 512,1024 --dtypes fp32,bf16
+# python benchmark.py stress --workers 4 --requests 64
+# python benchmark.py load --server unix:output/server.sock --concurrency 8
+# python benchmark.py scale --workers 1,2,4,8 --pin
+# python benchmark.py ready --checkpoint models/ImagePatch.pth
+# python benchmark.py parity
+#
+import argparse
+import concurrent.futures
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import torch
+from PIL import Image
+
+from data import image_with_mask
+from model import (WEIGHTS_SUFFIX, ModelExecutor, ModelProcessPool, OnnxModel, enable_amp,
+                   export_onnx_model, export_torch_model, get_model, model_compile,
+                   model_convert_int8, model_cost, model_forward_tiled, model_freeze,
+                   model_peak_memory, model_prepare_int8, model_save, model_setenv,
+                   weights_convert)
+from script import image_to_tensor, load_script_model, tensor_to_image
+
+MODELS = ('ImagePatchModel', 'LBAMModel')
+PARITY_CASES = ('tiled', 'script', 'compile')
+BACKENDS = ('default', 'onednn', 'compile', 'script', 'onnx')
+DTYPES = ('fp32', 'bf16', 'int8')
+COST_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'int8': torch.qint8}
+
+
+def benchmark_inputs(size, batch_size, seed):
+    """Random image and mask Nx3xHxW, about 30% holes, same for same seed."""
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.rand(batch_size, 3, size, size, generator=generator)
+    mask = (torch.rand(batch_size, 3, size, size, generator=generator) > 0.3).float()
+    return image, mask
+
+
+def parity_inputs(size, batch_size, seed):
+    """Smooth image with rectangle holes Nx3xHxW, holes cross the image center.
+
+    benchmark_inputs noise holes hide context errors, every hole pixel has valid neighbours.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.nn.functional.interpolate(
+        torch.rand(batch_size, 3, 8, 8, generator=generator), size=(size, size),
+        mode='bilinear', align_corners=False)
+    mask = torch.zeros(batch_size, 3, size, size)
+    for n in range(batch_size):
+        for _ in range(4):
+            h, w = torch.randint(size // 8, size // 3, (2,), generator=generator).tolist()
+            y, x = torch.randint(size // 4, size // 2, (2,), generator=generator).tolist()
+            mask[n, :, y - h // 2:y + h // 2, x - w // 2:x + w // 2] = 1.0
+    return image, mask
+
+
+def lbam_model():
+    """Original LBAMModel from ../models, same layers as ImagePatchModel before our changes."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.append(root)
+    from models.LBAMModel import LBAMModel
+
+    model = LBAMModel(4, 3)
+    # image_with_mask and autocast like ImagePatchModel
+    model.memoryFormat = torch.contiguous_format
+    return model
+
+
+def benchmark_model(name, backend, dtype, checkpoint=None, workdir="output/benchmark", threads=0):
+    """Create model for inference, raise ValueError for combinations that do not exist.
+
+    script model takes image and mask as loaded, others take image_with_mask outputs.
+    """
+    if name == 'LBAMModel':
+        if backend != 'default' or dtype == 'int8':
+            raise ValueError("LBAMModel only runs default backend with fp32 or bf16")
+        model = lbam_model()
+        if checkpoint is not None:
+            model.load_state_dict(torch.load(checkpoint, map_location='cpu'), strict=False)
+        return model.eval()
+
+    if backend in ('script', 'onnx'):
+        if dtype != 'fp32':
+            raise ValueError("{} backend is fp32 only".format(backend))
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        if checkpoint is None:
+            # exporters load weights from file
+            checkpoint = os.path.join(workdir, "ImagePatch.pth")
+            model_save(get_model(), checkpoint)
+        if backend == 'script':
+            script_file = os.path.join(workdir, "image_patch.pt")
+            export_torch_model(checkpoint, script_file)
+            return load_script_model(script_file)
+        onnx_file = os.path.join(workdir, "image_patch.onnx")
+        export_onnx_model(checkpoint, onnx_file)
+        return OnnxModel(onnx_file, threads)
+
+    if dtype == 'int8' and backend != 'default':
+        raise ValueError("int8 only runs default backend")
+
+    model = get_model(checkpoint, backend='onednn' if backend == 'onednn' else 'default')
+    model.eval()
+    if dtype == 'int8':
+        # latency does not depend on calibration data
+        model_prepare_int8(model)
+        with torch.no_grad():
+            model(*image_with_mask(*benchmark_inputs(256, 1, 0)))
+        model_convert_int8(model)
+    elif dtype == 'bf16':
+        enable_amp(model, torch.bfloat16)
+    if backend == 'compile':
+        model_compile(model, os.path.join(workdir, "compile_cache"))
+    return model
+
+
+def benchmark_latency(model, inputs, warmup=2, repeat=10):
+    """Seconds of every timed call."""
+    seconds = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            model(*inputs)
+            if i >= warmup:
+                seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def benchmark_stats(seconds, batch_size):
+    """Latency percentiles (ms) and throughput (images/s)."""
+    p50, p95, p99 = torch.tensor(seconds, dtype=torch.float64).quantile(
+        torch.tensor([0.50, 0.95, 0.99], dtype=torch.float64)).tolist()
+    mean = sum(seconds) / len(seconds)
+    return {'p50': p50 * 1000, 'p95': p95 * 1000, 'p99': p99 * 1000,
+            'mean': mean * 1000, 'throughput': batch_size / mean}
+
+
+def benchmark_run(args):
+    """Sweep every combination, one result or skip reason per combination."""
+    results = []
+    for name in args.models:
+        for backend in args.backends:
+            for dtype in args.dtypes:
+                torch.manual_seed(args.seed)
+                torch.set_num_threads(args.threads[0])
+                try:
+                    model = benchmark_model(name, backend, dtype, args.checkpoint,
+                                            args.workdir, args.threads[0])
+                except (ValueError, ImportError) as e:
+                    results.append({'model': name, 'backend': backend, 'dtype': dtype,
+                                    'skipped': str(e)})
+                    print("{} {} {}: skipped, {}".format(name, backend, dtype, e))
+                    continue
+
+                if name == 'LBAMModel' and dtype == 'bf16':
+                    forward = model
+
+                    def model(*inputs):
+                        with torch.autocast('cpu', dtype=torch.bfloat16):
+                            return forward(*inputs)
+                    model.memoryFormat = forward.memoryFormat
+
+                for threads in args.threads:
+                    torch.set_num_threads(threads)
+                    for size in args.sizes:
+                        for batch_size in args.batch_sizes:
+                            inputs = benchmark_inputs(size, batch_size, args.seed)
+                            if backend != 'script':
+                                inputs = image_with_mask(*inputs, model.memoryFormat)
+                            seconds = benchmark_latency(model, inputs, args.warmup, args.repeat)
+                            result = {'model': name, 'backend': backend, 'dtype': dtype,
+                                      'threads': threads, 'size': size, 'batch': batch_size}
+                            result.update(benchmark_stats(seconds, batch_size))
+                            results.append(result)
+                            print("{model} {backend} {dtype} threads={threads} {size}x{size} "
+                                  "bs={batch}: p50 {p50:.1f} p95 {p95:.1f} p99 {p99:.1f} ms, "
+                                  "{throughput:.2f} img/s".format(**result))
+                del model
+    return results
+
+
+def rss_bytes(field):
+    """VmRSS or VmHWM of this process from /proc, bytes."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise ValueError("{} not found".format(field))
+
+
+def measure_rss(queue, backend, dtype, size, batch_size, tile_size, checkpoint, workdir):
+    """Child process: peak RSS growth of one forward over RSS right before it,
+    then torch allocated peak of the same call."""
+    model = benchmark_model('ImagePatchModel', backend, dtype, checkpoint, workdir)
+    with torch.no_grad():
+        # load libraries and one-time kernels outside the measured call
+        model(*image_with_mask(*benchmark_inputs(128, 1, 0), model.memoryFormat))
+        inputs = image_with_mask(*benchmark_inputs(size, batch_size, 0), model.memoryFormat)
+        # reset VmHWM to current RSS, linux only
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = rss_bytes("VmRSS")
+        if tile_size > 0:
+            model_forward_tiled(model, *inputs, tile_size=tile_size)
+            rss = rss_bytes("VmHWM") - before
+            _, allocated = model_peak_memory(
+                lambda: model_forward_tiled(model, *inputs, tile_size=tile_size))
+        else:
+            model(*inputs)
+            rss = rss_bytes("VmHWM") - before
+            _, allocated = model_peak_memory(model, *inputs)
+    queue.put((rss, allocated))
+
+
+def benchmark_cost(args):
+    """Predicted cost against measured peak RSS, one fresh process per case."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in args.backends:
+        for dtype in args.dtypes:
+            try:
+                model = benchmark_model('ImagePatchModel', backend, dtype, args.checkpoint, args.workdir)
+            except ValueError as e:
+                print("{} {}: skipped, {}".format(backend, dtype, e))
+                continue
+            for size in args.sizes:
+                for batch_size in args.batch_sizes:
+                    cost = model_cost(model, batch_size, size, size, COST_DTYPES[dtype],
+                                      backend, args.tile_size)
+                    queue = context.Queue()
+                    process = context.Process(target=measure_rss, args=(
+                        queue, backend, dtype, size, batch_size, args.tile_size,
+                        args.checkpoint, args.workdir))
+                    process.start()
+                    rss, allocated = queue.get()
+                    process.join()
+                    result = {'backend': backend, 'dtype': dtype, 'size': size, 'batch': batch_size,
+                              'tile_size': args.tile_size, 'gflops': cost['flops'] / 1e9,
+                              'param_mb': cost['param_bytes'] / 1e6,
+                              'predicted_mb': cost['peak_bytes'] / 1e6, 'rss_mb': rss / 1e6,
+                              'allocated_mb': allocated / 1e6, 'error': cost['peak_bytes'] / rss - 1.0}
+                    results.append(result)
+                    print("{backend} {dtype} {size}x{size} bs={batch} tile={tile_size}: "
+                          "{gflops:.1f} GFLOPs, params {param_mb:.1f} MB, peak predicted "
+                          "{predicted_mb:.1f} MB, measured RSS {rss_mb:.1f} MB ({error:+.1%}), "
+                          "torch allocated {allocated_mb:.1f} MB".format(**result))
+    return results
+
+
+def benchmark_stress(args):
+    """Concurrent requests on one shared model must match sequential results bit for bit."""
+    model = benchmark_model('ImagePatchModel', args.backend, args.dtype, args.checkpoint,
+                            args.workdir, torch.get_num_threads())
+    if isinstance(model, torch.nn.Module):
+        model_freeze(model)
+
+    requests = []
+    for i in range(args.requests):
+        size = args.sizes[i % len(args.sizes)]
+        inputs = benchmark_inputs(size, 1, args.seed + i)
+        if args.backend != 'script':
+            inputs = image_with_mask(*inputs, model.memoryFormat)
+        requests.append(inputs)
+
+    with ModelExecutor(model, workers=args.workers) as executor:
+        start = time.perf_counter()
+        expected = [executor.run(*inputs) for inputs in requests]
+        sequential = time.perf_counter() - start
+
+        mismatches, max_diff, concurrent = 0, 0.0, 0.0
+        order = list(range(len(requests)))
+        for _ in range(args.rounds):
+            # different interleaving every round
+            random.Random(args.seed + _).shuffle(order)
+            start = time.perf_counter()
+            futures = {i: executor.submit(*requests[i]) for i in order}
+            outputs = {i: f.result() for i, f in futures.items()}
+            concurrent += time.perf_counter() - start
+            for i, output in outputs.items():
+                if not torch.equal(output, expected[i]):
+                    mismatches += 1
+                    max_diff = max(max_diff, (output - expected[i]).abs().max().item())
+
+    report = {'backend': args.backend, 'dtype': args.dtype, 'workers': args.workers,
+              'threads': torch.get_num_threads(), 'requests': args.requests * args.rounds,
+              'mismatches': mismatches, 'max_diff': max_diff,
+              'sequential': args.requests / sequential,
+              'concurrent': args.requests * args.rounds / concurrent}
+    print("{backend} {dtype} workers={workers} threads={threads}: {requests} requests, "
+          "{mismatches} mismatches (max diff {max_diff:.3g}), sequential {sequential:.2f} img/s, "
+          "concurrent {concurrent:.2f} img/s".format(**report))
+    return report
+
+
+def smaps_bytes(pid, field):
+    """Pss, Pss_Shmem, Private_Dirty ... of a process from /proc, bytes."""
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise ValueError("{} not found".format(field))
+
+
+def benchmark_scale(args):
+    """Throughput of ModelProcessPool from 1 to N workers, memory of shared weights."""
+    model = benchmark_model('ImagePatchModel', 'default', args.dtype, args.checkpoint, args.workdir)
+    model_freeze(model)
+    forward = functools.partial(model_forward_tiled, tile_size=args.tile_size)
+    requests = [image_with_mask(*benchmark_inputs(args.size, 1, args.seed + i), model.memoryFormat)
+                for i in range(args.requests)]
+    expected = forward(model, *requests[0])
+    param_bytes = sum(t.numel() * t.element_size() for t in model.state_dict().values())
+
+    results = []
+    for workers in args.workers:
+        start = time.perf_counter()
+        with ModelProcessPool(model, workers, args.threads, args.pin, forward) as pool:
+            ready = time.perf_counter() - start
+            # one request per worker loads kernels, not timed
+            outputs = pool.map(requests[:1] * workers)
+            start = time.perf_counter()
+            pool.map(requests)
+            seconds = time.perf_counter() - start
+
+            pss = smaps_bytes(os.getpid(), 'Pss') + sum(smaps_bytes(pid, 'Pss') for pid in pool.pids)
+            shared = smaps_bytes(os.getpid(), 'Pss_Shmem') + \
+                sum(smaps_bytes(pid, 'Pss_Shmem') for pid in pool.pids)
+            private = sum(smaps_bytes(pid, 'Private_Dirty') for pid in pool.pids) / workers
+        result = {'workers': workers, 'threads': args.threads, 'pin': args.pin, 'size': args.size,
+                  'ready': ready, 'throughput': len(requests) / seconds,
+                  'pss_mb': pss / 1e6, 'shared_mb': shared / 1e6, 'param_mb': param_bytes / 1e6,
+                  'private_mb': private / 1e6,
+                  'max_diff': max((o - expected).abs().max().item() for o in outputs)}
+        result['speedup'] = result['throughput'] / (results[0]['throughput'] if results
+                                                    else result['throughput'])
+        results.append(result)
+        print("workers={workers} threads={threads} pin={pin} {size}x{size}: ready {ready:.1f} s, "
+              "{throughput:.2f} img/s ({speedup:.2f}x), PSS {pss_mb:.0f} MB, shared "
+              "{shared_mb:.0f} MB (weights {param_mb:.0f} MB), private {private_mb:.0f} MB/worker, "
+              "max diff {max_diff:.3g}".format(**result))
+    return results
+
+
+def measure_ready(queue, case, path, size):
+    """Child process: seconds to ready model and to first output, RSS and peak RSS.
+
+    RSS growth is not used, freed heap of imports is reused without growing RSS.
+    """
+    import torchvision.models as models
+
+    from model import VGG16FeatureExtractor
+
+    base = rss_bytes('VmRSS')
+    start = time.perf_counter()
+    if case == 'model':
+        model = model_freeze(get_model(path))
+        inputs = image_with_mask(*benchmark_inputs(size, 1, 0), model.memoryFormat)
+    elif case == 'vgg16':
+        # as before VGG16FeatureExtractor loaded features only
+        vgg16 = models.vgg16()
+        vgg16.load_state_dict(torch.load(path))
+        model = vgg16.features[:17]
+        inputs = (benchmark_inputs(size, 1, 0)[0],)
+    else:
+        model = VGG16FeatureExtractor(path)
+        inputs = (benchmark_inputs(size, 1, 0)[0],)
+    result = {'base_mb': base / 1e6, 'ready': time.perf_counter() - start,
+              'ready_mb': rss_bytes('VmRSS') / 1e6, 'ready_peak_mb': rss_bytes('VmHWM') / 1e6}
+    with torch.no_grad():
+        model(*inputs)
+    result.update({'first': time.perf_counter() - start, 'first_mb': rss_bytes('VmRSS') / 1e6,
+                   'first_peak_mb': rss_bytes('VmHWM') / 1e6})
+    queue.put(result)
+
+
+def benchmark_ready(args):
+    """Time to ready and RSS, .pth against mapped .safetensors, each in a fresh process.
+
+    Files are in page cache after the first run, numbers are warm starts.
+    """
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        checkpoint = os.path.join(args.workdir, "ImagePatch.pth")
+        model_save(get_model(), checkpoint)
+    mapped = os.path.join(args.workdir, "ImagePatch" + WEIGHTS_SUFFIX)
+    weights_convert(checkpoint, mapped)
+    cases = [('model', 'pth', checkpoint), ('model', 'mapped', mapped)]
+    if os.path.exists(args.vgg16):
+        # VGG16FeatureExtractor maps the .safetensors next to given .pth
+        vgg16 = os.path.join(args.workdir, "vgg16.pth")
+        if not os.path.exists(vgg16):
+            os.symlink(os.path.abspath(args.vgg16), vgg16)
+        features = os.path.join(args.workdir, "vgg16" + WEIGHTS_SUFFIX)
+        if os.path.exists(features):
+            os.remove(features)
+        cases += [('vgg16', 'pth', args.vgg16), ('features', 'pth', vgg16)]
+    else:
+        print("No '{}', VGG16 is not measured.".format(args.vgg16))
+
+    def run(case, path):
+        context = multiprocessing.get_context('spawn')
+        trials = []
+        for _ in range(args.repeat):
+            queue = context.Queue()
+            process = context.Process(target=measure_ready, args=(queue, case, path, args.size))
+            process.start()
+            trials.append(queue.get())
+            process.join()
+        # median by ready time
+        return sorted(trials, key=lambda t: t['ready'])[len(trials) // 2]
+
+    results = []
+    for case, method, path in cases:
+        results.append(dict(case=case, method=method, file_mb=os.path.getsize(path) / 1e6,
+                            **run(case, path)))
+        if case == 'features':
+            weights_convert(args.vgg16, features, ['features.'])
+            results.append(dict(case=case, method='mapped', file_mb=os.path.getsize(features) / 1e6,
+                                **run(case, vgg16)))
+    for result in results:
+        result['speedup'] = [r for r in results if r['case'] == result['case']][0]['ready'] / \
+            result['ready']
+        print("{case:<8} {method:<6} file {file_mb:.0f} MB: ready {ready:.2f} s ({speedup:.1f}x) "
+              "RSS {ready_mb:.0f} MB peak {ready_peak_mb:.0f} MB, first output {first:.2f} s "
+              "RSS {first_mb:.0f} MB peak {first_peak_mb:.0f} MB (after imports {base_mb:.0f} MB)"
+              .format(**result))
+    return results
+
+
+def benchmark_load(args):
+    """Concurrent clients against running server.py, latency as seen by clients."""
+    from client import predict_request, server_request
+
+    images = sorted(glob.glob(args.images))
+    masks = sorted(glob.glob(args.masks))
+    if len(images) == 0 or len(images) != len(masks):
+        raise ValueError("Found {} images but {} masks.".format(len(images), len(masks)))
+    payloads = [predict_request(images[i % len(images)], masks[i % len(masks)], args.crop_size)
+                for i in range(args.requests)]
+
+    def send(payload):
+        start = time.perf_counter()
+        status, data = server_request(args.server, 'POST', '/predict', payload)
+        return status, time.perf_counter() - start, data.get('batch_size', 0)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(send, payloads))
+    seconds = time.perf_counter() - start
+
+    ok = [t for status, t, _ in results if status == 200]
+    report = benchmark_stats(ok or [0.0], 1)
+    report.update({'requests': len(results), 'ok': len(ok), 'concurrency': args.concurrency,
+                   'throughput': len(ok) / seconds,
+                   'batch': sum(b for _, _, b in results) / max(len(ok), 1)})
+    print("{requests} requests, {ok} ok, concurrency {concurrency}: p50 {p50:.1f} p95 {p95:.1f} "
+          "p99 {p99:.1f} ms, {throughput:.2f} img/s, mean batch {batch:.2f}".format(**report))
+    status, stats = server_request(args.server, 'GET', '/stats')
+    print("server responses {responses}, batch sizes {batch_sizes}".format(**stats))
+    return report
+
+
+def benchmark_parity(args):
+    """Max abs difference of execution paths to full frame eager forward inside holes."""
+    from model import TILE_TOLERANCE
+
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        # exported models load weights from file
+        checkpoint = os.path.join(args.workdir, "ImagePatch.pth")
+        model_save(get_model(), checkpoint)
+    model = model_freeze(get_model(checkpoint))
+    results = []
+
+    def check(case, size, output, expected, holes, tolerance, **config):
+        diff = (output - expected).abs().masked_select(holes.expand_as(expected))
+        results.append(dict(case=case, size=size, max_diff=diff.max().item(),
+                            tolerance=tolerance, **config))
+        results[-1]['ok'] = results[-1]['max_diff'] <= tolerance
+        print("{} {}x{}{}: max diff {:.3g} (tolerance {:.3g}) {}".format(
+            case, size[0], size[1], "".join(" {}={}".format(k, v) for k, v in config.items()),
+            results[-1]['max_diff'], tolerance, "ok" if results[-1]['ok'] else "FAILED"))
+
+    if 'tiled' in args.cases:
+        for size, tile_size, tolerance in ((256, 256, 1e-5), (512, 256, TILE_TOLERANCE),
+                                           (1024, 512, TILE_TOLERANCE)):
+            images, masks = image_with_mask(*parity_inputs(size, 1, args.seed))
+            with torch.no_grad():
+                expected = model(images, masks)
+            # one tile is plain padding, several tiles lose context at seams
+            check('tiled', (size, size), model_forward_tiled(model, images, masks, tile_size),
+                  expected, masks[:, 0:1] < 0.5, tolerance, tile_size=tile_size)
+
+    if 'script' in args.cases:
+        # predict.py --script end to end, sizes are not multiple of MODEL_ALIGN
+        script_file = os.path.join(args.workdir, "image_patch.pt")
+        export_torch_model(checkpoint, script_file)
+        dataset = os.path.join(args.workdir, "parity")
+        for folder in ("image", "mask", "output"):
+            os.makedirs(os.path.join(dataset, folder), exist_ok=True)
+        sizes = ((200, 300), (130, 257))
+        for i, (h, w) in enumerate(sizes):
+            image, mask = parity_inputs(max(h, w), 1, args.seed + i)
+            name = "{}x{}.png".format(h, w)
+            tensor_to_image(image[0, :, 0:h, 0:w]).save(os.path.join(dataset, "image", name))
+            tensor_to_image(mask[0, :, 0:h, 0:w]).save(os.path.join(dataset, "mask", name))
+        subprocess.run([sys.executable, "predict.py", "--script", os.path.abspath(script_file),
+                        "--input", os.path.abspath(os.path.join(dataset, "image", "*.png"))],
+                       cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        for h, w in sizes:
+            name = "{}x{}.png".format(h, w)
+            image, mask = [image_to_tensor(Image.open(os.path.join(dataset, folder, name)))
+                           for folder in ("image", "mask")]
+            images, masks = image_with_mask(image, mask)
+            with torch.no_grad():
+                expected = model_forward_tiled(model, images, masks)
+            # both go through 8 bit png
+            expected = image_to_tensor(tensor_to_image(expected[0]))
+            output = image_to_tensor(Image.open(os.path.join(dataset, "output", "output_" + name)))
+            check('script', (h, w), output, expected, masks[:, 0:1] < 0.5, 1.0 / 255 + 1e-6)
+
+    if 'compile' in args.cases:
+        # default bucket pads to MODEL_ALIGN only, like eager
+        compiled = model_compile(get_model(checkpoint).eval(),
+                                 os.path.join(args.workdir, "compile_cache"))
+        for h, w in ((384, 384), (200, 300)):
+            images, masks = image_with_mask(*parity_inputs(max(h, w), 1, args.seed))
+            images, masks = images[:, :, 0:h, 0:w], masks[:, :, 0:h, 0:w]
+            check('compile', (h, w), model_forward_tiled(compiled, images, masks),
+                  model_forward_tiled(model, images, masks), masks[:, 0:1] < 0.5, 1e-4,
+                  bucket=compiled.compileBucket)
+    return results
+
+
+def result_key(result):
+    return (result['model'], result['backend'], result['dtype'],
+            result['threads'], result['size'], result['batch'])
+
+
+def benchmark_compare(baseline, current, threshold=0.1, metric='p50'):
+    """Rows (key, baseline ms, current ms, ratio, regressed) for results in both files."""
+    base = {result_key(r): r for r in baseline['results'] if 'skipped' not in r}
+    rows = []
+    for r in current['results']:
+        if 'skipped' in r or result_key(r) not in base:
+            continue
+        old, new = base[result_key(r)][metric], r[metric]
+        ratio = new / old
+        rows.append((result_key(r), old, new, ratio, ratio > 1.0 + threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    """Benchmark."""
+
+    def int_list(text):
+        return [int(x) for x in text.split(',')]
+
+    def str_list(choices):
+        def parse(text):
+            items = text.split(',')
+            for item in items:
+                if item not in choices:
+                    raise argparse.ArgumentTypeError(
+                        "'{}' is not one of {}".format(item, ', '.join(choices)))
+            return items
+        return parse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help="measure latency and throughput")
+    run.add_argument('--checkpoint', type=str, default=None,
+                     help="checkpoint file, default random weights")
+    run.add_argument('--models', type=str_list(MODELS), default=[MODELS[0]],
+                     help="comma list of " + ", ".join(MODELS))
+    run.add_argument('--backends', type=str_list(BACKENDS), default=['default'],
+                     help="comma list of " + ", ".join(BACKENDS))
+    run.add_argument('--dtypes', type=str_list(DTYPES), default=['fp32'],
+                     help="comma list of " + ", ".join(DTYPES))
+    run.add_argument('--sizes', type=int_list, default=[256, 512, 1024],
+                     help="comma list of image sizes, multiple of 128")
+    run.add_argument('--batch_sizes', type=int_list, default=[1], help="comma list of batch sizes")
+    run.add_argument('--threads', type=int_list, default=[torch.get_num_threads()],
+                     help="comma list of intra-op thread counts")
+    run.add_argument('--warmup', type=int, default=2, help="untimed calls per case")
+    run.add_argument('--repeat', type=int, default=10, help="timed calls per case")
+    run.add_argument('--seed', type=int, default=0, help="seed of weights and inputs")
+    run.add_argument('--workdir', type=str, default="output/benchmark",
+                     help="exported models and compile cache")
+    run.add_argument('--output', type=str, default="output/benchmark.json", help="result file")
+
+    cost = subparsers.add_parser('cost', help="predicted cost against measured peak RSS")
+    cost.add_argument('--checkpoint', type=str, default=None,
+                      help="checkpoint file, default random weights")
+    cost.add_argument('--backends', type=str_list(('default', 'onednn')), default=['default'],
+                      help="comma list of default, onednn")
+    cost.add_argument('--dtypes', type=str_list(DTYPES), default=['fp32'],
+                      help="comma list of " + ", ".join(DTYPES))
+    cost.add_argument('--sizes', type=int_list, default=[512, 1024],
+                      help="comma list of image sizes, multiple of 128, allocator and library "
+                      "caches dominate RSS below 512")
+    cost.add_argument('--batch_sizes', type=int_list, default=[1], help="comma list of batch sizes")
+    cost.add_argument('--tile_size', type=int, default=0, help="tiled inference, 0 means full frame")
+    cost.add_argument('--max_error', type=float, default=0.25,
+                      help="fail when prediction is off measured RSS by more than this ratio")
+    cost.add_argument('--workdir', type=str, default="output/benchmark", help="exported models")
+
+    stress = subparsers.add_parser('stress', help="concurrent requests on one shared model")
+    stress.add_argument('--checkpoint', type=str, default=None,
+                        help="checkpoint file, default random weights")
+    stress.add_argument('--backend', type=str, default='default', choices=BACKENDS)
+    stress.add_argument('--dtype', type=str, default='fp32', choices=DTYPES)
+    stress.add_argument('--sizes', type=int_list, default=[256, 384, 512],
+                        help="comma list of image sizes, requests cycle through them")
+    stress.add_argument('--workers', type=int, default=4, help="executor threads")
+    stress.add_argument('--requests', type=int, default=24, help="requests per round")
+    stress.add_argument('--rounds', type=int, default=3, help="rounds with shuffled order")
+    stress.add_argument('--seed', type=int, default=0, help="seed of inputs")
+    stress.add_argument('--workdir', type=str, default="output/benchmark", help="exported models")
+
+    scale = subparsers.add_parser('scale', help="multi-process pool from 1 to N workers")
+    scale.add_argument('--checkpoint', type=str, default=None,
+                       help="checkpoint file, default random weights")
+    scale.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'bf16'])
+    scale.add_argument('--workers', type=int_list,
+                       default=[1 << i for i in range(len(os.sched_getaffinity(0)).bit_length())],
+                       help="comma list of worker counts, default powers of 2 up to cores")
+    scale.add_argument('--threads', type=int, default=0,
+                       help="intra-op threads per worker, 0 means cores of its set")
+    scale.add_argument('--pin', action="store_true", help="pin workers to disjoint core sets")
+    scale.add_argument('--size', type=int, default=256, help="image size")
+    scale.add_argument('--tile_size', type=int, default=1024, help="tile size, multiple of 128")
+    scale.add_argument('--requests', type=int, default=32, help="timed requests per case")
+    scale.add_argument('--seed', type=int, default=0, help="seed of inputs")
+    scale.add_argument('--workdir', type=str, default="output/benchmark", help="exported models")
+
+    load = subparsers.add_parser('load', help="concurrent clients against running server.py")
+    load.add_argument('--server', type=str, default="http://127.0.0.1:8080",
+                      help="http://host:port or unix:path")
+    load.add_argument('--images', type=str, default="../testimgs/images/*.png", help="images")
+    load.add_argument('--masks', type=str, default="../testimgs/masks/*.png",
+                      help="masks, paired by sorted name")
+    load.add_argument('--crop_size', type=int, default=512, help="resize shorter side, 0 means none")
+    load.add_argument('--requests', type=int, default=32, help="total requests")
+    load.add_argument('--concurrency', type=int, default=8, help="clients sending at a time")
+
+    ready = subparsers.add_parser('ready', help="cold start of .pth against mapped weights")
+    ready.add_argument('--checkpoint', type=str, default=None,
+                       help=".pth checkpoint file, default random weights")
+    ready.add_argument('--vgg16', type=str, default="models/vgg16-397923af.pth",
+                       help="VGG16 weights of loss network")
+    ready.add_argument('--size', type=int, default=256, help="image size of first output")
+    ready.add_argument('--repeat', type=int, default=3, help="fresh processes per case")
+    ready.add_argument('--workdir', type=str, default="output/benchmark",
+                       help="converted weights")
+
+    parity = subparsers.add_parser('parity', help="execution paths against full frame eager")
+    parity.add_argument('--checkpoint', type=str, default=None,
+                        help="checkpoint file, default random weights")
+    parity.add_argument('--cases', type=str_list(PARITY_CASES), default=list(PARITY_CASES),
+                        help="comma list of " + ", ".join(PARITY_CASES))
+    parity.add_argument('--seed', type=int, default=0, help="seed of inputs")
+    parity.add_argument('--workdir', type=str, default="output/benchmark", help="exported models")
+
+    compare = subparsers.add_parser('compare', help="flag regressions against baseline")
+    compare.add_argument('baseline', type=str, help="baseline result file")
+    compare.add_argument('current', type=str, help="current result file")
+    compare.add_argument('--metric', type=str, default='p50', choices=['p50', 'p95', 'p99', 'mean'])
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help="regression when current is slower by more than this ratio")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = benchmark_compare(baseline, current, args.threshold, args.metric)
+        print("{:<48} {:>10} {:>10} {:>8}".format(
+            "case", "base(ms)", "now(ms)", "ratio"))
+        for key, old, new, ratio, regressed in rows:
+            print("{:<48} {:>10.1f} {:>10.1f} {:>8.2f}{}".format(
+                " ".join(str(k) for k in key), old, new, ratio, "  REGRESSION" if regressed else ""))
+        regressions = sum(row[4] for row in rows)
+        print("{} cases, {} regressions ({} > +{:.0f}%)".format(
+            len(rows), regressions, args.metric, args.threshold * 100))
+        sys.exit(1 if regressions > 0 else 0)
+
+    if args.command == 'stress':
+        report = benchmark_stress(args)
+        sys.exit(1 if report['mismatches'] > 0 else 0)
+
+    if args.command == 'scale':
+        benchmark_scale(args)
+        sys.exit(0)
+
+    if args.command == 'parity':
+        results = benchmark_parity(args)
+        sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+    if args.command == 'ready':
+        benchmark_ready(args)
+        sys.exit(0)
+
+    if args.command == 'load':
+        report = benchmark_load(args)
+        sys.exit(0 if report['ok'] == report['requests'] else 1)
+
+    if args.command == 'cost':
+        results = benchmark_cost(args)
+        failed = [r for r in results if abs(r['error']) > args.max_error]
+        print("{} cases, {} off by more than {:.0f}%".format(
+            len(results), len(failed), args.max_error * 100))
+        sys.exit(1 if failed else 0)
+
+    model_setenv()
+    results = benchmark_run(args)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    report = {
+        'host': {'platform': platform.platform(), 'processor': platform.processor(),
+                 'cpus': os.cpu_count(), 'torch': torch.__version__},
+        'config': {k: v for k, v in vars(args).items() if k != 'command'},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to '{}'.".format(args.output))
@@ -0,0 +1,129 @@
+"""Thin client of server.py, takes test.py arguments."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# python client.py --server unix:output/server.sock \
+#     --input ../testimgs/images/image_001.png --mask ../testimgs/masks/image_001.png \
+#     --output ../testimgs/output/result1 --pretrained models/ImagePatch.pth
+#
+# Saves output.png and output_orig.png like test.py, the model stays loaded in server.
+# Only needs python standard library.
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import sys
+import time
+import urllib.parse
+
+# same as data/basicFunction.py CheckImageFile
+IMAGE_EXTENSIONS = ('.png', '.PNG', '.jpg', '.JPG', '.jpeg', '.JPEG', '.bmp', '.BMP')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over unix socket."""
+
+    def __init__(self, path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def server_connection(server, timeout=None):
+    """server is http://host:port or unix:path."""
+    if server.startswith('unix:'):
+        return UnixHTTPConnection(server[len('unix:'):], timeout)
+    url = urllib.parse.urlsplit(server)
+    return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+
+
+def server_request(server, method, path, payload=None, retries=0, timeout=None):
+    """Return (status, json), 503 (server busy) is retried after Retry-After seconds."""
+    body = None if payload is None else json.dumps(payload).encode('utf-8')
+    for attempt in range(retries + 1):
+        connection = server_connection(server, timeout)
+        try:
+            connection.request(method, path, body=body,
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            status, data = response.status, json.loads(response.read() or b'{}')
+            retry_after = float(response.getheader('Retry-After', 1))
+        finally:
+            connection.close()
+        if status != 503 or attempt == retries:
+            return status, data
+        time.sleep(retry_after)
+
+
+def predict_request(input, mask, crop_size=0, pretrained="", deadline_ms=0):
+    """JSON body of POST /predict."""
+    with open(input, 'rb') as f:
+        image = base64.b64encode(f.read()).decode('ascii')
+    with open(mask, 'rb') as f:
+        mask = base64.b64encode(f.read()).decode('ascii')
+    return {'image': image, 'mask': mask, 'crop_size': crop_size,
+            'checkpoint': os.path.abspath(pretrained) if pretrained else "",
+            'deadline_ms': deadline_ms}
+
+
+if __name__ == "__main__":
+    """Client."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='', help='input damaged image')
+    parser.add_argument('--mask', type=str, default='', help='input mask')
+    parser.add_argument('--output', type=str, default='output', help='output file name')
+    parser.add_argument('--pretrained', type=str, default='',
+                        help='pretrained model, must be the one server runs')
+    parser.add_argument('--loadSize', type=int, default=350,
+                        help='image loading size, unused as in test.py')
+    parser.add_argument('--cropSize', type=int, default=1024,
+                        help='resize shorter side to this size')
+    parser.add_argument('--server', type=str, default="http://127.0.0.1:8080",
+                        help="http://host:port or unix:path")
+    parser.add_argument('--deadline', type=float, default=0,
+                        help="request deadline (ms), 0 means server default")
+    parser.add_argument('--retries', type=int, default=3, help="retries when server is busy")
+    parser.add_argument('--stats', action="store_true", help="print server stats and exit")
+    args = parser.parse_args()
+
+    if args.stats:
+        status, data = server_request(args.server, 'GET', '/stats')
+        print(json.dumps(data, indent=2))
+        sys.exit(0 if status == 200 else 1)
+
+    if not args.input.endswith(IMAGE_EXTENSIONS):
+        print('Input file is not image file!')
+    elif not args.mask.endswith(IMAGE_EXTENSIONS):
+        print('Input mask is not image file!')
+    elif args.pretrained == '':
+        print('Provide pretrained model!')
+    else:
+        status, data = server_request(
+            args.server, 'POST', '/predict',
+            predict_request(args.input, args.mask, args.cropSize, args.pretrained, args.deadline),
+            retries=args.retries)
+        if status != 200:
+            print("Server error {}: {}".format(status, data.get('error', '')))
+            sys.exit(1)
+
+        with open(args.output + "_orig.png", 'wb') as f:
+            f.write(base64.b64decode(data['orig']))
+        with open(args.output + ".png", 'wb') as f:
+            f.write(base64.b64decode(data['output']))
+        print("batch size {}, queue {:.1f} ms, inference {:.1f} ms".format(
+            data['batch_size'], data['queue_ms'], data['infer_ms']))
@@ -0,0 +1,54 @@
+"""Convert .pth checkpoint to mappable .safetensors weights."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# python convert.py models/ImagePatch.pth
+# python convert.py models/vgg16-397923af.pth --prefixes features.
+#
+# get_model, model_load and VGG16FeatureExtractor map .safetensors files instead of
+# unpickling and copying, VGG16FeatureExtractor picks it up next to the .pth file.
+
+import argparse
+import os
+import time
+
+import torch
+
+from model import WEIGHTS_SUFFIX, weights_convert, weights_load
+
+if __name__ == "__main__":
+    """Convert."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help=".pth state dict file")
+    parser.add_argument('--output', type=str, default="",
+                        help="weights file, default checkpoint with " + WEIGHTS_SUFFIX)
+    parser.add_argument('--prefixes', type=str, default="",
+                        help="comma list of name prefixes to keep, default all")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.checkpoint)[0] + WEIGHTS_SUFFIX
+    prefixes = [p for p in args.prefixes.split(',') if p]
+
+    start = time.time()
+    count = weights_convert(args.checkpoint, output, prefixes)
+    print("{} tensors saved to '{}' ({:.1f} MB -> {:.1f} MB) in {:.1f} s.".format(
+        count, output, os.path.getsize(args.checkpoint) / 1e6, os.path.getsize(output) / 1e6,
+        time.time() - start))
+
+    # round trip check
+    state_dict = torch.load(args.checkpoint, map_location='cpu')
+    if 'state_dict' in state_dict and isinstance(state_dict['state_dict'], dict):
+        state_dict = state_dict['state_dict']
+    mapped = weights_load(output)
+    for n, t in mapped.items():
+        if not torch.equal(t, state_dict[n]):
+            raise ValueError("Tensor '{}' differs after conversion".format(n))
+    print("Checked {} tensors, identical.".format(len(mapped)))
@@ -10,6 +10,7 @@
 # ************************************************************************************/
 #
 
+import glob
 import os
 import pdb
 
@@ -35,8 +36,10 @@ def get_transform(train=True):
     return T.Compose(ts)
 
 
-def image_with_mask(image, mask):
-    """image, mask: NX3xHxW."""
+def image_with_mask(image, mask, memory_format=torch.contiguous_format):
+    """image, mask: NX3xHxW, memory_format should match model.memoryFormat."""
+    image = image.contiguous(memory_format=memory_format)
+    mask = mask.contiguous(memory_format=memory_format)
     threshhold = 0.5
     ones = mask >= threshhold
     zeros = mask < threshhold
@@ -54,6 +57,37 @@ def image_with_mask(image, mask):
     return image, mask
 
 
+def load_image_pairs(images, masks, size=0, memory_format=torch.contiguous_format):
+    """Load (image, image_with_mask(image, mask)) list, sorted names are paired.
+
+    size > 0 resizes to size x size, 0 crops to multiple of 128.
+    """
+    totensor = T.ToTensor()
+    image_filenames = sorted(glob.glob(images))
+    mask_filenames = sorted(glob.glob(masks))
+    if len(image_filenames) != len(mask_filenames) or len(image_filenames) == 0:
+        raise ValueError("Found {} images but {} masks.".format(
+            len(image_filenames), len(mask_filenames)))
+
+    pairs = []
+    for image_filename, mask_filename in zip(image_filenames, mask_filenames):
+        image = Image.open(image_filename).convert("RGB")
+        mask = Image.open(mask_filename).convert("RGB")
+        if size > 0:
+            image = image.resize((size, size), Image.BICUBIC)
+            mask = mask.resize((size, size), Image.NEAREST)
+        else:
+            # model needs multiple of 128
+            width = image.width // 128 * 128
+            height = image.height // 128 * 128
+            image = image.crop((0, 0, width, height))
+            mask = mask.crop((0, 0, width, height))
+        image = totensor(image).unsqueeze(0)
+        mask = totensor(mask).unsqueeze(0)
+        pairs.append((image, image_with_mask(image, mask, memory_format)))
+    return pairs
+
+
 class ImagePatchDataset(data.Dataset):
     """Define dataset."""
 
@@ -96,7 +130,7 @@ class ImagePatchDataset(data.Dataset):
         return fmt_str
 
 
-def train_data(bs):
+def train_data(bs, num_workers=4):
     """Get data loader for trainning & validating, bs means batch_size."""
 
     train_ds = ImagePatchDataset(
@@ -113,28 +147,28 @@ def train_data(bs):
 
     # Define training and validation data loaders
     train_dl = data.DataLoader(
-        train_ds, batch_size=bs, shuffle=True, num_workers=4)
+        train_ds, batch_size=bs, shuffle=True, num_workers=num_workers)
     valid_dl = data.DataLoader(
-        valid_ds, batch_size=bs, shuffle=False, num_workers=4)
+        valid_ds, batch_size=bs, shuffle=False, num_workers=num_workers)
 
     return train_dl, valid_dl
 
 
-def test_data(bs):
+def test_data(bs, num_workers=4):
     """Get data loader for test, bs means batch_size."""
 
     test_ds = ImagePatchDataset(
         test_dataset_rootdir, get_transform(train=False))
     test_dl = data.DataLoader(test_ds, batch_size=bs,
-                              shuffle=False, num_workers=4)
+                              shuffle=False, num_workers=num_workers)
 
     return test_dl
 
 
-def get_data(trainning=True, bs=4):
+def get_data(trainning=True, bs=4, num_workers=4):
     """Get data loader for trainning & validating, bs means batch_size."""
 
-    return train_data(bs) if trainning else test_data(bs)
+    return train_data(bs, num_workers) if trainning else test_data(bs, num_workers)
 
 
 def ImagePatchDatasetTest():
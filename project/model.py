@@ -10,20 +10,32 @@
 # ************************************************************************************/
 #
 
+import collections
+import concurrent.futures
+import hashlib
+import json
 import math
 import os
 import pdb
+import queue
+import signal
+import struct
 import sys
+import threading
+import time
+import warnings
+from concurrent.futures.process import BrokenProcessPool
 
 import torch
 import torch.nn as nn
 from torch import autograd
 from torch.nn.parameter import Parameter
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
-from apex import amp
 from tqdm import tqdm
 
-from data import image_with_mask
+from data import image_with_mask, load_image_pairs
+from script import ALIGN, TILE_OVERLAP, tile_pad
 
 
 def PSNR(img1, img2):
@@ -74,56 +86,454 @@ class ImagePatchModel(nn.Module):
 
         self.tanh = nn.Tanh()
 
+        # Optional MaskPlanCache, see forward
+        self.planCache = None
+        # Optional Workspace for inference_forward buffers
+        self.workspace = None
+        # Gradient checkpointing granularity, see model_checkpoint
+        self.checkpoint = None
+        # Optional ActivationCompressor, see model_compress
+        self.compressor = None
+        # Native autocast dtype like torch.bfloat16, see enable_amp
+        self.autocast = None
+        # Memory format of inputs and inference buffers, see model_onednn
+        self.memoryFormat = torch.contiguous_format
+        # torch.compile of forward and its shape bucket, see model_compile
+        self.compiled = None
+        self.compileBucket = 0
+
+    def mask_plan(self, masks):
+        """Compile masks to MaskPlan, the whole mask branch only depends on masks."""
+        forwardMaps, mus = [], []
+        mu = masks
+        for i in range(1, 8):
+            forwardMap, mu = getattr(self, 'ec{:d}'.format(i)).conv.mask_forward(mu)
+            forwardMaps.append(forwardMap)
+            if i < 7:
+                mus.append(mu)
+
+        reverseMaps = []
+        revMu = 1 - masks
+        for i in range(1, 7):
+            reverseMap, revMu = getattr(
+                self, 'reverseConv{:d}'.format(i))(revMu)
+            reverseMaps.append(reverseMap)
+
+        return MaskPlan(forwardMaps, mus, reverseMaps)
+
+    def inference_forward(self, inputImgs, masks):
+        """Forward without autograd, every tensor is released after its last use.
+
+        Decoder level i input is cat(skip, dc) * cat(forwardMap, reverseMap), that is
+        [encoder convOut | dc * reverseMap]. Encoder writes the first half and decoder
+        the second half of one preallocated buffer, so there is no torch.cat and skip,
+        forwardMap are never kept.
+        """
+        plan = masks if isinstance(masks, MaskPlan) else None
+        batchSize = max(inputImgs.size(0),
+                        masks.forwardMaps[0].size(0) if plan else masks.size(0))
+        H, W = inputImgs.size(2), inputImgs.size(3)
+        device_type = inputImgs.device.type
+        dtype = torch.get_autocast_dtype(device_type) \
+            if torch.is_autocast_enabled(device_type) else inputImgs.dtype
+
+        buffers, reverseMaps = [], []
+        features, mu = inputImgs, masks
+        revMu = None if plan else 1 - masks
+        for i in range(1, 8):
+            ec = getattr(self, 'ec{:d}'.format(i))
+            buffer = None
+            if i < 7:
+                _, H, W = conv_flops(ec.conv.conv, H, W)
+                C = ec.conv.conv.out_channels
+                size = (batchSize, 2 * C, H, W)
+                if self.workspace is not None:
+                    buffer = self.workspace.get('dc{:d}'.format(7 - i), size, dtype,
+                                                inputImgs.device, self.memoryFormat)
+                else:
+                    buffer = torch.empty(size, dtype=dtype, device=inputImgs.device,
+                                         memory_format=self.memoryFormat)
+
+            if plan is None:
+                features, mu, _, _ = ec(features, mu, out=buffer[:, 0:C] if i < 7 else None)
+            else:
+                features, _, _, _ = ec(features, None, plan.forwardMaps[i - 1],
+                                       out=buffer[:, 0:C] if i < 7 else None)
+            if i == 7:
+                break
+
+            buffers.append(buffer)
+            if plan is None:
+                reverseMap, revMu = getattr(
+                    self, 'reverseConv{:d}'.format(i))(revMu)
+            else:
+                reverseMap = plan.reverseMaps[i - 1]
+            reverseMaps.append(reverseMap)
+        del mu, revMu, buffer, reverseMap
+
+        for i in range(1, 7):
+            features = getattr(self, 'dc{:d}'.format(i)).inference_forward(
+                features, reverseMaps.pop(), buffers.pop())
+
+        output = self.dc7(features)
+        del features
+        output = self.tanh(output.float())
+
+        return output.add_(1).div_(2)
+
     def forward(self, inputImgs, masks):
-        """Forward."""
+        """Forward, masks could be MaskPlan, whose batch size could be 1 for all images."""
 
         # pdb.set_trace()
         # (Pdb) pp inputImgs.size(), masks.size()
         # (torch.Size([1, 4, 1024, 1024]), torch.Size([1, 3, 1024, 1024]))
 
-        ef1, mu1, skipConnect1, forwardMap1 = self.ec1(inputImgs, masks)
-        ef2, mu2, skipConnect2, forwardMap2 = self.ec2(ef1, mu1)
-        ef3, mu3, skipConnect3, forwardMap3 = self.ec3(ef2, mu2)
-        ef4, mu4, skipConnect4, forwardMap4 = self.ec4(ef3, mu3)
-        ef5, mu5, skipConnect5, forwardMap5 = self.ec5(ef4, mu4)
-        ef6, mu6, skipConnect6, forwardMap6 = self.ec6(ef5, mu5)
-        ef7, _, _, _ = self.ec7(ef6, mu6)
+        if self.compiled is not None and not torch.compiler.is_compiling():
+            return self.compiled_forward(inputImgs, masks)
+
+        device_type = inputImgs.device.type
+        if self.autocast is not None and not torch.is_autocast_enabled(device_type):
+            # Every weight is used once per forward, caching its cast only costs memory
+            with torch.autocast(device_type, dtype=self.autocast, cache_enabled=False):
+                return self.forward(inputImgs, masks)
+
+        inputImgs = inputImgs.contiguous(memory_format=self.memoryFormat)
+        if not isinstance(masks, MaskPlan):
+            masks = masks.contiguous(memory_format=self.memoryFormat)
+
+        if isinstance(masks, MaskPlan):
+            if torch.is_grad_enabled() and not any(t.requires_grad for t in masks.tensors()) \
+                    and any(p.requires_grad for p in self.parameters()):
+                # mask branch parameters would silently get no gradient
+                raise ValueError("MaskPlan was built without grad, build it with grad "
+                                 "enabled or pass masks")
+        elif self.planCache is not None and not torch.is_grad_enabled():
+            # cached plans are built without grad, training computes the mask branch
+            masks = self.planCache.get(self, masks)
+
+        if not torch.is_grad_enabled() and not torch.jit.is_tracing():
+            return self.inference_forward(inputImgs, masks)
+
+        if self.checkpoint == 'half':
+            encoded = checkpoint_forward(self, self.encoder_forward, inputImgs, masks)
+            output = checkpoint_forward(self, self.decoder_forward, *encoded)
+        else:
+            output = self.decoder_forward(*self.encoder_forward(inputImgs, masks))
 
-        reverseMap1, revMu1 = self.reverseConv1(1 - masks)
-        reverseMap2, revMu2 = self.reverseConv2(revMu1)
-        reverseMap3, revMu3 = self.reverseConv3(revMu2)
-        reverseMap4, revMu4 = self.reverseConv4(revMu3)
-        reverseMap5, revMu5 = self.reverseConv5(revMu4)
-        reverseMap6, _ = self.reverseConv6(revMu5)
+        # pdb.set_trace()
+        # (Pdb) pp output.size()
+        # torch.Size([1, 3, 1024, 1024])
 
-        concatMap6 = torch.cat((forwardMap6, reverseMap6), 1)
-        dcFeatures1 = self.dc1(skipConnect6, ef7, concatMap6)
+        return output
 
-        concatMap5 = torch.cat((forwardMap5, reverseMap5), 1)
-        dcFeatures2 = self.dc2(skipConnect5, dcFeatures1, concatMap5)
+    def compiled_forward(self, inputImgs, masks):
+        """Run compiled forward, inference inputs are padded up to the shape bucket."""
+        for m in self.modules():
+            if isinstance(m, GaussActivation) and not m.frozen:
+                m.clamp_()
+
+        bucket = self.compileBucket
+        if torch.is_grad_enabled() or isinstance(masks, MaskPlan) or bucket <= 0:
+            return self.compiled(inputImgs, masks)
+
+        # one compiled graph per bucket, not per image size
+        H, W = inputImgs.size(2), inputImgs.size(3)
+        height = (H + bucket - 1) // bucket * bucket
+        width = (W + bucket - 1) // bucket * bucket
+        output = self.compiled(tile_pad(inputImgs, height, width),
+                               tile_pad(masks, height, width))
+        return output[:, :, 0:H, 0:W]
+
+    def stage_forward(self, granularity, module, *args):
+        """Run one stage, checkpointed when self.checkpoint selects its granularity."""
+        if self.checkpoint in (granularity, 'stage'):
+            return checkpoint_forward(module, module, *args)
+        return module(*args)
+
+    def encoder_forward(self, inputImgs, masks):
+        """Encoder half, returns ef7, skip connections 1-6 and reverse maps 1-6."""
+        stage = self.stage_forward
+        if isinstance(masks, MaskPlan):
+            forwardMaps = masks.forwardMaps
+            ef1, _, attendedSkip1, _ = stage('forward', self.ec1, inputImgs, None, forwardMaps[0])
+            ef2, _, attendedSkip2, _ = stage('forward', self.ec2, ef1, None, forwardMaps[1])
+            ef3, _, attendedSkip3, _ = stage('forward', self.ec3, ef2, None, forwardMaps[2])
+            ef4, _, attendedSkip4, _ = stage('forward', self.ec4, ef3, None, forwardMaps[3])
+            ef5, _, attendedSkip5, _ = stage('forward', self.ec5, ef4, None, forwardMaps[4])
+            ef6, _, attendedSkip6, _ = stage('forward', self.ec6, ef5, None, forwardMaps[5])
+            ef7, _, _, _ = stage('forward', self.ec7, ef6, None, forwardMaps[6])
+
+            reverseMap1, reverseMap2, reverseMap3, reverseMap4, reverseMap5, \
+                reverseMap6 = masks.reverseMaps
+        else:
+            ef1, mu1, attendedSkip1, _ = stage('forward', self.ec1, inputImgs, masks)
+            ef2, mu2, attendedSkip2, _ = stage('forward', self.ec2, ef1, mu1)
+            ef3, mu3, attendedSkip3, _ = stage('forward', self.ec3, ef2, mu2)
+            ef4, mu4, attendedSkip4, _ = stage('forward', self.ec4, ef3, mu3)
+            ef5, mu5, attendedSkip5, _ = stage('forward', self.ec5, ef4, mu4)
+            ef6, mu6, attendedSkip6, _ = stage('forward', self.ec6, ef5, mu5)
+            ef7, _, _, _ = stage('forward', self.ec7, ef6, mu6)
+
+            reverseMap1, revMu1 = stage('forward', self.reverseConv1, 1 - masks)
+            reverseMap2, revMu2 = stage('forward', self.reverseConv2, revMu1)
+            reverseMap3, revMu3 = stage('forward', self.reverseConv3, revMu2)
+            reverseMap4, revMu4 = stage('forward', self.reverseConv4, revMu3)
+            reverseMap5, revMu5 = stage('forward', self.reverseConv5, revMu4)
+            reverseMap6, _ = stage('forward', self.reverseConv6, revMu5)
+
+        return ef7, attendedSkip1, attendedSkip2, attendedSkip3, attendedSkip4, attendedSkip5, \
+            attendedSkip6, reverseMap1, reverseMap2, reverseMap3, reverseMap4, reverseMap5, \
+            reverseMap6
+
+    def decoder_forward(self, ef7, attendedSkip1, attendedSkip2, attendedSkip3, attendedSkip4,
+                        attendedSkip5, attendedSkip6, reverseMap1, reverseMap2, reverseMap3,
+                        reverseMap4, reverseMap5, reverseMap6):
+        """Decoder half, returns output in [0, 1]."""
+        stage = self.stage_forward
+        # attendedSkip is already multiplied by forward attention map,
+        # so decoders only take the reverse attention map
+        dcFeatures1 = stage('reverse', self.dc1, attendedSkip6, ef7, reverseMap6)
+        dcFeatures2 = stage('reverse', self.dc2, attendedSkip5, dcFeatures1, reverseMap5)
+        dcFeatures3 = stage('reverse', self.dc3, attendedSkip4, dcFeatures2, reverseMap4)
+        dcFeatures4 = stage('reverse', self.dc4, attendedSkip3, dcFeatures3, reverseMap3)
+        dcFeatures5 = stage('reverse', self.dc5, attendedSkip2, dcFeatures4, reverseMap2)
+        dcFeatures6 = stage('reverse', self.dc6, attendedSkip1, dcFeatures5, reverseMap1)
 
-        concatMap4 = torch.cat((forwardMap4, reverseMap4), 1)
-        dcFeatures3 = self.dc3(skipConnect4, dcFeatures2, concatMap4)
+        dcFeatures7 = self.dc7(dcFeatures6)
 
-        concatMap3 = torch.cat((forwardMap3, reverseMap3), 1)
-        dcFeatures4 = self.dc4(skipConnect3, dcFeatures3, concatMap3)
+        return (self.tanh(dcFeatures7.float()) + 1) / 2
 
-        concatMap2 = torch.cat((forwardMap2, reverseMap2), 1)
-        dcFeatures5 = self.dc5(skipConnect2, dcFeatures4, concatMap2)
 
-        concatMap1 = torch.cat((forwardMap1, reverseMap1), 1)
-        dcFeatures6 = self.dc6(skipConnect1, dcFeatures5, concatMap1)
+class MaskPlan(object):
+    """Mask branch results of ImagePatchModel.
 
-        dcFeatures7 = self.dc7(dcFeatures6)
+    forwardMaps: ec1-ec7 attention maps, mus: ec1-ec6 updated masks,
+    reverseMaps: reverseConv1-6 attention maps.
+    """
 
-        output = (self.tanh(dcFeatures7) + 1) / 2
+    def __init__(self, forwardMaps, mus, reverseMaps):
+        """Init plan."""
+        self.forwardMaps = forwardMaps
+        self.mus = mus
+        self.reverseMaps = reverseMaps
 
-        # pdb.set_trace()
-        # (Pdb) pp output.size()
-        # torch.Size([1, 3, 1024, 1024])
+    def tensors(self):
+        """All tensors in plan."""
+        return self.forwardMaps + self.mus + self.reverseMaps
+
+    def nbytes(self):
+        """Memory size of plan."""
+        return sum(t.numel() * t.element_size() for t in self.tensors())
 
+    def to(self, device):
+        """Move plan to device."""
+        return MaskPlan([t.to(device) for t in self.forwardMaps],
+                        [t.to(device) for t in self.mus],
+                        [t.to(device) for t in self.reverseMaps])
+
+
+class Workspace(object):
+    """Buffers reused across inference calls, keyed by name."""
+
+    def __init__(self):
+        """Init workspace."""
+        self.buffers = {}
+
+    def get(self, name, size, dtype, device, memory_format=torch.contiguous_format):
+        """Get buffer, reallocate it if size, dtype, device or memory format changed."""
+        buffer = self.buffers.get(name)
+        if buffer is not None and buffer.size() == size and buffer.dtype == dtype \
+                and buffer.device == device and buffer.is_contiguous(memory_format=memory_format):
+            return buffer
+
+        # release old buffer before allocating the new one
+        del buffer
+        self.buffers.pop(name, None)
+        self.buffers[name] = torch.empty(size, dtype=dtype, device=device,
+                                         memory_format=memory_format)
+        return self.buffers[name]
+
+    def nbytes(self):
+        """Memory size of workspace."""
+        return sum(b.numel() * b.element_size() for b in self.buffers.values())
+
+    def clear(self):
+        """Release all buffers."""
+        self.buffers.clear()
+
+
+class MaskPlanCache(object):
+    """LRU cache of MaskPlan, keyed by mask content hash, bounded by max_bytes.
+
+    Plans are computed without gradients and become stale if weights change, so
+    ImagePatchModel only uses the cache when grad is disabled.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        """Init cache."""
+        self.max_bytes = max_bytes
+        self.plans = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # shared by ModelExecutor threads
+        self.lock = threading.Lock()
+
+    def key(self, masks):
+        """Content hash of masks."""
+        h = hashlib.sha1(masks.detach().contiguous().cpu().numpy().tobytes())
+        h.update(str((tuple(masks.size()), masks.dtype, masks.device)).encode())
+        return h.hexdigest()
+
+    def get(self, model, masks):
+        """Get plan from cache, compile and cache it if not found."""
+        key = self.key(masks)
+        with self.lock:
+            if key in self.plans:
+                self.hits += 1
+                self.plans.move_to_end(key)
+                return self.plans[key]
+            self.misses += 1
+
+        # concurrent misses of one key both compile, the later one is kept
+        with torch.no_grad():
+            plan = model.mask_plan(masks)
+        with self.lock:
+            if key in self.plans:
+                self.nbytes -= self.plans.pop(key).nbytes()
+            self.plans[key] = plan
+            self.nbytes += plan.nbytes()
+            while self.nbytes > self.max_bytes and len(self.plans) > 1:
+                _, old = self.plans.popitem(last=False)
+                self.nbytes -= old.nbytes()
+        return plan
+
+    def clear(self):
+        """Remove all plans."""
+        with self.lock:
+            self.plans.clear()
+            self.nbytes = 0
+
+
+def checkpoint_forward(module, function, *args):
+    """Checkpoint function(*args), BatchNorm running stats in module are updated only once.
+
+    Backward runs function again, the recomputation must not count the batch twice.
+    """
+    calls = []
+
+    def run(*inputs):
+        if not calls:
+            calls.append(True)
+            return function(*inputs)
+
+        stats = [b for m in module.modules()
+                 if isinstance(m, nn.modules.batchnorm._BatchNorm) for b in m.buffers()]
+        saved = [b.clone() for b in stats]
+        output = function(*inputs)
+        for b, s in zip(stats, saved):
+            b.copy_(s)
         return output
 
+    return checkpoint(run, *args, use_reentrant=False)
+
+
+class ActivationCompressor(object):
+    """Store tensors saved for backward in bf16 or per-channel int8, per layer type.
+
+    config maps layer type to 'bf16' or 'int8', layer types are
+    'forward' -- ForwardAttention, 'mask' -- ReverseMaskConv,
+    'reverse' -- ReverseAttention, 'gauss' -- GaussActivation.
+    Inner layers use their own setting, so {'forward': 'bf16', 'gauss': 'int8'}
+    keeps GaussActivation inputs in int8 inside bf16 ForwardAttention.
+    """
+
+    def __init__(self, model, config):
+        """Register hooks on model."""
+        self.config = config
+        self.contexts = []
+        # Tensors packed in current outermost layer, one tensor saved by several ops is packed once
+        self.packed = {}
+        self.handles = []
+        self.nbytes = 0
+        self.packedBytes = 0
+
+        types = dict(zip(COMPRESS_LAYERS,
+                         (ForwardAttention, ReverseMaskConv, ReverseAttention, GaussActivation)))
+        for name, mode in config.items():
+            if name not in types:
+                raise ValueError("Unknown layer type '{}'".format(name))
+            if mode not in COMPRESS_MODES:
+                raise ValueError("Unknown compression '{}'".format(mode))
+            for m in model.modules():
+                if isinstance(m, types[name]):
+                    self.handles.append(m.register_forward_pre_hook(self.enter_hook(mode)))
+                    self.handles.append(m.register_forward_hook(self.exit_hook, always_call=True))
+
+    def enter_hook(self, mode):
+        pack = self.pack_bf16 if mode == 'bf16' else self.pack_int8
+
+        def hook(module, inputs):
+            if torch.is_grad_enabled():
+                context = autograd.graph.saved_tensors_hooks(pack, self.unpack)
+                context.__enter__()
+            else:
+                context = None
+            self.contexts.append(context)
+        return hook
+
+    def exit_hook(self, module, inputs, output=None):
+        context = self.contexts.pop()
+        if context is not None:
+            context.__exit__(None, None, None)
+        if not self.contexts:
+            self.packed.clear()
+
+    @staticmethod
+    def compressible(tensor):
+        # Parameters stay as they are, compressing them only adds copies
+        return tensor.dim() == 4 and tensor.dtype == torch.float32 and \
+            not (tensor.is_leaf and tensor.requires_grad)
+
+    def pack(self, tensor, mode):
+        if not self.compressible(tensor):
+            return tensor
+        key = (tensor.data_ptr(), tensor.size(), tensor._version, mode)
+        if key in self.packed:
+            return self.packed[key][1]
+
+        if mode == 'bf16':
+            packed = ('bf16', tensor.to(torch.bfloat16))
+            self.packedBytes += tensor.numel() * 2
+        else:
+            scale = tensor.abs().amax(dim=(0, 2, 3), keepdim=True).div_(127.0).clamp_(min=1e-12)
+            packed = ('int8', torch.round(tensor / scale).to(torch.int8), scale)
+            self.packedBytes += tensor.numel() + scale.numel() * scale.element_size()
+        self.nbytes += tensor.numel() * tensor.element_size()
+        # Keep tensor referenced so its address is not reused while key is alive
+        self.packed[key] = (tensor, packed)
+        return packed
+
+    def pack_bf16(self, tensor):
+        return self.pack(tensor, 'bf16')
+
+    def pack_int8(self, tensor):
+        return self.pack(tensor, 'int8')
+
+    @staticmethod
+    def unpack(packed):
+        if isinstance(packed, torch.Tensor):
+            return packed
+        if packed[0] == 'bf16':
+            return packed[1].float()
+        return packed[1].float().mul_(packed[2])
+
+    def remove(self):
+        """Remove hooks."""
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+
 
 def weights_init(init_type='gaussian'):
     def init_fun(m):
@@ -152,6 +562,52 @@ def weights_init(init_type='gaussian'):
     return init_fun
 
 
+def gauss_activation(inputFeatures, a, mu, sigma1, sigma2):
+    """Asymmetric gaussian g_A, plain tensor ops."""
+    # left: a * exp(-sigma1 * (x - mu)^2), right: 1 + (a - 1) * exp(-sigma2 * (x - mu)^2)
+    lowerThanMu = inputFeatures < mu
+    output = inputFeatures - mu
+    output.square_().mul_(torch.where(lowerThanMu, -sigma1, -sigma2)).exp_()
+    output.mul_(torch.where(lowerThanMu, a, a - 1)).add_(~lowerThanMu)
+
+    return output
+
+
+class GaussActivationFunction(autograd.Function):
+    """Asymmetric gaussian g_A, only input is saved, backward recomputes the rest."""
+
+    @staticmethod
+    def forward(ctx, inputFeatures, a, mu, sigma1, sigma2):
+        ctx.save_for_backward(inputFeatures, a, mu, sigma1, sigma2)
+
+        return gauss_activation(inputFeatures, a, mu, sigma1, sigma2)
+
+    @staticmethod
+    def backward(ctx, gradOutput):
+        inputFeatures, a, mu, sigma1, sigma2 = ctx.saved_tensors
+
+        lowerThanMu = inputFeatures < mu
+        diff = inputFeatures - mu
+        sigma = torch.where(lowerThanMu, sigma1, sigma2)
+        scale = torch.where(lowerThanMu, a, a - 1)
+        gradExp = gradOutput * torch.exp(-sigma * diff * diff)
+
+        gradInput = gradA = gradMu = gradSigma1 = gradSigma2 = None
+        if ctx.needs_input_grad[1]:
+            gradA = gradExp.sum()
+        gradExp = gradExp * scale
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[2]:
+            gradInput = -2 * sigma * diff * gradExp
+            if ctx.needs_input_grad[2]:
+                gradMu = -gradInput.sum()
+        if ctx.needs_input_grad[3] or ctx.needs_input_grad[4]:
+            gradSigma = -diff * diff * gradExp
+            gradSigma1 = torch.where(lowerThanMu, gradSigma, 0).sum()
+            gradSigma2 = torch.where(lowerThanMu, 0, gradSigma).sum()
+
+        return gradInput, gradA, gradMu, gradSigma1, gradSigma2
+
+
 class GaussActivation(nn.Module):
     def __init__(self, a, mu, sigma1, sigma2):
         super(GaussActivation, self).__init__()
@@ -160,37 +616,53 @@ class GaussActivation(nn.Module):
         self.mu = Parameter(torch.tensor(mu, dtype=torch.float32))
         self.sigma1 = Parameter(torch.tensor(sigma1, dtype=torch.float32))
         self.sigma2 = Parameter(torch.tensor(sigma2, dtype=torch.float32))
+        # Parameters are clamped once by model_freeze, forward leaves them alone
+        self.frozen = False
 
         # pdb.set_trace()
 
+    def clamp_(self):
+        """Project parameters to their valid range, in place and out of autograd."""
+        self.a.data.clamp_(1.01, 6.0)
+        self.mu.data.clamp_(0.1, 3.0)
+        self.sigma1.data.clamp_(0.5, 2.0)
+        self.sigma2.data.clamp_(0.5, 2.0)
+
     def forward(self, inputFeatures):
 
         # pdb.set_trace()
 
-        self.a.data = torch.clamp(self.a.data, 1.01, 6.0)
-        self.mu.data = torch.clamp(self.mu.data, 0.1, 3.0)
-        self.sigma1.data = torch.clamp(self.sigma1.data, 0.5, 2.0)
-        self.sigma2.data = torch.clamp(self.sigma2.data, 0.5, 2.0)
+        # compiled graphs can not mutate .data, model_compile clamps before calling them
+        if not self.frozen and not torch.compiler.is_compiling():
+            self.clamp_()
 
-        lowerThanMu = inputFeatures < self.mu
-        largerThanMu = inputFeatures >= self.mu
+        # Attention maps run in fp32 under autocast, bf16 is too coarse around mu
+        if torch.jit.is_tracing():
+            # traced graph records tensor ops, python autograd functions can not be saved
+            return gauss_activation(inputFeatures.float(), self.a, self.mu, self.sigma1, self.sigma2)
+        return GaussActivationFunction.apply(inputFeatures.float(), self.a, self.mu, self.sigma1, self.sigma2)
 
-        # pdb.set_trace()
 
-        leftValuesActiv = self.a * \
-            torch.exp(- self.sigma1 * ((inputFeatures - self.mu) ** 2))
-        leftValuesActiv.masked_fill_(largerThanMu, 0.0)
+class MaskUpdateFunction(autograd.Function):
+    """relu(x) ** alpha, only input is saved."""
 
-        rightValueActiv = 1 + \
-            (self.a - 1) * torch.exp(- self.sigma2 *
-                                     ((inputFeatures - self.mu) ** 2))
-        rightValueActiv.masked_fill_(lowerThanMu, 0.0)
+    @staticmethod
+    def forward(ctx, inputMaskMap, alpha):
+        ctx.save_for_backward(inputMaskMap)
+        ctx.alpha = alpha
 
-        output = leftValuesActiv + rightValueActiv
+        return torch.relu(inputMaskMap).pow_(alpha)
 
-        # pdb.set_trace()
+    @staticmethod
+    def backward(ctx, gradOutput):
+        inputMaskMap, = ctx.saved_tensors
 
-        return output
+        # gradient is zero for x <= 0, pow(0, alpha - 1) there is not used
+        gradInput = gradOutput * ctx.alpha * \
+            torch.relu(inputMaskMap).pow_(ctx.alpha - 1)
+        gradInput = torch.where(inputMaskMap > 0, gradInput, 0)
+
+        return gradInput, None
 
 # mask updating functions, we recommand using alpha that is larger than 0 and lower than 1.0
 
@@ -199,7 +671,6 @@ class MaskUpdate(nn.Module):
     def __init__(self, alpha):
         super(MaskUpdate, self).__init__()
 
-        self.updateFunc = nn.ReLU(True)
         #self.alpha = Parameter(torch.tensor(alpha, dtype=torch.float32))
         self.alpha = alpha
 
@@ -207,7 +678,9 @@ class MaskUpdate(nn.Module):
         """ self.alpha.data = torch.clamp(self.alpha.data, 0.6, 0.8)
         print(self.alpha) """
 
-        return torch.pow(self.updateFunc(inputMaskMap), self.alpha)
+        if torch.jit.is_tracing():
+            return torch.relu(inputMaskMap).pow_(self.alpha)
+        return MaskUpdateFunction.apply(inputMaskMap, self.alpha)
 
 # learnable forward attention conv layer
 
@@ -233,22 +706,85 @@ class ForwardAttentionLayer(nn.Module):
         self.activationFuncG_A = GaussActivation(1.1, 2.0, 1.0, 1.0)
         self.updateMask = MaskUpdate(0.8)
 
-    def forward(self, inputFeatures, inputMasks):
-        convFeatures = self.conv(inputFeatures)
+    def fuse(self):
+        """Pack conv and maskConv into one grouped conv (groups=2), inference only.
+
+        Packed weights are a detached copy. forward runs it only when grad is disabled
+        and weights did not change since fuse(), otherwise the two convs run.
+        """
+        self.fusedVersion = self.weight_version()
+        weight = self.conv.weight.detach()
+        maskWeight = self.maskConv.weight.detach()
+        # ec1 has 4 feature channels but 3 mask channels, pad mask weight with zeros
+        maskWeight = nn.functional.pad(
+            maskWeight, (0, 0, 0, 0, 0, weight.size(1) - maskWeight.size(1)))
+        self.register_buffer('fusedWeight', torch.cat(
+            (weight, maskWeight), 0), persistent=False)
+        if self.conv.bias is not None:
+            self.register_buffer('fusedBias', torch.cat(
+                (self.conv.bias.detach(), self.maskConv.bias.detach()), 0), persistent=False)
+        else:
+            self.fusedBias = None
+
+    def weight_version(self):
+        """In-place updates (optimizer step, load_state_dict) bump tensor versions."""
+        return tuple(t._version for t in (self.conv.weight, self.conv.bias,
+                                          self.maskConv.weight, self.maskConv.bias)
+                     if t is not None)
+
+    def fused(self):
+        """True if fused_forward gives what conv and maskConv give."""
+        return hasattr(self, 'fusedWeight') and not torch.is_grad_enabled() and \
+            self.fusedVersion == self.weight_version()
+
+    def fused_forward(self, inputFeatures, inputMasks):
+        """conv and maskConv in one grouped conv, see fuse()."""
+        padChannels = inputFeatures.size(1) - inputMasks.size(1)
+        inputs = torch.cat((inputFeatures, inputMasks) +
+                           (inputMasks[:, 0:padChannels],) * (padChannels > 0), 1)
+        outputs = nn.functional.conv2d(inputs, self.fusedWeight, self.fusedBias, self.conv.stride,
+                                       self.conv.padding, self.conv.dilation, 2 * self.conv.groups)
+        return outputs.chunk(2, 1)
+
+    def mask_forward(self, inputMasks):
+        """Mask branch only, it does not depend on features."""
         maskFeatures = self.maskConv(inputMasks)
-        #convFeatures_skip = convFeatures.clone()
 
         maskActiv = self.activationFuncG_A(maskFeatures)
-        convOut = convFeatures * maskActiv
-
         maskUpdate = self.updateMask(maskFeatures)
 
+        return maskActiv, maskUpdate
+
+    def forward(self, inputFeatures, inputMasks, maskActiv=None, out=None):
+        # maskActiv comes from MaskPlan, skip mask branch; out for convOut, no autograd
+        if maskActiv is None and self.fused():
+            convFeatures, maskFeatures = self.fused_forward(
+                inputFeatures, inputMasks)
+            maskActiv = self.activationFuncG_A(maskFeatures)
+            maskUpdate = self.updateMask(maskFeatures)
+        elif maskActiv is None:
+            convFeatures = self.conv(inputFeatures)
+            maskActiv, maskUpdate = self.mask_forward(inputMasks)
+        else:
+            convFeatures = self.conv(inputFeatures)
+            maskUpdate = None
+        #convFeatures_skip = convFeatures.clone()
+
+        convOut = torch.mul(convFeatures, maskActiv, out=out)
+
         return convOut, maskUpdate, convFeatures, maskActiv
 
 # forward attention gather feature activation and batchnorm
 
 
 class ForwardAttention(nn.Module):
+    """ForwardAttentionLayer with optional bn and activation.
+
+    forward returns (features, maskUpdated, attendedSkip, maskActiv). attendedSkip is
+    conv features multiplied by the forward attention map, ready for ReverseAttention.
+    It is not the raw conv features, third value of LBAMModel's ForwardAttention.
+    """
+
     def __init__(self, inputChannels, outputChannels, bn=False, sample='down-4',
                  activ='leaky', convBias=False):
         super(ForwardAttention, self).__init__()
@@ -285,18 +821,20 @@ class ForwardAttention(nn.Module):
         else:
             pass
 
-    def forward(self, inputFeatures, inputMasks):
+    def forward(self, inputFeatures, inputMasks, maskActiv=None, out=None):
         # pdb.set_trace()
 
         features, maskUpdated, convPreF, maskActiv = self.conv(
-            inputFeatures, inputMasks)
+            inputFeatures, inputMasks, maskActiv, out)
 
+        # ReverseAttention takes it as the first half of its attended input
+        attendedSkip = features
         if hasattr(self, 'bn'):
             features = self.bn(features)
         if hasattr(self, 'activ'):
             features = self.activ(features)
 
-        return features, maskUpdated, convPreF, maskActiv
+        return features, maskUpdated, attendedSkip, maskActiv
 
 
 class ReverseMaskConv(nn.Module):
@@ -400,13 +938,15 @@ class ReverseAttention(nn.Module):
         # torch.Size([1, 512, 16, 16])
 
         # note that encoder features are ahead, it's important tor make forward attention map ahead
-        # of reverse attention map when concatenate, we do it in the LBAM model forward function
-        concatFeatures = torch.cat((ecFeaturesSkip, nextDcFeatures), 1)
-        # (Pdb) concatFeatures.size()
+        # of reverse attention map when concatenate.
+        # cat(skip, dc) * cat(forwardMap, reverseMap) == cat(skip * forwardMap, dc * reverseMap),
+        # ecFeaturesSkip comes from ForwardAttention already multiplied by forwardMap,
+        # maskFeaturesForAttention is reverseMap only, so no attention map concatenation.
+        outputFeatures = torch.cat(
+            (ecFeaturesSkip, nextDcFeatures * maskFeaturesForAttention), 1)
+        # (Pdb) outputFeatures.size()
         # torch.Size([1, 1024, 16, 16])
 
-        outputFeatures = concatFeatures * maskFeaturesForAttention
-
         if hasattr(self, 'bn'):
             outputFeatures = self.bn(outputFeatures)
         if hasattr(self, 'activ'):
@@ -420,6 +960,130 @@ class ReverseAttention(nn.Module):
 
         return outputFeatures
 
+    def inference_forward(self, dcFeatures, reverseMap, outputFeatures):
+        """No autograd, outputFeatures is preallocated [attended skip | free].
+
+        Second half gets self.conv(dcFeatures) * reverseMap, activation runs in place.
+        """
+        skipChannels = outputFeatures.size(1) - self.conv.out_channels
+        torch.mul(self.conv(dcFeatures), reverseMap,
+                  out=outputFeatures[:, skipChannels:])
+        del dcFeatures, reverseMap
+
+        if hasattr(self, 'bn'):
+            outputFeatures = self.bn(outputFeatures)
+        if isinstance(getattr(self, 'activ', None), nn.LeakyReLU):
+            nn.functional.leaky_relu_(
+                outputFeatures, self.activ.negative_slope)
+        elif hasattr(self, 'activ'):
+            outputFeatures = self.activ(outputFeatures)
+
+        return outputFeatures
+
+
+class SubPixelConvTranspose2d(nn.Module):
+    """ConvTranspose2d(kernel_size=4, stride=2, padding=1) as a stride-1 conv.
+
+    One 2x2 conv at input resolution gives the 4 output phases, they are
+    interleaved like pixel_shuffle. Weights come from the transposed conv.
+    """
+
+    def __init__(self, convTranspose):
+        super(SubPixelConvTranspose2d, self).__init__()
+
+        self.in_channels = convTranspose.in_channels
+        self.out_channels = convTranspose.out_channels
+        self.kernel_size = convTranspose.kernel_size
+        self.stride = convTranspose.stride
+
+        # Phase (rh, rw), tap (u, v) uses transposed kernel[3 - 2u - rh, 3 - 2v - rw]
+        index = torch.tensor([[3, 1], [2, 0]])
+        weight = convTranspose.weight.detach()[:, :, index][:, :, :, :, index]
+        weight = weight.permute(1, 2, 4, 0, 3, 5).reshape(
+            self.out_channels * 4, self.in_channels, 2, 2)
+
+        self.conv = nn.Conv2d(self.in_channels, self.out_channels * 4, 2, padding=1,
+                              bias=convTranspose.bias is not None)
+        self.conv.weight.data.copy_(weight)
+        if convTranspose.bias is not None:
+            self.conv.bias.data.copy_(
+                convTranspose.bias.detach().repeat_interleave(4))
+
+    @staticmethod
+    def supported(conv):
+        return isinstance(conv, nn.ConvTranspose2d) and conv.kernel_size == (4, 4) and \
+            conv.stride == (2, 2) and conv.padding == (1, 1) and conv.dilation == (1, 1) and \
+            conv.output_padding == (0, 0) and conv.groups == 1
+
+    def forward(self, x):
+        N, C, H, W = x.size()
+        phases = self.conv(x).view(N, self.out_channels, 4, H + 1, W + 1)
+
+        # keep channels_last input channels_last
+        memory_format = torch.channels_last \
+            if x.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+        output = torch.empty((N, self.out_channels, 2 * H, 2 * W), dtype=phases.dtype,
+                             device=phases.device, memory_format=memory_format)
+        output[:, :, 0::2, 0::2] = phases[:, :, 0, 0:H, 0:W]
+        output[:, :, 0::2, 1::2] = phases[:, :, 1, 0:H, 1:]
+        output[:, :, 1::2, 0::2] = phases[:, :, 2, 1:, 0:W]
+        output[:, :, 1::2, 1::2] = phases[:, :, 3, 1:, 1:]
+
+        return output
+
+
+class QuantizedConv(nn.Module):
+    """Conv2d/ConvTranspose2d running in INT8 between quant and dequant stubs.
+
+    Inputs and outputs stay float, so GaussActivation and everything else
+    around the conv are not touched. See model_prepare_int8.
+    """
+
+    def __init__(self, conv):
+        super(QuantizedConv, self).__init__()
+
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+
+        self.quant = torch.ao.quantization.QuantStub()
+        self.conv = conv
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+class PrepackedConv2d(nn.Module):
+    """Conv2d with weights prepacked once by oneDNN, channels_last input, CPU inference only.
+
+    Float weights are not kept, see model_onednn.
+    """
+
+    def __init__(self, conv):
+        super(PrepackedConv2d, self).__init__()
+
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        self.transposed = False
+
+        weight = conv.weight.detach().contiguous(memory_format=torch.channels_last)
+        bias = None if conv.bias is None else conv.bias.detach()
+        # input size only guides algorithm choice, other sizes work too
+        self.context = torch.ops.mkldnn_prepacked.conv2d_prepack(
+            weight, bias, list(self.stride), list(self.padding), list(self.dilation),
+            self.groups, [1, self.in_channels, 256, 256], "none")
+
+    def forward(self, x):
+        return torch.ops.mkldnn_prepacked.conv2d_run(
+            x.contiguous(memory_format=torch.channels_last), self.context)
+
 
 class DiscriminatorDoubleColumn(nn.Module):
     def __init__(self, inputChannels):
@@ -539,13 +1203,21 @@ def gram_matrix(feat):
 
 
 class VGG16FeatureExtractor(nn.Module):
-    def __init__(self):
+    def __init__(self, weights='models/vgg16-397923af.pth'):
         super(VGG16FeatureExtractor, self).__init__()
-        vgg16 = models.vgg16(pretrained=False)
-        vgg16.load_state_dict(torch.load('models/vgg16-397923af.pth'))
-        self.enc_1 = nn.Sequential(*vgg16.features[:5])
-        self.enc_2 = nn.Sequential(*vgg16.features[5:10])
-        self.enc_3 = nn.Sequential(*vgg16.features[10:17])
+        # only features[:17] are used, classifier is neither built nor loaded
+        with torch.device('meta'):
+            features = models.vgg16().features[:17]
+        names = ['features.' + n for n in features.state_dict().keys()]
+        mapped = os.path.splitext(weights)[0] + WEIGHTS_SUFFIX
+        if os.path.exists(mapped):
+            state_dict = weights_load(mapped, names)
+        else:
+            state_dict = torch.load(weights, map_location='cpu')
+        features.load_state_dict({n[len('features.'):]: state_dict[n] for n in names}, assign=True)
+        self.enc_1 = nn.Sequential(*features[:5])
+        self.enc_2 = nn.Sequential(*features[5:10])
+        self.enc_3 = nn.Sequential(*features[10:17])
 
         # fix the encoder
         for i in range(3):
@@ -619,13 +1291,22 @@ class ImagePatchDiscriminator(nn.Module):
 
 
 def model_load(model, path):
-    """Load model."""
+    """Load model, .safetensors weights are mapped from file instead of copied."""
     if not os.path.exists(path):
         print("Model '{}' does not exist.".format(path))
         return
 
-    state_dict = torch.load(path, map_location=lambda storage, loc: storage)
     target_state_dict = model.state_dict()
+    if path.endswith(WEIGHTS_SUFFIX):
+        state_dict = weights_load(path, target_state_dict.keys())
+        for n in weights_names(path):
+            if n not in target_state_dict.keys():
+                raise KeyError(n)
+        # parameters become views of the mapped file, requires_grad is kept
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        return
+
+    state_dict = torch.load(path, map_location=lambda storage, loc: storage)
     for n, p in state_dict.items():
         if n in target_state_dict.keys():
             target_state_dict[n].copy_(p)
@@ -634,82 +1315,1123 @@ def model_load(model, path):
 
 
 def model_save(model, path):
-    """Save model."""
-    torch.save(model.state_dict(), path)
+    """Save model, .safetensors path saves mappable weights, see weights_save."""
+    if path.endswith(WEIGHTS_SUFFIX):
+        weights_save(model.state_dict(), path)
+    else:
+        torch.save(model.state_dict(), path)
+
+
+# Mappable weights file, safetensors layout: 8 bytes little-endian header size, JSON
+# header {name: {dtype, shape, data_offsets}}, tensor bytes. No safetensors package needed.
+WEIGHTS_SUFFIX = ".safetensors"
+
+WEIGHTS_DTYPES = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16,
+                  'BF16': torch.bfloat16, 'I64': torch.int64, 'I32': torch.int32,
+                  'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8, 'BOOL': torch.bool}
+
+
+def weights_header(path):
+    """Header dict and byte offset of tensor data."""
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size))
+    header.pop('__metadata__', None)
+    return header, 8 + size
+
+
+def weights_names(path):
+    """Tensor names of weights file, in file order."""
+    return list(weights_header(path)[0].keys())
+
+
+def weights_save(state_dict, path, metadata=None):
+    """Save tensors to weights file.
+
+    Larger elements come first and data starts 64 bytes aligned, so every tensor
+    is aligned to its element size when mapped.
+    """
+    names = {dtype: name for name, dtype in WEIGHTS_DTYPES.items()}
+    tensors = sorted(((n, t.detach().cpu().contiguous()) for n, t in state_dict.items()),
+                     key=lambda item: -item[1].element_size())
+    header, offset = {}, 0
+    for n, t in tensors:
+        nbytes = t.numel() * t.element_size()
+        header[n] = {'dtype': names[t.dtype], 'shape': list(t.shape),
+                     'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+    text = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # header may be padded with spaces
+    text += b' ' * (-(8 + len(text)) % 64)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(text)))
+        f.write(text)
+        for _, t in tensors:
+            f.write(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def weights_load(path, names=None):
+    """Tensors of weights file as views of the mapped file, only names when given.
+
+    Nothing is read until a tensor is used. The mapping is private, writes to the
+    tensors do not change the file.
+    """
+    header, start = weights_header(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    state_dict = collections.OrderedDict()
+    for n in (header.keys() if names is None else names):
+        if n not in header:
+            continue
+        info = header[n]
+        dtype = WEIGHTS_DTYPES[info['dtype']]
+        begin = start + info['data_offsets'][0]
+        element_size = torch.empty(0, dtype=dtype).element_size()
+        if begin % element_size != 0:
+            raise ValueError("Tensor '{}' in '{}' is not aligned".format(n, path))
+        tensor = torch.empty(0, dtype=dtype)
+        tensor.set_(storage, begin // element_size, info['shape'],
+                    torch.empty(info['shape'], device='meta').stride())
+        state_dict[n] = tensor
+    return state_dict
+
+
+def weights_mapped(tensor):
+    """True if tensor is a view of file mapped by weights_load.
+
+    The private file map looks shared to torch but has no handle to send to other processes.
+    """
+    storage = tensor.untyped_storage()
+    if tensor.device.type != 'cpu' or not storage.is_shared():
+        return False
+    try:
+        return storage._get_shared_fd() < 0
+    except RuntimeError:
+        # file_system sharing strategy has no fd to tell them apart
+        return False
+
+
+def weights_convert(pth_file, output_file, prefixes=None):
+    """Convert torch.save state dict file to weights file, keep only names with prefixes."""
+    state_dict = torch.load(pth_file, map_location='cpu')
+    if 'state_dict' in state_dict and isinstance(state_dict['state_dict'], dict):
+        state_dict = state_dict['state_dict']
+    if prefixes:
+        state_dict = {n: t for n, t in state_dict.items() if n.startswith(tuple(prefixes))}
+    weights_save(state_dict, output_file, {'source': os.path.basename(pth_file)})
+    return len(state_dict)
+
+
+# Seven stride-2 encoder stages, so H and W must be multiple of 2**7, tile_pad pads to it
+MODEL_ALIGN = ALIGN
+
+# TILE_OVERLAP (script.py) is one bottleneck cell. The receptive field (~636 px over
+# seven stride-2 encoders) is wider than any affordable overlap, so tiles only see part
+# of the context of full frame. Inside holes the difference stays below TILE_TOLERANCE,
+# benchmark.py parity checks it with several tiles.
+TILE_TOLERANCE = 1e-2
+
+# Measured peak of one fp32 inference_forward on CPU (~510), bytes per input pixel
+INFER_BYTES_PER_PIXEL = 600
+
+# Gradient checkpointing segments, see model_checkpoint
+CHECKPOINT_GRANULARITY = (None, 'forward', 'reverse', 'stage', 'half')
+
+# Activation compression layer types and modes, see ActivationCompressor
+COMPRESS_LAYERS = ('forward', 'mask', 'reverse', 'gauss')
+COMPRESS_MODES = ('bf16', 'int8')
+
+
+def model_tile_size(max_memory, batch_size=1, model=None):
+    """Largest tile size (multiple of MODEL_ALIGN) fits into max_memory bytes.
+
+    With model, tile peak comes from model_cost, otherwise from INFER_BYTES_PER_PIXEL.
+    """
+    pixels = max_memory / (batch_size * INFER_BYTES_PER_PIXEL)
+    size = max(MODEL_ALIGN, int(math.sqrt(pixels)) // MODEL_ALIGN * MODEL_ALIGN)
+    if model is None:
+        return size
+
+    dtype = model.autocast if getattr(model, 'autocast', None) is not None else torch.float32
+    # bytes per pixel of the cost model are close to the constant, search around it
+    size += MODEL_ALIGN
+    while size > MODEL_ALIGN and \
+            model_cost(model, batch_size, size, size, dtype)['peak_bytes'] > max_memory:
+        size -= MODEL_ALIGN
+    return size
+
+
+def tile_starts(length, tile_size, stride):
+    """Window start positions, the last window is aligned to the end."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def tile_weight(length, overlap):
+    """1D feather weight, linear ramp over the overlap area at both sides."""
+    ramp = torch.arange(1, length + 1, dtype=torch.float32)
+    ramp = torch.min(ramp, ramp.flip(0)) / (overlap + 1)
+    return ramp.clamp(max=1.0)
+
+
+def model_forward_tiled(model, images, masks, tile_size=512, tile_overlap=TILE_OVERLAP,
+                        max_memory=0):
+    """Inference with overlapped tiles, peak memory depends on tile size, not image size.
+
+    images: Nx4xHxW, masks: Nx3xHxW, both come from image_with_mask.
+    max_memory(bytes) > 0 overrides tile_size.
+    """
+    if max_memory > 0:
+        tile_size = model_tile_size(max_memory, images.size(0),
+                                    model if isinstance(model, ImagePatchModel) else None)
+    tile_size = max(MODEL_ALIGN, tile_size // MODEL_ALIGN * MODEL_ALIGN)
+    tile_overlap = min(tile_overlap, tile_size // 2)
+    stride = tile_size - tile_overlap
+
+    B, C, H, W = images.size()
+    output = torch.zeros(B, 3, H, W, device=images.device)
+    weight = torch.zeros(1, 1, H, W, device=images.device)
+
+    for y in tile_starts(H, tile_size, stride):
+        for x in tile_starts(W, tile_size, stride):
+            h = min(tile_size, H - y)
+            w = min(tile_size, W - x)
+            tile_images = images[:, :, y:y + h, x:x + w]
+            tile_masks = masks[:, :, y:y + h, x:x + w]
 
+            with torch.no_grad():
+                tile_output = model(tile_pad(tile_images), tile_pad(tile_masks))
+            tile_output = tile_output[:, :, 0:h, 0:w]
+
+            tile_w = tile_weight(h, tile_overlap).view(h, 1) * \
+                tile_weight(w, tile_overlap).view(1, w)
+            tile_w = tile_w.to(images.device)
+            output[:, :, y:y + h, x:x + w] += tile_output.float() * tile_w
+            weight[:, :, y:y + h, x:x + w] += tile_w
+
+            del tile_output
+
+    return output / weight
+
+
+def model_peak_memory(func, *args):
+    """Return func(*args) and peak bytes allocated by torch during the call."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+        result = func(*args)
+
+    # memory events: positive for allocation, negative for release
+    events = sorted((e.start_ns(), e.nbytes()) for e in prof.profiler.kineto_results.events()
+                    if e.name() == '[memory]')
+    current, peak = 0, 0
+    for _, nbytes in events:
+        current += nbytes
+        peak = max(peak, current)
+    return result, peak
+
+
+def model_fuse_conv(model):
+    """Run conv and maskConv of every ForwardAttentionLayer as one grouped conv."""
+    for m in model.modules():
+        if isinstance(m, ForwardAttentionLayer):
+            m.fuse()
+    return model
 
-def export_onnx_model():
-    """Export onnx model."""
 
-    import onnx
-    from onnx import optimizer
+def model_checkpoint(model, granularity=None):
+    """Enable gradient checkpointing for training.
+
+    granularity: 'forward' -- every ForwardAttention and ReverseMaskConv,
+                 'reverse' -- every ReverseAttention,
+                 'stage'   -- both of them,
+                 'half'    -- encoder and decoder as two segments,
+                 None      -- disable.
+    """
+    if granularity not in CHECKPOINT_GRANULARITY:
+        raise ValueError("Unknown checkpoint granularity '{}'".format(granularity))
+    model.checkpoint = granularity
+    return model
+
+
+def model_compress(model, config=None):
+    """Compress activations saved for backward, config like {'forward': 'bf16', 'gauss': 'int8'}."""
+    if model.compressor is not None:
+        model.compressor.remove()
+        model.compressor = None
+    if config:
+        model.compressor = ActivationCompressor(model, config)
+    return model
+
+
+def model_compile(model, cache_dir="output/compile_cache", bucket=MODEL_ALIGN, mode=None):
+    """Run forward (inference and training) through torch.compile.
+
+    Graphs are static per input shape, inference pads height and width up to a
+    multiple of bucket (0 disables padding). Padding to MODEL_ALIGN is what eager
+    mode needs anyway, so outputs match eager. Larger buckets compile fewer shapes
+    but add context the model sees, which changes outputs. Inductor and AOTAutograd
+    caches are kept in cache_dir, so later processes skip code generation for seen buckets.
+    """
+    import torch._functorch.config
+    import torch._inductor.config
+
+    if cache_dir:
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+
+    model.compileBucket = bucket
+    model.compiled = torch.compile(model.forward, dynamic=False, mode=mode)
+    return model
+
+
+def model_onednn(model):
+    """CPU inference backend: channels_last activations and oneDNN prepacked convs.
+
+    Decoder transposed convs become SubPixelConvTranspose2d first, so every conv
+    is prepacked. Parameters are frozen, load weights before calling this.
+    """
+    model.eval()
+    model_subpixel(model)
+
+    def prepack(conv):
+        return PrepackedConv2d(conv) if isinstance(conv, nn.Conv2d) else conv
+
+    for m in model.modules():
+        if isinstance(m, ForwardAttentionLayer):
+            m.conv, m.maskConv = prepack(m.conv), prepack(m.maskConv)
+        elif isinstance(m, ReverseMaskConv):
+            m.reverseMaskConv = prepack(m.reverseMaskConv)
+        elif isinstance(m, SubPixelConvTranspose2d):
+            m.conv = prepack(m.conv)
+
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model_channels_last(model)
+
+
+def model_channels_last(model):
+    """channels_last weights and activations, image_with_mask follows model.memoryFormat."""
+    model.memoryFormat = torch.channels_last
+    return model.to(memory_format=torch.channels_last)
+
+
+def model_freeze(model):
+    """Inference mode without side effects, so threads can share one weight copy.
+
+    GaussActivation parameters are clamped here once instead of in every forward
+    and no parameter needs gradients. Load weights and apply backends first.
+    """
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    for m in model.modules():
+        if isinstance(m, GaussActivation):
+            m.clamp_()
+            m.frozen = True
+    return model
+
+
+class ModelExecutor(object):
+    """Thread pool running concurrent inference requests on one frozen model.
+
+    Torch ops release the GIL, so requests overlap. Intra-op threads
+    (torch.set_num_threads) are shared by all workers.
+    """
+
+    def __init__(self, model, workers=2):
+        """Init executor, model must be frozen by model_freeze and have no Workspace."""
+        if isinstance(model, nn.Module):
+            if any(isinstance(m, GaussActivation) and not m.frozen for m in model.modules()):
+                raise ValueError("Model is not frozen, call model_freeze first")
+            if getattr(model, 'workspace', None) is not None:
+                raise ValueError("Workspace buffers can not be shared by threads")
+        self.model = model
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='ImagePatch')
+
+    def run(self, images, masks):
+        """One request on the calling thread, inputs come from image_with_mask."""
+        # grad mode is thread local
+        with torch.no_grad():
+            return self.model(images, masks)
+
+    def submit(self, images, masks):
+        """Queue one request, return its future."""
+        return self.pool.submit(self.run, images, masks)
+
+    def map(self, pairs):
+        """Outputs of (images, masks) pairs, in order."""
+        futures = [self.submit(images, masks) for images, masks in pairs]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait=True):
+        """Stop workers."""
+        self.pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+
+def model_core_sets(workers):
+    """Split cores of this process into workers contiguous sets, shared when too few."""
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < workers:
+        return [cores] * workers
+    return [cores[i * len(cores) // workers:(i + 1) * len(cores) // workers]
+            for i in range(workers)]
+
+
+def model_pool_worker(model, forward, tasks, results, threads, cores):
+    """Worker process of ModelProcessPool, model weights are mapped from parent."""
+    # Ctrl-C goes to the whole process group, parent stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    # tensor versions restart in this process, fused weights were made current by the pool
+    for m in model.modules():
+        if isinstance(m, ForwardAttentionLayer) and hasattr(m, 'fusedWeight'):
+            m.fusedVersion = m.weight_version()
+    results.put((None, os.getpid(), None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, images, masks = task
+        try:
+            with torch.no_grad():
+                output = model(images, masks) if forward is None else forward(model, images, masks)
+            results.put((index, output, None))
+        except Exception as e:
+            results.put((index, None, "{}: {}".format(type(e).__name__, e)))
+
+
+# Seconds ModelProcessPool waits for results before checking its workers are alive
+POOL_POLL = 0.5
+
+
+class ModelProcessPool(object):
+    """Worker processes running inference on one shared memory copy of weights.
+
+    Parameters and buffers are moved to shared memory once, spawned workers map
+    the same pages. Each worker runs threads intra-op threads, pinned to its core
+    set when pin is set. Requests go to whichever worker is idle.
+    forward(model, images, masks) runs in workers, it must be picklable,
+    like functools.partial(model_forward_tiled, tile_size=512).
+    A worker that dies (OOM, crash) breaks the pool like ProcessPoolExecutor, pending
+    futures fail with BrokenProcessPool and submit raises it.
+    """
+
+    def __init__(self, model, workers=2, threads=0, pin=False, forward=None):
+        """Init pool, model must be frozen by model_freeze, CPU only."""
+        if any(isinstance(m, GaussActivation) and not m.frozen for m in model.modules()):
+            raise ValueError("Model is not frozen, call model_freeze first")
+        if getattr(model, 'workspace', None) is not None or \
+                getattr(model, 'planCache', None) is not None:
+            raise ValueError("Workspace and plan cache can not be shared by processes")
+        if any(isinstance(m, (PrepackedConv2d, QuantizedConv)) for m in model.modules()):
+            raise ValueError("oneDNN prepacked and INT8 weights can not be shared by processes")
+        for m in model.modules():
+            if isinstance(m, ForwardAttentionLayer) and hasattr(m, 'fusedWeight') and \
+                    m.fusedVersion != m.weight_version():
+                m.fuse()
+        # weights mapped from .safetensors file are copied to shared memory once
+        for t in list(model.parameters()) + list(model.buffers()):
+            if weights_mapped(t):
+                t.data = t.data.clone()
+        model.share_memory()
+
+        cores = model_core_sets(workers)
+        context = torch.multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = []
+        self.closing = False
+        self.broken = None
+        for i in range(workers):
+            process = context.Process(
+                target=model_pool_worker, daemon=True,
+                args=(model, forward, self.tasks, self.results,
+                      threads if threads > 0 else len(cores[i]), cores[i] if pin else None))
+            process.start()
+            self.processes.append(process)
+        # wait until every worker has attached weights
+        try:
+            self.pids = [self.get()[1] for _ in range(workers)]
+        except BrokenProcessPool:
+            for process in self.processes:
+                process.terminate()
+            raise
+
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.count = 0
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def get(self):
+        """Next result, raise BrokenProcessPool when a worker exited before shutdown."""
+        while True:
+            try:
+                return self.results.get(timeout=POOL_POLL)
+            except queue.Empty:
+                # results of the dead worker that made it to the queue are read first
+                for process in self.processes:
+                    if process.exitcode is not None and not self.closing:
+                        raise BrokenProcessPool("Worker {} exited with code {}".format(
+                            process.pid, process.exitcode))
+
+    def collect(self):
+        while True:
+            try:
+                item = self.get()
+            except BrokenProcessPool as e:
+                # which requests the dead worker held is unknown, fail all pending
+                with self.lock:
+                    self.broken = e
+                    futures, self.futures = self.futures, {}
+                for future in futures.values():
+                    future.set_exception(BrokenProcessPool(*e.args))
+                break
+            if item is None:
+                break
+            index, output, error = item
+            with self.lock:
+                future = self.futures.pop(index)
+            if error is None:
+                future.set_result(output)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def submit(self, images, masks):
+        """Queue one request, return its future."""
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.broken is not None:
+                raise BrokenProcessPool(*self.broken.args)
+            index = self.count
+            self.count += 1
+            self.futures[index] = future
+        self.tasks.put((index, images, masks))
+        return future
+
+    def run(self, images, masks):
+        """One request, blocks until a worker returns it."""
+        return self.submit(images, masks).result()
+
+    __call__ = run
+
+    def map(self, pairs):
+        """Outputs of (images, masks) pairs, in order."""
+        futures = [self.submit(images, masks) for images, masks in pairs]
+        return [f.result() for f in futures]
+
+    def shutdown(self):
+        """Stop workers."""
+        self.closing = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+
+def model_prepare_int8(model):
+    """Wrap every conv of model with QuantizedConv and insert observers for calibration.
+
+    Apply model_subpixel first if wanted. Run calibration images through the model,
+    then call model_convert_int8.
+    """
+    qconfig = torch.ao.quantization.get_default_qconfig('x86')
+    # per-channel weight observer does not support transposed convs
+    qconfigTransposed = torch.ao.quantization.QConfig(
+        activation=qconfig.activation, weight=torch.ao.quantization.default_weight_observer)
+
+    def wrap(conv):
+        if isinstance(conv, SubPixelConvTranspose2d):
+            conv.conv = wrap(conv.conv)
+            return conv
+        quantized = QuantizedConv(conv)
+        quantized.qconfig = qconfigTransposed if conv.transposed else qconfig
+        return quantized
+
+    for m in model.modules():
+        if isinstance(m, ForwardAttentionLayer):
+            m.conv, m.maskConv = wrap(m.conv), wrap(m.maskConv)
+        elif isinstance(m, ReverseMaskConv):
+            m.reverseMaskConv = wrap(m.reverseMaskConv)
+        elif isinstance(m, ReverseAttention):
+            m.conv = wrap(m.conv)
+    model.dc7 = wrap(model.dc7)
+
+    torch.backends.quantized.engine = 'x86'
+    model.eval()
+    return torch.ao.quantization.prepare(model, inplace=True)
+
+
+def model_convert_int8(model):
+    """Replace observed convs with INT8 convs, see model_prepare_int8."""
+    return torch.ao.quantization.convert(model.eval(), inplace=True)
+
+
+def model_save_int8(model, path, subpixel=False):
+    """Save INT8 model, subpixel tells model_load_int8 how to rebuild the layers."""
+    torch.save({'format': 'int8', 'subpixel': subpixel,
+                'state_dict': model.state_dict()}, path)
+
+
+def model_load_int8(model, path):
+    """Load INT8 model saved by model_save_int8 into float model, CPU only."""
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if not isinstance(checkpoint, dict) or checkpoint.get('format') != 'int8':
+        raise ValueError("'{}' is not an INT8 model.".format(path))
+
+    if checkpoint['subpixel']:
+        model_subpixel(model)
+    # observers see no data here, scales come from the state dict
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model_prepare_int8(model)
+        model_convert_int8(model)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
+
+def model_subpixel(model):
+    """Replace decoder transposed convs with SubPixelConvTranspose2d, after loading weights."""
+    for i in range(1, 7):
+        dc = getattr(model, 'dc{:d}'.format(i))
+        if SubPixelConvTranspose2d.supported(dc.conv):
+            dc.conv = SubPixelConvTranspose2d(dc.conv)
+    if SubPixelConvTranspose2d.supported(model.dc7):
+        model.dc7 = SubPixelConvTranspose2d(model.dc7)
+    return model
+
 
-    onnx_file = "output/image_path.onnx"
-    weight_file = "output/ImagePatch.pth"
+def conv_flops(conv, height, width):
+    """FLOPs and output size of Conv2d/ConvTranspose2d for HxW input."""
+    if isinstance(conv, SubPixelConvTranspose2d):
+        flops, _, _ = conv_flops(conv.conv, height, width)
+        return flops, height * conv.stride[0], width * conv.stride[1]
+    if isinstance(conv, QuantizedConv):
+        return conv_flops(conv.conv, height, width)
+
+    kh, kw = conv.kernel_size
+    # float and quantized transposed convs both have transposed set
+    if conv.transposed:
+        oh = (height - 1) * conv.stride[0] - 2 * conv.padding[0] + \
+            conv.dilation[0] * (kh - 1) + conv.output_padding[0] + 1
+        ow = (width - 1) * conv.stride[1] - 2 * conv.padding[1] + \
+            conv.dilation[1] * (kw - 1) + conv.output_padding[1] + 1
+        macs = height * width * conv.in_channels * \
+            (conv.out_channels // conv.groups) * kh * kw
+    else:
+        oh = (height + 2 * conv.padding[0] -
+              conv.dilation[0] * (kh - 1) - 1) // conv.stride[0] + 1
+        ow = (width + 2 * conv.padding[1] -
+              conv.dilation[1] * (kw - 1) - 1) // conv.stride[1] + 1
+        macs = oh * ow * conv.out_channels * \
+            (conv.in_channels // conv.groups) * kh * kw
+    return 2 * macs, oh, ow
+
+
+def model_flops(model, height, width):
+    """FLOPs of convolutions for one HxW image, derived from layer definitions."""
+    flops = 0
+    h, w = height, width
+    for i in range(1, 8):
+        layer = getattr(model, 'ec{:d}'.format(i)).conv
+        f, _, _ = conv_flops(layer.maskConv, h, w)
+        flops += f
+        f, h, w = conv_flops(layer.conv, h, w)
+        flops += f
+
+    rh, rw = height, width
+    for i in range(1, 7):
+        f, rh, rw = conv_flops(
+            getattr(model, 'reverseConv{:d}'.format(i)).reverseMaskConv, rh, rw)
+        flops += f
+
+    for i in range(1, 8):
+        conv = model.dc7 if i == 7 else getattr(model, 'dc{:d}'.format(i)).conv
+        f, h, w = conv_flops(conv, h, w)
+        flops += f
+
+    return flops
+
+
+def model_receptive_field(model):
+    """Receptive field (pixels) of one output pixel, derived from layer definitions."""
+    rf, jump = 1, 1
+    for i in range(1, 8):
+        conv = getattr(model, 'ec{:d}'.format(i)).conv.conv
+        rf += (conv.kernel_size[0] - 1) * jump
+        jump *= conv.stride[0]
+    for i in range(1, 8):
+        conv = model.dc7 if i == 7 else getattr(model, 'dc{:d}'.format(i)).conv
+        # every output pixel of transposed conv sees ceil(k/s) input pixels
+        taps = (conv.kernel_size[0] + conv.stride[0] - 1) // conv.stride[0]
+        rf += (taps - 1) * jump
+        jump //= conv.stride[0]
+    return rf
+
+
+def model_param_bytes(model, dtype=torch.float32):
+    """Weight bytes of convs and attention scalars, derived from layer definitions.
+
+    bf16 autocast keeps fp32 weights, torch.qint8 (model_prepare_int8) stores 1 byte per
+    conv weight plus fp32 scale and zero point per output channel.
+    """
+    nbytes = 0
+    for m in model.modules():
+        if isinstance(m, GaussActivation):
+            nbytes += 4 * 4
+        elif type(m).__name__ in ('Conv2d', 'ConvTranspose2d', 'PrepackedConv2d'):
+            # float, quantized and prepacked convs
+            kh, kw = m.kernel_size
+            weights = m.in_channels * m.out_channels // m.groups * kh * kw
+            if dtype == torch.qint8:
+                nbytes += weights + 8 * m.out_channels
+            else:
+                nbytes += 4 * weights
+    return nbytes
+
+
+def model_cost(model, batch_size, height, width, dtype=torch.float32, backend='default',
+               tile_size=0, tile_overlap=TILE_OVERLAP):
+    """Predicted cost of one no-grad forward, derived from layer definitions.
+
+    dtype is torch.float32, torch.bfloat16 (autocast) or torch.qint8 (INT8 convs),
+    backend 'default' or 'onednn' (same bytes, channels_last). tile_size > 0 predicts
+    model_forward_tiled. Returns dict with flops, param_bytes and peak_bytes, peak is
+    what torch allocates for activations, inputs and weights are not included.
+    It replays allocations of inference_forward, so keep both in sync.
+    """
+    if backend not in ('default', 'onednn'):
+        raise ValueError("Unknown backend '{}'".format(backend))
+    if dtype not in (torch.float32, torch.bfloat16, torch.qint8):
+        raise ValueError("Unknown dtype '{}'".format(dtype))
+
+    N = batch_size
+    H = (height + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+    W = (width + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+    param_bytes = model_param_bytes(model, dtype)
+
+    if tile_size > 0 and (H > tile_size or W > tile_size):
+        tile_size = max(MODEL_ALIGN, tile_size // MODEL_ALIGN * MODEL_ALIGN)
+        stride = tile_size - min(tile_overlap, tile_size // 2)
+        h, w = min(tile_size, H), min(tile_size, W)
+        tiles = len(tile_starts(H, tile_size, stride)) * len(tile_starts(W, tile_size, stride))
+        tile = model_cost(model, N, h, w, dtype, backend)
+        # output and weight accumulators, contiguous copies of tile inputs,
+        # then tile output, feather weight and weighted tile
+        accumulators = 4 * (N * 3 + 1) * height * width
+        peak = accumulators + max(tile['peak_bytes'] + 4 * N * 7 * h * w,
+                                  4 * N * 3 * h * w * 2 + 4 * h * w,
+                                  4 * N * 3 * height * width)
+        return {'flops': tiles * tile['flops'], 'param_bytes': param_bytes,
+                'peak_bytes': peak, 'tiles': tiles, 'tile_size': (h, w)}
+
+    act = 2 if dtype == torch.bfloat16 else 4
+    live = [0, 0]
+
+    def alloc(*sizes):
+        live[0] += sum(sizes)
+        live[1] = max(live[1], live[0])
+
+    def free(*sizes):
+        live[0] -= sum(sizes)
+
+    def conv(layer, channels, h, w, cast=False):
+        """Run layer on channels x h x w input, return output size (bytes, C, h, w)."""
+        C = layer.out_channels
+        _, oh, ow = conv_flops(layer, h, w)
+        output = N * C * oh * ow * act
+        temporaries = []
+        if dtype == torch.bfloat16:
+            inner = layer.conv if isinstance(layer, SubPixelConvTranspose2d) else layer
+            kh, kw = inner.kernel_size
+            # autocast casts weight (and fp32 input) for every call
+            temporaries.append(2 * inner.in_channels * inner.out_channels // inner.groups * kh * kw)
+            if cast:
+                temporaries.append(2 * N * channels * h * w)
+        if dtype == torch.qint8:
+            temporaries += [N * channels * h * w, N * C * oh * ow]
+        if isinstance(layer, SubPixelConvTranspose2d):
+            # 4 phases at input resolution (plus border), then interleaved output
+            temporaries.append(N * C * 4 * (h + 1) * (w + 1) * act)
+        alloc(*temporaries)
+        alloc(output)
+        free(*temporaries)
+        return output, C, oh, ow
+
+    def attention(size):
+        """Gauss activation and mask update of conv output, return (map, update) bytes."""
+        elements = size // act
+        if dtype == torch.bfloat16:
+            alloc(4 * elements)
+        # lowerThanMu, output, then torch.where temporaries and ~lowerThanMu
+        alloc(elements, 4 * elements)
+        alloc(4 * elements)
+        free(4 * elements)
+        alloc(elements)
+        free(elements, elements)
+        if dtype == torch.bfloat16:
+            free(4 * elements)
+        alloc(size)
+        return 4 * elements, size
+
+    h, w, channels = H, W, 4
+    features = 0
+    mu, maskChannels = 0, 3
+    revMu, revChannels = N * 3 * H * W * 4, 3
+    rh, rw = H, W
+    alloc(revMu)
+    buffers, reverseMaps = [], []
+    maskActiv = 0
+    for i in range(1, 8):
+        layer = getattr(model, 'ec{:d}'.format(i)).conv
+        C = layer.conv.out_channels
+        free(maskActiv)
+        _, oh, ow = conv_flops(layer.conv, h, w)
+        buffer = N * 2 * C * oh * ow * act if i < 7 else 0
+        alloc(buffer)
+
+        convFeatures, _, _, _ = conv(layer.conv, channels, h, w, cast=i == 1)
+        maskFeatures, _, _, _ = conv(layer.maskConv, maskChannels, h, w, cast=i == 1)
+        maskActiv, update = attention(maskFeatures)
+        free(maskFeatures)
+        if i == 7:
+            alloc(convFeatures)
+        alloc(convFeatures)
+        free(convFeatures, features, mu)
+        if i == 7:
+            free(convFeatures)
+        features, mu = convFeatures, update
+        h, w, channels, maskChannels = oh, ow, C, C
+        if i == 7:
+            break
+        buffers.append(buffer)
+
+        layer = getattr(model, 'reverseConv{:d}'.format(i)).reverseMaskConv
+        maskFeatures, C, rh2, rw2 = conv(layer, revChannels, rh, rw, cast=i == 1)
+        reverseMap, update = attention(maskFeatures)
+        free(maskFeatures, revMu)
+        reverseMaps.append(reverseMap)
+        revMu, revChannels, rh, rw = update, C, rh2, rw2
+    free(mu, revMu)
+
+    for i in range(1, 7):
+        layer = getattr(model, 'dc{:d}'.format(i)).conv
+        output, C, h, w = conv(layer, channels, h, w)
+        free(output, reverseMaps.pop(), features)
+        features, channels = buffers.pop(), 2 * C
+
+    output, _, _, _ = conv(model.dc7, channels, H // 2, W // 2)
+    free(features)
+    if dtype == torch.bfloat16:
+        alloc(4 * output // act)
+    alloc(4 * output // act)
+    free(output)
+    if dtype == torch.bfloat16:
+        free(4 * output // act)
+
+    return {'flops': N * model_flops(model, H, W), 'param_bytes': param_bytes,
+            'peak_bytes': live[1], 'tiles': 1, 'tile_size': (H, W)}
+
+
+def model_batch_size(model, height, width, max_memory, dtype=torch.float32, backend='default',
+                     limit=64):
+    """Largest batch size (at most limit) whose predicted peak fits into max_memory bytes, 0 if none."""
+    for batch_size in range(1, limit + 1):
+        if model_cost(model, batch_size, height, width, dtype, backend)['peak_bytes'] > max_memory:
+            return batch_size - 1
+    return limit
+
+
+def hole_boxes(hole, margin, cell=16):
+    """Boxes [y1, x1, y2, x2] of connected holes, expanded by margin and merged.
+
+    hole: HxW bool tensor, connectivity is found on a grid of cell x cell pixels.
+    """
+    H, W = hole.size()
+    grid = nn.functional.max_pool2d(
+        hole.float()[None, None], cell, ceil_mode=True)[0, 0] > 0
+    cells = set(map(tuple, grid.nonzero().tolist()))
+
+    boxes = []
+    while cells:
+        y1, x1 = y2, x2 = cells.pop()
+        stack = [(y1, x1)]
+        while stack:
+            cy, cx = stack.pop()
+            y1, x1, y2, x2 = min(y1, cy), min(x1, cx), max(y2, cy), max(x2, cx)
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    if (cy + dy, cx + dx) in cells:
+                        cells.remove((cy + dy, cx + dx))
+                        stack.append((cy + dy, cx + dx))
+        boxes.append([max(0, y1 * cell - margin), max(0, x1 * cell - margin),
+                      min(H, (y2 + 1) * cell + margin), min(W, (x2 + 1) * cell + margin)])
+
+    # Merge overlapped boxes, so every hole pixel belongs to one box
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def model_forward_holes(model, images, masks, margin=-1, batch_size=4):
+    """Inference only on crops around holes, then composite into the input.
+
+    images: Nx4xHxW, masks: Nx3xHxW, both come from image_with_mask.
+    margin < 0 means half of the model receptive field.
+    Return output and a report of FLOPs saved against full-frame inference.
+    """
+    B, C, H, W = images.size()
+    if margin < 0:
+        margin = model_receptive_field(model) // 2
+
+    crops = []
+    for b in range(B):
+        for box in hole_boxes(masks[b, 0] < 0.5, margin):
+            crops.append((b, box))
+
+    # All crops have same size, so they can run in batches
+    crop_h = crop_w = MODEL_ALIGN
+    for b, (y1, x1, y2, x2) in crops:
+        crop_h = max(crop_h, y2 - y1)
+        crop_w = max(crop_w, x2 - x1)
+    crop_h = (crop_h + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+    crop_w = (crop_w + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+
+    full_h = (H + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+    full_w = (W + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+    full_flops = B * model_flops(model, full_h, full_w)
+    crop_h, crop_w = min(crop_h, full_h), min(crop_w, full_w)
+    flops = len(crops) * model_flops(model, crop_h, crop_w)
+
+    output = images[:, 0:3].clone()
+    if flops >= full_flops:
+        # Crops cost more than the whole frame
+        tile_size = max(full_h, full_w)
+        predict = model_forward_tiled(model, images, masks, tile_size=tile_size)
+        output = output * masks + predict * (1 - masks)
+        flops = full_flops
+        crops = [(b, [0, 0, H, W]) for b in range(B)]
+    else:
+        for i in range(0, len(crops), batch_size):
+            batch = []
+            for b, (y1, x1, y2, x2) in crops[i:i + batch_size]:
+                # Center crop on the box, then shift it into the image
+                y = max(0, min((y1 + y2 - crop_h) // 2, H - crop_h))
+                x = max(0, min((x1 + x2 - crop_w) // 2, W - crop_w))
+                batch.append((b, y, x, y1, x1, y2, x2))
+            crop_images = torch.cat([tile_pad(images[b:b + 1, :, y:y + crop_h, x:x + crop_w], crop_h, crop_w)
+                                     for b, y, x, _, _, _, _ in batch])
+            crop_masks = torch.cat([tile_pad(masks[b:b + 1, :, y:y + crop_h, x:x + crop_w], crop_h, crop_w)
+                                    for b, y, x, _, _, _, _ in batch])
+            with torch.no_grad():
+                predicts = model(crop_images, crop_masks)
+
+            for predict, (b, y, x, y1, x1, y2, x2) in zip(predicts, batch):
+                predict = predict[:, y1 - y:y2 - y, x1 - x:x2 - x].float()
+                mask = masks[b, :, y1:y2, x1:x2]
+                output[b, :, y1:y2, x1:x2] = output[b, :, y1:y2, x1:x2] * mask + \
+                    predict * (1 - mask)
+
+    report = {'crops': len(crops), 'crop_size': (crop_h, crop_w),
+              'flops': flops, 'full_flops': full_flops,
+              'saved': 1.0 - flops / full_flops}
+    return output, report
+
+
+def export_onnx_model(weight_file="output/ImagePatch.pth", onnx_file="output/image_patch.onnx"):
+    """Export onnx model, inputs are image Nx4xHxW and mask Nx3xHxW from image_with_mask.
+
+    Batch, height and width are dynamic, height and width must be multiple of 128.
+    """
+
+    import onnx
 
     # 1. Load model
     print("Loading model ...")
-    model = get_model()
-    model_load(model, weight_file)
+    model = get_model(weight_file)
     model.eval()
 
     # 2. Model export
     print("Export model ...")
-    dummy_input = torch.randn(1, 3, 512, 512)
+    dummy_input = torch.randn(1, 4, 512, 512)
+    dummy_mask = (torch.rand(1, 3, 512, 512) > 0.5).float()
 
-    input_names = ["input"]
+    input_names = ["input", "mask"]
     output_names = ["output"]
     # variable lenght axes
-    dynamic_axes = {'input': {0: 'batch_size', 1: 'channel', 2: "height", 3: 'width'},
-                    'noise_level': {0: 'batch_size', 1: 'channel', 2: "height", 3: 'width'},
-                    'output': {0: 'batch_size', 1: 'channel', 2: "height", 3: 'width'}}
-    torch.onnx.export(model, dummy_input, onnx_file,
+    dynamic_axes = {'input': {0: 'batch_size', 2: "height", 3: 'width'},
+                    'mask': {0: 'batch_size', 2: "height", 3: 'width'},
+                    'output': {0: 'batch_size', 2: "height", 3: 'width'}}
+    # tracing takes the autograd path, custom autograd functions are inlined
+    torch.onnx.export(model, (dummy_input, dummy_mask), onnx_file,
                       input_names=input_names,
                       output_names=output_names,
-                      verbose=True,
-                      opset_version=11,
-                      keep_initializers_as_inputs=True,
+                      opset_version=17,
                       export_params=True,
-                      dynamic_axes=dynamic_axes)
+                      do_constant_folding=True,
+                      dynamic_axes=dynamic_axes,
+                      dynamo=False)
 
-    # 3. Optimize model
+    # 3. Check model
     print('Checking model ...')
-    model = onnx.load(onnx_file)
-    onnx.checker.check_model(model)
-
-    print("Optimizing model ...")
-    passes = ["extract_constant_to_initializer",
-              "eliminate_unused_initializer"]
-    optimized_model = optimizer.optimize(model, passes)
-    onnx.save(optimized_model, onnx_file)
+    onnx.checker.check_model(onnx_file)
 
     # 4. Visual model
-    # python -c "import netron; netron.start('image_clean.onnx')"
+    # python -c "import netron; netron.start('image_patch.onnx')"
+
+
+class OnnxModel(object):
+    """ONNX Runtime CPU session called like ImagePatchModel for inference."""
+
+    def __init__(self, onnx_file, threads=0):
+        """Create session, threads 0 means ONNX Runtime default."""
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_file, options, providers=['CPUExecutionProvider'])
+        self.memoryFormat = torch.contiguous_format
+
+    def __call__(self, inputImgs, masks):
+        output = self.session.run(None, {'input': inputImgs.float().contiguous().cpu().numpy(),
+                                         'mask': masks.float().contiguous().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def check_onnx_model(weight_file="output/ImagePatch.pth", onnx_file="output/image_patch.onnx",
+                     images="../testimgs/images/*.png", masks="../testimgs/masks/*.png", size=0):
+    """Check onnx model against pytorch on image/mask pairs, print max difference and latency."""
+    model = get_model(weight_file)
+    model.eval()
+    onnx_model = OnnxModel(onnx_file)
+
+    pairs = load_image_pairs(images, masks, size)
+    max_diff, torch_seconds, onnx_seconds = 0.0, 0.0, 0.0
+    with torch.no_grad():
+        # warm up
+        model(*pairs[0][1])
+        onnx_model(*pairs[0][1])
+        for _, (image, mask) in pairs:
+            start = time.time()
+            output = model(image, mask)
+            torch_seconds += time.time() - start
+
+            start = time.time()
+            onnx_output = onnx_model(image, mask)
+            onnx_seconds += time.time() - start
 
+            max_diff = max(max_diff, (output - onnx_output).abs().max().item())
 
-def export_torch_model():
-    """Export torch model."""
+    n = len(pairs)
+    print("Images: {}, max abs difference: {:.3e}".format(n, max_diff))
+    print("Latency pytorch: {:.3f}s, onnxruntime: {:.3f}s, speedup: {:.2f}x".format(
+        torch_seconds / n, onnx_seconds / n, torch_seconds / onnx_seconds))
+    return max_diff
 
-    script_file = "output/image_patch.pt"
-    weight_file = "output/ImagePatch.pth"
+
+class ImagePatchScript(nn.Module):
+    """ImagePatchModel with image_with_mask thresholding, for TorchScript export.
+
+    Inputs are image and mask Nx3xHxW as loaded, mask is 1 for holes.
+    """
+
+    def __init__(self, model):
+        super(ImagePatchScript, self).__init__()
+        self.model = model
+
+    def forward(self, image, mask):
+        images, masks = image_with_mask(image, mask.clone())
+        return self.model(images, masks)
+
+
+def export_torch_model(weight_file="output/ImagePatch.pth", script_file="output/image_patch.pt"):
+    """Export frozen torch script model, see ImagePatchScript for inputs.
+
+    Batch, height and width are dynamic, height and width must be multiple of 128.
+    """
 
     # 1. Load model
     print("Loading model ...")
-    model = get_model()
-    model_load(model, weight_file)
+    model = get_model(weight_file)
     model.eval()
 
     # 2. Model export
     print("Export model ...")
-    dummy_input = torch.randn(1, 3, 512, 512)
-    traced_script_module = torch.jit.trace(model, dummy_input)
+    dummy_input = torch.rand(1, 3, 512, 512)
+    dummy_mask = (torch.rand(1, 3, 512, 512) > 0.5).float()
+    with torch.no_grad():
+        traced_script_module = torch.jit.trace(
+            ImagePatchScript(model).eval(), (dummy_input, dummy_mask), check_trace=False)
+    # parameters become constants and get folded, oneDNN prepacked constants of
+    # torch.jit.optimize_for_inference can not be saved, so loader runs it
+    traced_script_module = torch.jit.freeze(traced_script_module)
     traced_script_module.save(script_file)
 
 
-def get_model():
-    """Create model."""
+def get_model(checkpoint=None, backend='default'):
+    """Create model, backend 'onednn' needs checkpoint since it freezes weights, see model_onednn.
+
+    .safetensors checkpoint skips random init, weights are mapped from file.
+    """
     model_setenv()
-    model = ImagePatchModel(4, 3)
+    if checkpoint is not None and checkpoint.endswith(WEIGHTS_SUFFIX) and \
+            os.path.exists(checkpoint):
+        # every tensor comes from file, no memory or time for random init
+        with torch.device('meta'):
+            model = ImagePatchModel(4, 3)
+        model_load(model, checkpoint)
+        missing = [n for n, t in model.state_dict().items() if t.is_meta]
+        if missing:
+            raise KeyError("'{}' misses {}".format(checkpoint, ", ".join(missing)))
+    else:
+        model = ImagePatchModel(4, 3)
+        if checkpoint is not None:
+            model_load(model, checkpoint)
+    if backend == 'onednn':
+        model_onednn(model)
+    elif backend != 'default':
+        raise ValueError("Unknown backend '{}'".format(backend))
     return model
 
 
@@ -754,7 +2476,7 @@ def train_epoch(loader, model, optimizer, model_d, device, tag=''):
             masks = masks.to(device)
 
             GT = images
-            new_images, new_masks = image_with_mask(images, masks)
+            new_images, new_masks = image_with_mask(images, masks, model.memoryFormat)
             fake_images = model(new_images, new_masks)
 
             G_loss = model_d(new_images[:, 0:3, :, :],
@@ -799,7 +2521,7 @@ def valid_epoch(loader, model, device, tag=''):
             masks = masks.to(device)
 
             # Predict results without calculating gradients
-            new_images, new_masks = image_with_mask(images, masks)
+            new_images, new_masks = image_with_mask(images, masks, model.memoryFormat)
             with torch.no_grad():
                 predicts = model(new_images, new_masks)
 
@@ -858,33 +2580,17 @@ def model_setenv():
     print("  ENABLE_APEX: ", os.environ["ENABLE_APEX"])
 
 
-def enable_amp(x):
-    """Init Automatic Mixed Precision(AMP)."""
-    if os.environ["ENABLE_APEX"] == "YES":
-        x = amp.initialize(x, opt_level="O1")
-
+def enable_amp(x, dtype=None):
+    """Init Automatic Mixed Precision(AMP).
 
-def infer_perform():
-    """Model infer performance ..."""
-
-    model = get_model()
-    device = model_device()
-
-    model.eval()
-    model = model.to(device)
-    enable_amp(model)
-
-    progress_bar = tqdm(total=100)
-    progress_bar.set_description("Test Inference Performance ...")
-
-    for i in range(100):
-        input = torch.randn(8, 3, 512, 512)
-        input = input.to(device)
-
-        with torch.no_grad():
-            output = model(input)
-
-        progress_bar.update(1)
+    dtype like torch.bfloat16 selects native autocast (CPU or GPU),
+    otherwise apex O1 is used when ENABLE_APEX is YES.
+    """
+    if dtype is not None:
+        x.autocast = dtype
+    elif os.environ["ENABLE_APEX"] == "YES":
+        from apex import amp
+        x = amp.initialize(x, opt_level="O1")
 
 
 if __name__ == '__main__':
@@ -895,5 +2601,4 @@ if __name__ == '__main__':
 
     export_torch_model()
     export_onnx_model()
-
-    infer_perform()
+    check_onnx_model()
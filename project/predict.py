@@ -10,68 +10,380 @@
 # ************************************************************************************/
 #
 import argparse
+import concurrent.futures
+import functools
 import glob
 import os
 import pdb
+import queue
+import threading
+import time
 
 import torch
-import torchvision.transforms as transforms
 from PIL import Image
 from tqdm import tqdm
 
-from data import image_with_mask
-from model import enable_amp, get_model, model_device, model_load
+from autotune import autotune_load, autotune_threads
+from profiler import StageProfiler
+from script import (ALIGN, TILE_OVERLAP, image_to_tensor, load_script_model, tensor_to_image,
+                    tile_pad)
+
+SAVE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+
+
+def mask_filename(filename):
+    """dataset/x/image/a.png -> dataset/x/mask/a.png"""
+    return os.path.dirname(os.path.dirname(filename)) + "/mask/" + os.path.basename(filename)
+
+
+def output_filename(filename, prefix, format='png'):
+    """dataset/x/image/a.png -> dataset/x/output/prefix_a.format"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.dirname(os.path.dirname(filename)) + "/output/" + prefix + name + "." + format
+
+
+def load_pair(filename):
+    """Decode image and its mask as 1x3xHxW tensors."""
+    image = image_to_tensor(Image.open(filename).convert("RGB"))
+    mask = image_to_tensor(Image.open(mask_filename(filename)).convert("RGB"))
+    return filename, image, mask
+
+
+def save_image(tensor, filename, format='png', compress_level=6, quality=90):
+    """Encode 3xHxW tensor, compress_level is for png, quality for jpg and webp."""
+    options = {'compress_level': compress_level} if format == 'png' else {'quality': quality}
+    tensor_to_image(tensor).save(filename, SAVE_FORMATS[format], **options)
+
+
+def predict_pipeline(filenames, forward, batch_size=4, decode_workers=2, write_workers=2,
+                     queue_size=16, save_input=True, save_options={}, inflight=1):
+    """Decode ahead, run batches bucketed by image size, encode outputs behind.
+
+    forward(images, masks) takes decoded Bx3xHxW images and masks, H and W are
+    multiple of ALIGN, and returns (new_images or None, outputs). Decode and write
+    queues are bounded by queue_size, so a slow stage blocks the others.
+    inflight > 1 runs that many batches at a time, for forward on a process pool.
+    """
+    decoded = queue.Queue(maxsize=queue_size)
+    writes = threading.BoundedSemaphore(queue_size)
+    running = threading.BoundedSemaphore(inflight)
+    decoder = concurrent.futures.ThreadPoolExecutor(decode_workers, thread_name_prefix='decode')
+    runner = concurrent.futures.ThreadPoolExecutor(inflight, thread_name_prefix='run')
+    writer = concurrent.futures.ThreadPoolExecutor(write_workers, thread_name_prefix='write')
+
+    def produce():
+        for filename in filenames:
+            decoded.put(decoder.submit(load_pair, filename))
+        decoded.put(None)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    def write(tensor, filename):
+        writes.acquire()
+        future = writer.submit(save_image, tensor, filename, **save_options)
+        future.add_done_callback(lambda f: writes.release())
+        return future
+
+    def run(batch):
+        H, W = batch[0][1].size(2), batch[0][1].size(3)
+        H, W = (H + ALIGN - 1) // ALIGN * ALIGN, (W + ALIGN - 1) // ALIGN * ALIGN
+        # padding is cropped below
+        images = torch.cat([tile_pad(image, H, W) for _, image, _ in batch])
+        masks = torch.cat([tile_pad(mask, H, W) for _, _, mask in batch])
+        with torch.no_grad():
+            new_images, outputs = forward(images, masks)
+        writes = []
+        for i, (filename, image, _) in enumerate(batch):
+            h, w = image.size(2), image.size(3)
+            if save_input and new_images is not None:
+                writes.append(write(new_images[i, 0:3, 0:h, 0:w],
+                                    output_filename(filename, "input_", save_options['format'])))
+            writes.append(write(outputs[i, :, 0:h, 0:w].clamp(0, 1.0),
+                                output_filename(filename, "output_", save_options['format'])))
+        return writes
+
+    def submit(batch):
+        running.acquire()
+        future = runner.submit(run, batch)
+        future.add_done_callback(lambda f: running.release())
+        future.add_done_callback(lambda f: progress_bar.update(len(batch)))
+        futures.append(future)
+
+    def check(futures):
+        """Surface errors early, return futures not done, done runs give their writes."""
+        pending = []
+        for f in futures:
+            if not f.done():
+                pending.append(f)
+            elif isinstance(f.result(), list):
+                pending.extend(f.result())
+        return pending
+
+    # images of one size bucket run together, so padding is at most ALIGN - 1
+    buckets, futures = {}, []
+    progress_bar = tqdm(total=len(filenames))
+    while True:
+        item = decoded.get()
+        if item is None:
+            break
+        filename, image, mask = item.result()
+        key = ((image.size(2) + ALIGN - 1) // ALIGN, (image.size(3) + ALIGN - 1) // ALIGN)
+        bucket = buckets.setdefault(key, [])
+        bucket.append((filename, image, mask))
+        if len(bucket) == batch_size:
+            submit(buckets.pop(key))
+        futures = check(futures)
+    for bucket in buckets.values():
+        submit(bucket)
+
+    while futures:
+        concurrent.futures.wait(futures)
+        futures = check(futures)
+    producer.join()
+    decoder.shutdown()
+    runner.shutdown()
+    writer.shutdown()
+
 
 if __name__ == "__main__":
     """Predict."""
 
+    # values from autotune.py on this host, {} if not tuned
+    tuned = autotune_load('inference')
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--checkpoint', type=str,
                         default="models/ImagePatch.pth", help="checkpint file")
     parser.add_argument(
         '--input', type=str, default="dataset/predict/image/*.png", help="input image")
+    parser.add_argument('--tile_size', type=int,
+                        default=tuned.get('tile_size', 1024), help="tile size, multiple of 128")
+    parser.add_argument('--tile_overlap', type=int,
+                        default=TILE_OVERLAP, help="tile overlap")
+    parser.add_argument('--max_memory', type=int, default=0,
+                        help="peak memory budget (MB), 0 means using tile size")
+    parser.add_argument('--holes', action="store_true",
+                        help="only run model on crops around holes")
+    parser.add_argument('--plan_cache', type=int, default=0,
+                        help="mask plan cache size (MB) for reused masks, 0 means disable")
+    parser.add_argument('--fuse_conv', action="store_true",
+                        help="run image and mask conv as one grouped conv")
+    parser.add_argument('--subpixel', action="store_true",
+                        help="run decoder transposed conv as conv + pixel shuffle")
+    parser.add_argument('--workspace', action="store_true",
+                        help="reuse inference buffers across images")
+    parser.add_argument('--backend', type=str, default="default", choices=["default", "onednn"],
+                        help="onednn: CPU channels_last with prepacked convs")
+    parser.add_argument('--layout', type=str, choices=["contiguous", "channels_last"],
+                        default="channels_last" if tuned.get('channels_last') else "contiguous",
+                        help="memory layout of default backend float model")
+    parser.add_argument('--script', type=str, default="",
+                        help="run frozen torch script model file on CPU instead of checkpoint")
+    parser.add_argument('--onnx', type=str, default="",
+                        help="run onnx model file with ONNX Runtime on CPU instead of checkpoint")
+    parser.add_argument('--int8', action="store_true",
+                        help="checkpoint is INT8 model from quantize.py, CPU only")
+    parser.add_argument('--bf16', action="store_true",
+                        help="bf16 autocast, attention maps and output stay fp32")
+    parser.add_argument('--compile', action="store_true",
+                        help="torch.compile model, compiled code is cached in output/compile_cache")
+    parser.add_argument('--compile_bucket', type=int, default=ALIGN,
+                        help="pad image size up to multiple of bucket, one compile per bucket, "
+                        "buckets larger than 128 compile less often but change outputs")
+    parser.add_argument('--profile', type=str, default="",
+                        help="profile stages, save chrome trace to this file and print summary")
+    parser.add_argument('--pipeline', action="store_true",
+                        help="decode ahead and encode behind in thread pools, run batches")
+    parser.add_argument('--batch_size', type=int, default=tuned.get('batch_size', 4),
+                        help="pipeline batch size, images are bucketed by size")
+    parser.add_argument('--decode_workers', type=int, default=2, help="pipeline decode threads")
+    parser.add_argument('--write_workers', type=int, default=2, help="pipeline encode threads")
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help="pipeline decoded images and pending writes bound")
+    parser.add_argument('--format', type=str, default="png", choices=sorted(SAVE_FORMATS),
+                        help="output image format")
+    parser.add_argument('--compress_level', type=int, default=6, help="png compression level, 0-9")
+    parser.add_argument('--quality', type=int, default=90, help="jpg and webp quality, 1-100")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="pipeline worker processes sharing one weight copy, 0 means none")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads per worker process, 0 means cores of its set")
+    parser.add_argument('--pin', action="store_true",
+                        help="pin worker processes to disjoint core sets")
     args = parser.parse_args()
 
-    model = get_model()
-    model_load(model, args.checkpoint)
-    device = model_device()
-    model.to(device)
-    model.eval()
+    autotune_threads(tuned)
+
+    if args.pipeline and args.profile:
+        parser.error("--pipeline does not work with --profile")
+
+    if args.processes > 0 and (not args.pipeline or args.script or args.onnx or args.int8
+                               or args.holes or args.compile or args.workspace
+                               or args.plan_cache > 0 or args.backend != "default"):
+        parser.error("--processes needs --pipeline, does not work with --script, --onnx, --int8, "
+                     "--holes, --compile, --workspace, --plan_cache or --backend")
+    save_options = {'format': args.format, 'compress_level': args.compress_level,
+                    'quality': args.quality}
+
+    if args.script:
+        # torch script model only needs torch, model classes are not imported
+        model = load_script_model(args.script)
+        device = torch.device('cpu')
+    else:
+        from data import image_with_mask
+        from model import (MaskPlanCache, ModelProcessPool, OnnxModel, Workspace, enable_amp,
+                           get_model, model_channels_last, model_device, model_forward_holes,
+                           model_forward_tiled, model_compile, model_freeze, model_fuse_conv,
+                           model_load_int8, model_subpixel)
+
+        if args.backend != "default" and (args.int8 or args.fuse_conv):
+            parser.error("--backend {} does not work with --int8 or --fuse_conv".format(args.backend))
+
+        if args.onnx and (args.holes or args.plan_cache > 0 or args.workspace or args.bf16):
+            parser.error("--onnx does not work with --holes, --plan_cache, --workspace or --bf16")
+
+        if args.compile and args.profile:
+            parser.error("--compile does not work with --profile")
+
+        if args.compile and (args.onnx or args.int8 or args.backend != "default" or args.workspace):
+            parser.error("--compile does not work with --onnx, --int8, --backend or --workspace")
+
+        if args.onnx:
+            model = OnnxModel(args.onnx)
+            device = torch.device('cpu')
+        elif args.int8:
+            # layers are rebuilt as saved, fuse_conv and subpixel do not apply
+            model = get_model()
+            model_load_int8(model, args.checkpoint)
+            device = torch.device('cpu')
+        elif args.backend == "onednn":
+            model = get_model(args.checkpoint, backend=args.backend)
+            device = torch.device('cpu')
+        else:
+            model = get_model(args.checkpoint)
+            if args.fuse_conv:
+                model_fuse_conv(model)
+            if args.subpixel:
+                model_subpixel(model)
+            device = model_device() if args.processes == 0 else torch.device('cpu')
 
-    enable_amp(model)
+        if not args.onnx:
+            model.to(device)
+            model.eval()
+            if args.layout == "channels_last" and not args.int8 and args.backend == "default":
+                model_channels_last(model)
 
-    totensor = transforms.ToTensor()
-    toimage = transforms.ToPILImage()
+            enable_amp(model, torch.bfloat16 if args.bf16 else None)
+            if args.compile:
+                model_compile(model, bucket=args.compile_bucket)
+
+            if args.plan_cache > 0:
+                model.planCache = MaskPlanCache(args.plan_cache * 1024 * 1024)
+            if args.workspace:
+                model.workspace = Workspace()
+
+            if args.processes > 0:
+                model_freeze(model)
+                pool = ModelProcessPool(model, args.processes, args.threads, args.pin,
+                                        functools.partial(model_forward_tiled,
+                                                          tile_size=args.tile_size,
+                                                          tile_overlap=args.tile_overlap,
+                                                          max_memory=args.max_memory * 1024 * 1024))
+
+    # disabled profiler adds no hooks, its stages are null contexts
+    profiler = StageProfiler(bool(args.profile)).attach(model)
 
     image_filenames = glob.glob(args.input)
-    progress_bar = tqdm(total=len(image_filenames))
+    count = len(image_filenames)
+    total_flops, total_full_flops = 0, 0
+    start_time = time.time()
+
+    if args.pipeline:
+        def forward(images, masks):
+            global total_flops, total_full_flops
+            if args.script:
+                return None, model(images, masks)
+            new_images, new_masks = image_with_mask(
+                images.to(device), masks.to(device), model.memoryFormat)
+            if args.holes:
+                outputs, report = model_forward_holes(model, new_images, new_masks)
+                total_flops += report['flops']
+                total_full_flops += report['full_flops']
+            elif args.processes > 0:
+                outputs = pool.run(new_images, new_masks)
+            else:
+                outputs = model_forward_tiled(model, new_images, new_masks,
+                                              tile_size=args.tile_size,
+                                              tile_overlap=args.tile_overlap,
+                                              max_memory=args.max_memory * 1024 * 1024)
+            return new_images, outputs
+
+        predict_pipeline(image_filenames, forward, args.batch_size, args.decode_workers,
+                         args.write_workers, args.queue_size, save_options=save_options,
+                         inflight=max(1, args.processes))
+        image_filenames = []
+        if args.processes > 0:
+            pool.shutdown()
 
+    progress_bar = tqdm(total=len(image_filenames), disable=args.pipeline)
     for index, filename in enumerate(image_filenames):
         progress_bar.update(1)
 
-        # image
-        image = Image.open(filename).convert("RGB")
-        input_tensor = totensor(image).unsqueeze(0).to(device)
+        with profiler, torch.no_grad():
+            with profiler.stage('load'):
+                # image
+                image = Image.open(filename).convert("RGB")
+                input_tensor = image_to_tensor(image).to(device)
 
-        # mask
-        mask_filename = os.path.dirname(os.path.dirname(filename)) \
-            + "/mask/" + os.path.basename(filename)
-        mask_image = Image.open(mask_filename).convert("RGB")
-        mask_tensor = totensor(mask_image).unsqueeze(0).to(device)
+                # mask
+                mask_image = Image.open(mask_filename(filename)).convert("RGB")
+                mask_tensor = image_to_tensor(mask_image).to(device)
 
-        new_input_tensor, new_mask_tensor = image_with_mask(
-            input_tensor, mask_tensor)
+            if args.script:
+                with profiler.stage('model'):
+                    # padding is cropped below
+                    h, w = input_tensor.size(2), input_tensor.size(3)
+                    output_tensor = model(tile_pad(input_tensor), tile_pad(mask_tensor))
+                with profiler.stage('save_output'):
+                    output_tensor = output_tensor[:, :, 0:h, 0:w].clamp(0, 1.0).squeeze()
+                    save_image(output_tensor, output_filename(
+                        filename, "output_", args.format), **save_options)
+                continue
 
-        # new input
-        output_filename = os.path.dirname(os.path.dirname(filename)) \
-            + "/output/input_" + os.path.basename(filename)
-        toimage(new_input_tensor.clamp(
-            0, 1.0).squeeze().cpu()).save(output_filename)
+            with profiler.stage('image_with_mask'):
+                new_input_tensor, new_mask_tensor = image_with_mask(
+                    input_tensor, mask_tensor, model.memoryFormat)
 
-        with torch.no_grad():
-            output_tensor = model(new_input_tensor, new_mask_tensor)
+            with profiler.stage('save_input'):
+                # new input
+                save_image(new_input_tensor[:, 0:3].squeeze(), output_filename(
+                    filename, "input_", args.format), **save_options)
+
+            with profiler.stage('model'):
+                if args.holes:
+                    output_tensor, report = model_forward_holes(
+                        model, new_input_tensor, new_mask_tensor)
+                    total_flops += report['flops']
+                    total_full_flops += report['full_flops']
+                else:
+                    output_tensor = model_forward_tiled(model, new_input_tensor, new_mask_tensor,
+                                                        tile_size=args.tile_size,
+                                                        tile_overlap=args.tile_overlap,
+                                                        max_memory=args.max_memory * 1024 * 1024)
+
+            with profiler.stage('save_output'):
+                output_tensor = output_tensor.clamp(0, 1.0).squeeze()
+                save_image(output_tensor, output_filename(
+                    filename, "output_", args.format), **save_options)
+
+    seconds = time.time() - start_time
+    print("{} images in {:.1f} s, {:.2f} images/s".format(count, seconds, count / max(seconds, 1e-9)))
+
+    if args.profile:
+        profiler.export_chrome_trace(args.profile)
+        print(profiler.summary())
+        print("Chrome trace saved to '{}'.".format(args.profile))
 
-        output_tensor = output_tensor.clamp(0, 1.0).squeeze()
-        output_filename = os.path.dirname(os.path.dirname(filename)) \
-            + "/output/output_" + os.path.basename(filename)
-        toimage(output_tensor.cpu()).save(output_filename)
+    if total_full_flops > 0:
+        print("GFLOPs: {:.2f}, full-frame: {:.2f}, saved: {:.2f}%".format(
+            total_flops / 1e9, total_full_flops / 1e9, 100.0 * (1.0 - total_flops / total_full_flops)))
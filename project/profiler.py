@@ -0,0 +1,209 @@
+"""Per-stage profiler, Chrome trace and summary table."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# profiler = StageProfiler(enabled)
+# profiler.attach(model)
+# with profiler:
+#     with profiler.stage('load'):
+#         ...
+#     output = model(images, masks)
+# print(profiler.summary())
+# profiler.export_chrome_trace("output/trace.json")
+#
+# Disabled profiler registers no hooks and stage() is a null context.
+
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+
+import torch
+
+STAGE_PREFIX = "stage:"
+
+
+def stage_flops(module, args):
+    """FLOPs of one stage call, derived from layer definitions and input size."""
+    from model import (ForwardAttention, ReverseAttention, ReverseMaskConv,
+                       conv_flops)
+
+    H, W = args[0].size(2), args[0].size(3)
+    if isinstance(module, ForwardAttention):
+        layer = module.conv
+        flops, _, _ = conv_flops(layer.conv, H, W)
+        # maskActiv from MaskPlan skips mask conv
+        if len(args) < 3 or args[2] is None:
+            flops += conv_flops(layer.maskConv, H, W)[0]
+        return args[0].size(0) * flops
+    if isinstance(module, ReverseMaskConv):
+        return args[0].size(0) * conv_flops(module.reverseMaskConv, H, W)[0]
+    if isinstance(module, ReverseAttention):
+        return args[0].size(0) * conv_flops(module.conv, H, W)[0]
+    return args[0].size(0) * conv_flops(module, H, W)[0]
+
+
+class StageProfiler(object):
+    """Wall time, FLOPs and allocated bytes of labeled stages.
+
+    Stages are torch.profiler user annotations, memory comes from its
+    allocation events, so only torch tensors are counted.
+    """
+
+    def __init__(self, enabled=True):
+        """Init profiler."""
+        self.enabled = enabled
+        self.handles = []
+        self.wrapped = []
+        self.stack = []
+        # name -> FLOPs of every call, in call order
+        self.flops = collections.defaultdict(list)
+        self.profile = None
+        self.records = []
+        self.memory = []
+
+    def attach(self, model):
+        """Label ec*, reverseConv*, dc* stages of ImagePatchModel, no-op when disabled."""
+        if not self.enabled or not isinstance(model, torch.nn.Module):
+            return self
+
+        from model import ReverseAttention
+
+        for name, module in model.named_children():
+            if not name.startswith(('ec', 'reverseConv', 'dc')):
+                continue
+            self.handles.append(module.register_forward_pre_hook(
+                lambda m, args, name=name: self.enter(name, stage_flops(m, args))))
+            self.handles.append(module.register_forward_hook(
+                lambda m, args, output: self.exit(), always_call=True))
+            if isinstance(module, ReverseAttention):
+                # inference_forward is called directly, not through hooks
+                self.wrap(name, module)
+        return self
+
+    def wrap(self, name, module):
+        function = module.inference_forward
+
+        def inference_forward(*args):
+            with self.stage(name, stage_flops(module, args)):
+                return function(*args)
+        module.inference_forward = inference_forward
+        self.wrapped.append(module)
+
+    def detach(self):
+        """Remove hooks."""
+        for handle in self.handles:
+            handle.remove()
+        for module in self.wrapped:
+            del module.inference_forward
+        self.handles, self.wrapped = [], []
+
+    def enter(self, name, flops=0):
+        if self.profile is None:
+            return
+        function = torch.autograd.profiler.record_function(STAGE_PREFIX + name)
+        function.__enter__()
+        self.stack.append(function)
+        self.flops[name].append(flops)
+
+    def exit(self):
+        if self.profile is None or not self.stack:
+            return
+        self.stack.pop().__exit__(None, None, None)
+
+    @contextlib.contextmanager
+    def stage(self, name, flops=0):
+        """Label a block as stage name."""
+        if self.profile is None:
+            yield
+            return
+        self.enter(name, flops)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def __enter__(self):
+        if self.enabled:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profile = torch.profiler.profile(activities=activities, profile_memory=True)
+            self.profile.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is None:
+            return False
+        profile, self.profile = self.profile, None
+        profile.__exit__(*exc)
+        self.collect(profile)
+        return False
+
+    def collect(self, profile):
+        """Stage records (name, start_ns, end_ns, flops, allocated bytes, thread)."""
+        events = list(profile.profiler.kineto_results.events())
+        # positive for allocation, negative for release
+        memory = sorted((e.start_ns(), e.nbytes()) for e in events if e.name() == '[memory]')
+        times = [t for t, _ in memory]
+        allocated = [0] + list(itertools.accumulate(max(n, 0) for _, n in memory))
+        self.memory.extend(memory)
+        stages = sorted((e.start_ns(), e.end_ns(), e.name()[len(STAGE_PREFIX):], e.start_thread_id())
+                        for e in events
+                        if e.is_user_annotation() and e.name().startswith(STAGE_PREFIX))
+
+        calls = collections.Counter()
+        for start, end, name, thread in stages:
+            flops = self.flops[name]
+            index = calls[name]
+            calls[name] += 1
+            first, last = bisect.bisect_left(times, start), bisect.bisect_right(times, end)
+            self.records.append({'name': name, 'start': start, 'end': end, 'thread': thread,
+                                 'flops': flops[index] if index < len(flops) else 0,
+                                 'allocated': allocated[last] - allocated[first]})
+        self.flops.clear()
+
+    def summary(self):
+        """Per-stage table, stages in order of first call."""
+        rows = collections.OrderedDict()
+        for r in self.records:
+            row = rows.setdefault(r['name'], [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += r['end'] - r['start']
+            row[2] += r['flops']
+            row[3] += r['allocated']
+
+        lines = ["{:<16} {:>6} {:>11} {:>10} {:>9} {:>9} {:>14}".format(
+            "stage", "calls", "total(ms)", "mean(ms)", "GFLOPs", "GFLOP/s", "allocated(MB)")]
+        for name, (calls, ns, flops, allocated) in rows.items():
+            lines.append("{:<16} {:>6d} {:>11.1f} {:>10.2f} {:>9.2f} {:>9.1f} {:>14.1f}".format(
+                name, calls, ns / 1e6, ns / 1e6 / calls, flops / 1e9,
+                flops / ns if ns > 0 else 0.0, allocated / 1e6))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Stages as complete events, torch allocated bytes as counter, for chrome://tracing or Perfetto."""
+        if not self.records:
+            return
+        origin = min(min(r['start'] for r in self.records),
+                     self.memory[0][0] if self.memory else self.records[0]['start'])
+        trace = []
+        for r in self.records:
+            trace.append({'name': r['name'], 'cat': 'stage', 'ph': 'X', 'pid': 0, 'tid': r['thread'],
+                          'ts': (r['start'] - origin) / 1e3, 'dur': (r['end'] - r['start']) / 1e3,
+                          'args': {'GFLOPs': r['flops'] / 1e9, 'allocated(MB)': r['allocated'] / 1e6}})
+        current = 0
+        for t, nbytes in self.memory:
+            current += nbytes
+            trace.append({'name': 'torch memory', 'ph': 'C', 'pid': 0,
+                          'ts': (t - origin) / 1e3, 'args': {'MB': current / 1e6}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
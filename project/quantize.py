@@ -0,0 +1,142 @@
+"""Model INT8 quantization."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from data import load_image_pairs
+from model import (ImagePatchModel, get_model, model_convert_int8,
+                   model_load, model_prepare_int8, model_save,
+                   model_save_int8, model_subpixel)
+
+
+def hole_psnr(output, target, hole):
+    """PSNR(dB) over hole pixels, hole is Nx1xHxW with 1 for hole."""
+    count = hole.sum() * output.size(1)
+    mse = ((output - target) ** 2 * hole).sum() / count.clamp(min=1)
+    return 10 * torch.log10(1.0 / mse.clamp(min=1e-10))
+
+
+def hole_ssim(output, target, hole, window_size=11):
+    """SSIM map (gaussian window, sigma 1.5) averaged over hole pixels."""
+    channel = output.size(1)
+    x = torch.arange(window_size, dtype=torch.float32) - window_size // 2
+    gauss = torch.exp(-x ** 2 / (2 * 1.5 ** 2))
+    gauss = gauss / gauss.sum()
+    window = (gauss[:, None] * gauss[None, :]).expand(
+        channel, 1, window_size, window_size).contiguous()
+
+    def blur(t):
+        return F.conv2d(t, window, padding=window_size // 2, groups=channel)
+
+    mu1, mu2 = blur(output), blur(target)
+    sigma1 = blur(output * output) - mu1 ** 2
+    sigma2 = blur(target * target) - mu2 ** 2
+    sigma12 = blur(output * target) - mu1 * mu2
+    C1, C2 = 0.01 ** 2, 0.03 ** 2
+    ssim = ((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / \
+        ((mu1 ** 2 + mu2 ** 2 + C1) * (sigma1 + sigma2 + C2))
+    return (ssim * hole).sum() / (hole.sum() * channel).clamp(min=1)
+
+
+def evaluate(model, pairs):
+    """Average seconds per image, hole PSNR, hole SSIM and outputs."""
+    seconds, psnr, ssim, outputs = 0.0, 0.0, 0.0, []
+    with torch.no_grad():
+        # warm up
+        model(*pairs[0][1])
+        for image, (new_image, new_mask) in pairs:
+            start = time.time()
+            output = model(new_image, new_mask)
+            seconds += time.time() - start
+
+            hole = (new_mask[:, 0:1] < 0.5).float()
+            psnr += hole_psnr(output, image, hole).item()
+            ssim += hole_ssim(output, image, hole).item()
+            outputs.append(output)
+    n = len(pairs)
+    return seconds / n, psnr / n, ssim / n, outputs
+
+
+if __name__ == "__main__":
+    """Quantize."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str,
+                        default="models/ImagePatch.pth", help="checkpoint file")
+    parser.add_argument('--images', type=str,
+                        default="../testimgs/images/*.png", help="calibration images")
+    parser.add_argument('--masks', type=str,
+                        default="../testimgs/masks/*.png", help="calibration masks, paired by sorted name")
+    parser.add_argument('--size', type=int, default=512,
+                        help="resize images to size x size, 0 means crop to multiple of 128")
+    parser.add_argument('--subpixel', action="store_true",
+                        help="quantize decoder as conv + pixel shuffle")
+    parser.add_argument('--output', type=str,
+                        default="output/ImagePatch_int8.pth", help="INT8 model file")
+    args = parser.parse_args()
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pairs = load_image_pairs(args.images, args.masks, args.size)
+
+    model = get_model()
+    model_load(model, args.checkpoint)
+    model.eval()
+
+    # float reference keeps its own copy of weights
+    reference = ImagePatchModel(4, 3)
+    reference.load_state_dict(model.state_dict())
+    reference.eval()
+
+    if args.subpixel:
+        model_subpixel(model)
+
+    print("Calibrating ...")
+    model_prepare_int8(model)
+    with torch.no_grad():
+        for _, (new_image, new_mask) in tqdm(pairs):
+            model(new_image, new_mask)
+    model_convert_int8(model)
+
+    model_save_int8(model, args.output, args.subpixel)
+    print("INT8 model saved to '{}'.".format(args.output))
+
+    print("Evaluating ...")
+    float_file = args.output + ".float"
+    model_save(reference, float_file)
+    float_size = os.path.getsize(float_file)
+    os.remove(float_file)
+    int8_size = os.path.getsize(args.output)
+
+    float_seconds, float_psnr, float_ssim, float_outputs = evaluate(reference, pairs)
+    int8_seconds, int8_psnr, int8_ssim, int8_outputs = evaluate(model, pairs)
+
+    agree_psnr = 0.0
+    for (_, (_, new_mask)), a, b in zip(pairs, float_outputs, int8_outputs):
+        hole = (new_mask[:, 0:1] < 0.5).float()
+        agree_psnr += hole_psnr(b, a, hole).item() / len(pairs)
+
+    print("{:<6} {:>12} {:>10} {:>14} {:>10}".format(
+        "", "latency(s)", "size(MB)", "hole PSNR(dB)", "hole SSIM"))
+    print("{:<6} {:>12.3f} {:>10.1f} {:>14.3f} {:>10.4f}".format(
+        "fp32", float_seconds, float_size / 1e6, float_psnr, float_ssim))
+    print("{:<6} {:>12.3f} {:>10.1f} {:>14.3f} {:>10.4f}".format(
+        "int8", int8_seconds, int8_size / 1e6, int8_psnr, int8_ssim))
+    print("int8 vs fp32 hole PSNR: {:.3f} dB, speedup: {:.2f}x".format(
+        agree_psnr, float_seconds / int8_seconds))
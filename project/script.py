@@ -0,0 +1,61 @@
+"""Torch script model runtime, only needs torch, numpy and PIL."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# Models come from model.export_torch_model, inputs are image and mask Nx3xHxW as loaded,
+# mask thresholding of image_with_mask is in the model.
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Seven stride-2 encoder stages, so H and W must be multiple of 2**7, model.MODEL_ALIGN
+ALIGN = 128
+
+# Overlap of neighbour tiles, one bottleneck cell, see model.TILE_TOLERANCE
+TILE_OVERLAP = ALIGN
+
+
+def load_script_model(script_file):
+    """Load frozen torch script model for CPU inference."""
+    model = torch.jit.load(script_file, map_location='cpu')
+    model.eval()
+    # prepacked weights can not be saved with the model, so do it here
+    return torch.jit.optimize_for_inference(model)
+
+
+def tile_pad(tensor, height=0, width=0):
+    """Replicate pad NxCxHxW to (height, width), at least to multiple of ALIGN."""
+    H, W = tensor.size(2), tensor.size(3)
+    height = max(height, (H + ALIGN - 1) // ALIGN * ALIGN)
+    width = max(width, (W + ALIGN - 1) // ALIGN * ALIGN)
+    if height == H and width == W:
+        return tensor
+    # replicate keeps hole borders unchanged
+    return torch.nn.functional.pad(tensor, (0, width - W, 0, height - H), mode='replicate')
+
+
+def image_to_tensor(image):
+    """PIL image to 1x3xHxW float tensor in [0, 1], like ToTensor."""
+    array = np.asarray(image.convert("RGB"), dtype=np.float32) / 255.0
+    return torch.from_numpy(array).permute(2, 0, 1).unsqueeze(0).contiguous()
+
+
+def tensor_to_image(tensor):
+    """3xHxW tensor in [0, 1] to PIL image, like ToPILImage."""
+    array = tensor.clamp(0, 1.0).mul(255).byte().permute(1, 2, 0).cpu().numpy()
+    return Image.fromarray(array)
+
+
+def PSNR(img1, img2):
+    """PSNR, same as model.PSNR."""
+    difference = (1.*img1-img2)**2
+    mse = torch.sqrt(torch.mean(difference)) + 0.000001
+    return 20*torch.log10(1./mse)
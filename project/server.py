@@ -0,0 +1,526 @@
+"""Model inference server, dynamic batching over HTTP on localhost or Unix socket."""
+# coding=utf-8
+#
+# /************************************************************************************
+# ***
+# ***    Copyright Dell 2020, All Rights Reserved.
+# ***
+# ***    File Author: Dell, 2020年 11月 02日 星期一 17:49:55 CST
+# ***
+# ************************************************************************************/
+#
+# python server.py --checkpoint models/ImagePatch.pth --port 8080
+# python server.py --checkpoint models/ImagePatch.pth --unix output/server.sock
+#
+# POST /predict  {"image": base64, "mask": base64, "crop_size": 1024, "deadline_ms": 0,
+#                 "checkpoint": ""}
+#     -> {"output": base64 png, "orig": base64 png, "batch_size": n, "queue_ms": t, "infer_ms": t}
+# GET /stats     queue depth, batch sizes, responses and latency histograms
+#
+# Requests are grouped by size rounded up to MODEL_ALIGN, a group runs as one batch when
+# it is full or its oldest request waited max_delay. Too many pending requests answer 503,
+# expired deadline 504. client.py takes test.py arguments.
+
+import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import functools
+import io
+import json
+import os
+import signal
+
+import torch
+import torchvision.transforms as T
+import torchvision.utils as utils
+from PIL import Image
+
+from autotune import autotune_load, autotune_threads
+from data import image_with_mask
+from model import (MODEL_ALIGN, TILE_OVERLAP, ImagePatchModel, ModelExecutor, ModelProcessPool,
+                   enable_amp, get_model, model_batch_size, model_channels_last, model_device,
+                   model_forward_tiled, model_freeze, tile_pad)
+
+# Histogram bucket upper bounds (ms), the last bucket is unbounded
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class ServerError(Exception):
+    """Request error answered with HTTP status."""
+
+    def __init__(self, status, message):
+        super(ServerError, self).__init__(message)
+        self.status = status
+
+
+class LatencyHistogram(object):
+    """Bucket counts since start, percentiles over recent samples."""
+
+    def __init__(self, samples=4096):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=samples)
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.recent.append(ms)
+
+    def stats(self):
+        recent = sorted(self.recent)
+
+        def percentile(q):
+            return recent[min(len(recent) - 1, int(q * len(recent)))] if recent else 0.0
+
+        return {'count': self.count, 'mean': self.total / max(self.count, 1),
+                'p50': percentile(0.50), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                'buckets': [{'le': le, 'count': count}
+                            for le, count in zip(LATENCY_BUCKETS + ['inf'], self.counts)]}
+
+
+class PredictRequest(object):
+    """One image and mask, 1x3xHxW as decoded, waiting for a batch."""
+
+    def __init__(self, image, mask, arrival, deadline, future):
+        self.image = image
+        self.mask = mask
+        H, W = image.size(2), image.size(3)
+        # size group
+        self.key = ((H + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN,
+                    (W + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN)
+        # event loop time, deadline None means no deadline
+        self.arrival = arrival
+        self.deadline = deadline
+        self.future = future
+        self.batch_size = 0
+        self.queue_ms = 0.0
+        self.infer_ms = 0.0
+
+
+class DynamicBatcher(object):
+    """Coalesce queued requests of one size group into batches.
+
+    infer(requests) is blocking and runs in pool, at most workers batches at a time.
+    While all workers are busy requests keep queueing, so batches grow with load.
+    limit(key) is the batch size limit of a size group.
+    """
+
+    def __init__(self, infer, pool, limit, max_delay=0.01, workers=1):
+        self.infer = infer
+        self.pool = pool
+        self.limit = limit
+        self.max_delay = max_delay
+        self.slots = asyncio.Semaphore(workers)
+        self.wakeup = asyncio.Event()
+        # key -> requests in arrival order
+        self.groups = collections.OrderedDict()
+        self.depth = 0
+        self.running = 0
+        # requests dropped from queue at their deadline, never run
+        self.expired = 0
+        self.tasks = set()
+        self.batch_sizes = collections.Counter()
+        self.queue_latency = LatencyHistogram()
+        self.infer_latency = LatencyHistogram()
+
+    async def submit(self, request):
+        """Queue request, return its output or raise ServerError(504) at deadline."""
+        loop = asyncio.get_running_loop()
+        timeout = None if request.deadline is None else request.deadline - loop.time()
+        if timeout is not None and timeout <= 0:
+            # decode took the whole deadline, do not queue
+            self.expired += 1
+            raise ServerError(504, "deadline exceeded")
+        self.groups.setdefault(request.key, []).append(request)
+        self.depth += 1
+        self.wakeup.set()
+
+        try:
+            # shield keeps the future of a running batch alive
+            return await asyncio.wait_for(asyncio.shield(request.future), timeout)
+        except asyncio.TimeoutError:
+            self.cancel(request)
+            raise ServerError(504, "deadline exceeded")
+
+    def cancel(self, request):
+        """Drop request if it still waits in queue."""
+        group = self.groups.get(request.key)
+        if group is not None and request in group:
+            group.remove(request)
+            self.depth -= 1
+            self.expired += 1
+            if not group:
+                del self.groups[request.key]
+
+    def take(self, key, now):
+        """Next batch of group, requests past deadline are failed with 504 and skipped."""
+        group = self.groups[key]
+        for request in [r for r in group if r.deadline is not None and r.deadline <= now]:
+            group.remove(request)
+            self.depth -= 1
+            self.expired += 1
+            if not request.future.done():
+                request.future.set_exception(ServerError(504, "deadline exceeded"))
+        batch, group[:] = group[:self.limit(key)], group[self.limit(key):]
+        if not group:
+            del self.groups[key]
+        if not batch:
+            return None
+        self.depth -= len(batch)
+        for request in batch:
+            request.batch_size = len(batch)
+            request.queue_ms = (now - request.arrival) * 1000
+            self.queue_latency.add(request.queue_ms)
+        self.batch_sizes[len(batch)] += 1
+        return batch
+
+    async def next_batch(self):
+        """Wait for a full group or a group whose oldest request waited max_delay."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now, wake = loop.time(), None
+            # oldest group first
+            for key, group in sorted(self.groups.items(), key=lambda item: item[1][0].arrival):
+                if len(group) >= self.limit(key) or now - group[0].arrival >= self.max_delay:
+                    batch = self.take(key, now)
+                    if batch:
+                        return batch
+                    continue
+                ready = group[0].arrival + self.max_delay
+                wake = ready if wake is None else min(wake, ready)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), None if wake is None else wake - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """Dispatch batches until cancelled."""
+        while True:
+            await self.slots.acquire()
+            batch = await self.next_batch()
+            self.running += 1
+            task = asyncio.ensure_future(self.execute(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, batch):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            outputs = await asyncio.wrap_future(self.pool.submit(self.infer, batch))
+            infer_ms = (loop.time() - start) * 1000
+            self.infer_latency.add(infer_ms)
+            for request, output in zip(batch, outputs):
+                request.infer_ms = infer_ms
+                if not request.future.done():
+                    request.future.set_result(output)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+
+class InferenceServer(object):
+    """Keep one frozen model warm and answer HTTP requests with batched inference.
+
+    Requests are admitted while fewer than max_pending are being decoded, queued,
+    run or encoded, later ones are answered 503 without decoding.
+    With pool (ModelProcessPool), batches run in its worker processes, workers
+    should be its size.
+    """
+
+    def __init__(self, model, device, checkpoint="", max_batch=4, max_delay=0.01,
+                 max_pending=32, deadline=0.0, workers=1, io_workers=2, max_memory=0,
+                 tile_size=1024, tile_overlap=TILE_OVERLAP, max_body=256 * 1024 * 1024,
+                 pool=None):
+        """Init server, model must be frozen by model_freeze."""
+        self.model = model
+        self.device = device
+        self.checkpoint = os.path.realpath(checkpoint) if checkpoint else ""
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.workers = workers
+        self.max_memory = max_memory
+        self.max_body = max_body
+        self.executor = ModelExecutor(model, workers)
+        # pool workers run the same forward
+        self.forward = pool if pool is not None else functools.partial(
+            model_forward_tiled, model, tile_size=tile_size, tile_overlap=tile_overlap,
+            max_memory=max_memory)
+        self.io = concurrent.futures.ThreadPoolExecutor(io_workers, thread_name_prefix='io')
+        self.limits = {}
+        self.batcher = None
+        self.pending = 0
+        self.responses = collections.Counter()
+        self.total_latency = LatencyHistogram()
+
+    def batch_limit(self, key):
+        """max_batch, lowered so predicted peak of one batch fits into max_memory."""
+        if key not in self.limits:
+            limit = self.max_batch
+            if self.max_memory > 0 and isinstance(self.model, ImagePatchModel):
+                dtype = self.model.autocast if self.model.autocast is not None else torch.float32
+                backend = 'onednn' if self.model.memoryFormat == torch.channels_last else 'default'
+                # 0 means even one image does not fit, it is tiled in infer
+                limit = max(1, model_batch_size(self.model, key[0], key[1], self.max_memory,
+                                                dtype, backend, limit))
+            self.limits[key] = limit
+        return self.limits[key]
+
+    def decode(self, body):
+        """Request body to image, mask and deadline (ms), resized like test.py."""
+        try:
+            request = json.loads(body)
+            image = Image.open(io.BytesIO(base64.b64decode(request['image']))).convert('RGB')
+            mask = Image.open(io.BytesIO(base64.b64decode(request['mask']))).convert('RGB')
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            raise ServerError(400, "bad request: {}".format(e))
+        checkpoint = request.get('checkpoint', '')
+        if checkpoint and self.checkpoint and os.path.realpath(checkpoint) != self.checkpoint:
+            raise ServerError(400, "server runs checkpoint '{}'".format(self.checkpoint))
+
+        transforms = [T.ToTensor()]
+        if request.get('crop_size', 0) > 0:
+            transforms.insert(0, T.Resize(size=request['crop_size'],
+                                          interpolation=T.InterpolationMode.NEAREST))
+        transform = T.Compose(transforms)
+        return transform(image).unsqueeze(0), transform(mask).unsqueeze(0), \
+            request.get('deadline_ms', 0)
+
+    def infer(self, batch):
+        """Run one size group batch, return (output, orig) 1x3xHxW per request."""
+        H, W = batch[0].key
+        images = torch.cat([tile_pad(r.image, H, W) for r in batch]).to(self.device)
+        masks = torch.cat([tile_pad(r.mask, H, W) for r in batch]).to(self.device)
+        new_images, new_masks = image_with_mask(images, masks, self.model.memoryFormat)
+        outputs = self.forward(new_images, new_masks)
+        results = []
+        for i, r in enumerate(batch):
+            h, w = r.image.size(2), r.image.size(3)
+            orig = new_images[i:i + 1, 0:3, 0:h, 0:w] * new_masks[i:i + 1, :, 0:h, 0:w]
+            results.append((outputs[i:i + 1, :, 0:h, 0:w].float().cpu(), orig.float().cpu()))
+        return results
+
+    @staticmethod
+    def encode(tensor):
+        """1x3xHxW to base64 png, rounding as torchvision save_image in test.py."""
+        buffer = io.BytesIO()
+        utils.save_image(tensor, buffer, format='png')
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    async def predict(self, body, arrival):
+        loop = asyncio.get_running_loop()
+        image, mask, deadline_ms = await loop.run_in_executor(self.io, self.decode, body)
+        deadline_ms = deadline_ms if deadline_ms > 0 else self.deadline * 1000
+        deadline = arrival + deadline_ms / 1000 if deadline_ms > 0 else None
+
+        request = PredictRequest(image, mask, arrival, deadline, loop.create_future())
+        output, orig = await self.batcher.submit(request)
+        output, orig = await asyncio.gather(loop.run_in_executor(self.io, self.encode, output),
+                                            loop.run_in_executor(self.io, self.encode, orig))
+        self.total_latency.add((loop.time() - arrival) * 1000)
+        return {'output': output, 'orig': orig, 'batch_size': request.batch_size,
+                'queue_ms': request.queue_ms, 'infer_ms': request.infer_ms}
+
+    def stats(self):
+        return {'pending': self.pending, 'queue_depth': self.batcher.depth,
+                'running_batches': self.batcher.running, 'expired': self.batcher.expired,
+                'groups': {"{}x{}".format(*key): len(group)
+                           for key, group in self.batcher.groups.items()},
+                'responses': {str(k): v for k, v in sorted(self.responses.items())},
+                'batch_sizes': {str(k): v for k, v in sorted(self.batcher.batch_sizes.items())},
+                'latency_ms': {'queue': self.batcher.queue_latency.stats(),
+                               'infer': self.batcher.infer_latency.stats(),
+                               'total': self.total_latency.stats()}}
+
+    async def route(self, method, path, body, arrival):
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': "no route {} {}".format(method, path)}
+        self.pending += 1
+        try:
+            return 200, await self.predict(body, arrival)
+        except ServerError as e:
+            return e.status, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': "{}: {}".format(type(e).__name__, e)}
+        finally:
+            self.pending -= 1
+
+    async def respond(self, writer, status, payload, close=False, headers={}):
+        self.responses[status] += 1
+        body = json.dumps(payload).encode('utf-8')
+        lines = ["HTTP/1.1 {} {}".format(status, HTTP_REASONS[status]),
+                 "Content-Type: application/json",
+                 "Content-Length: {}".format(len(body)),
+                 "Connection: {}".format('close' if close else 'keep-alive')]
+        lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """HTTP/1.1 connection, requests with Content-Length body, keep-alive."""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                arrival = loop.time()
+                parts = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, {'error': "bad request line"}, close=True)
+                    break
+                method, path, version = parts[0], parts[1].partition('?')[0], parts[2]
+                length = int(headers.get('content-length', '0') or 0)
+                if length > self.max_body:
+                    await self.respond(writer, 413, {'error': "body over {} bytes".format(
+                        self.max_body)}, close=True)
+                    break
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '') != 'close'
+
+                if method == 'POST' and path == '/predict' and self.pending >= self.max_pending:
+                    # backpressure, body is skipped, not decoded
+                    while length > 0:
+                        length -= len(await reader.readexactly(min(length, 1024 * 1024)))
+                    await self.respond(writer, 503, {'error': "server busy"},
+                                       close=not keep_alive, headers={'Retry-After': 1})
+                else:
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status, payload = await self.route(method, path, body, arrival)
+                    await self.respond(writer, status, payload, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, unix="", warmup=0):
+        """Serve until SIGINT or SIGTERM, unix socket path overrides host and port."""
+        loop = asyncio.get_running_loop()
+        self.batcher = DynamicBatcher(self.infer, self.executor.pool, self.batch_limit,
+                                      self.max_delay, self.workers)
+        if warmup > 0:
+            # first call allocates buffers and picks kernels
+            image = torch.zeros(1, 3, warmup, warmup)
+            await loop.run_in_executor(self.executor.pool, self.infer, [
+                PredictRequest(image, image, 0, None, None)])
+
+        if unix:
+            if os.path.exists(unix):
+                os.remove(unix)
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+            print("Serving on unix:{}".format(unix))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("Serving on http://{}:{}".format(host, port))
+
+        stop = asyncio.Event()
+        for s in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(s, stop.set)
+        batcher = asyncio.ensure_future(self.batcher.run())
+        async with server:
+            await stop.wait()
+        batcher.cancel()
+        self.executor.shutdown()
+        self.io.shutdown()
+        if unix and os.path.exists(unix):
+            os.remove(unix)
+
+
+if __name__ == "__main__":
+    """Serve."""
+
+    # values from autotune.py on this host, {} if not tuned
+    tuned = autotune_load('inference')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str,
+                        default="models/ImagePatch.pth", help="checkpoint file, LBAM weights load too")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="listen address")
+    parser.add_argument('--port', type=int, default=8080, help="listen port")
+    parser.add_argument('--unix', type=str, default="", help="listen on unix socket path instead")
+    parser.add_argument('--backend', type=str, default="default", choices=["default", "onednn"],
+                        help="onednn: CPU channels_last with prepacked convs")
+    parser.add_argument('--bf16', action="store_true",
+                        help="bf16 autocast, attention maps and output stay fp32")
+    parser.add_argument('--layout', type=str, choices=["contiguous", "channels_last"],
+                        default="channels_last" if tuned.get('channels_last') else "contiguous",
+                        help="memory layout of default backend model")
+    parser.add_argument('--max_batch', type=int, default=tuned.get('batch_size', 4),
+                        help="batch size limit")
+    parser.add_argument('--max_delay', type=float, default=10,
+                        help="longest wait (ms) of a request for its batch to fill")
+    parser.add_argument('--max_pending', type=int, default=32,
+                        help="requests in flight, more are answered 503")
+    parser.add_argument('--deadline', type=float, default=0,
+                        help="default request deadline (ms), 0 means none")
+    parser.add_argument('--workers', type=int, default=1, help="batches running at a time")
+    parser.add_argument('--io_workers', type=int, default=2, help="decode and encode threads")
+    parser.add_argument('--max_memory', type=int, default=0,
+                        help="peak memory budget (MB) of one batch, lowers batch size and tiles")
+    parser.add_argument('--tile_size', type=int, default=tuned.get('tile_size', 1024),
+                        help="tile size, multiple of 128")
+    parser.add_argument('--tile_overlap', type=int, default=TILE_OVERLAP, help="tile overlap")
+    parser.add_argument('--warmup', type=int, default=512, help="warm up image size, 0 means none")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="worker processes sharing one weight copy, 0 means in process")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads per worker process, 0 means cores of its set")
+    parser.add_argument('--pin', action="store_true",
+                        help="pin worker processes to disjoint core sets")
+    args = parser.parse_args()
+
+    autotune_threads(tuned)
+
+    if args.processes > 0 and args.backend != "default":
+        parser.error("--processes does not work with --backend {}".format(args.backend))
+
+    model = get_model(args.checkpoint, backend=args.backend)
+    device = model_device() if args.backend == "default" and args.processes == 0 \
+        else torch.device('cpu')
+    model.to(device)
+    if args.layout == "channels_last" and args.backend == "default":
+        model_channels_last(model)
+    enable_amp(model, torch.bfloat16 if args.bf16 else None)
+    model_freeze(model)
+
+    pool = None
+    if args.processes > 0:
+        pool = ModelProcessPool(model, args.processes, args.threads, args.pin,
+                                functools.partial(model_forward_tiled, tile_size=args.tile_size,
+                                                  tile_overlap=args.tile_overlap,
+                                                  max_memory=args.max_memory * 1024 * 1024))
+
+    server = InferenceServer(model, device, args.checkpoint, max_batch=args.max_batch,
+                             max_delay=args.max_delay / 1000, max_pending=args.max_pending,
+                             deadline=args.deadline / 1000,
+                             workers=args.processes if pool is not None else args.workers,
+                             io_workers=args.io_workers, max_memory=args.max_memory * 1024 * 1024,
+                             tile_size=args.tile_size, tile_overlap=args.tile_overlap, pool=pool)
+    asyncio.run(server.serve(args.host, args.port, args.unix, args.warmup))
+    if pool is not None:
+        pool.shutdown()
@@ -10,12 +10,14 @@
 # ************************************************************************************/
 #
 import argparse
+import glob
 import os
 
 import torch
+from PIL import Image
+from tqdm import tqdm
 
-from data import get_data
-from model import enable_amp, get_model, model_device, model_load, valid_epoch
+from script import PSNR, image_to_tensor, load_script_model, tile_pad
 
 if __name__ == "__main__":
     """Test model."""
@@ -24,16 +26,41 @@ if __name__ == "__main__":
     parser.add_argument('--checkpoint', type=str,
                         default="models/ImagePatch.pth", help="checkpoint file")
     parser.add_argument('--bs', type=int, default=4, help="batch size")
+    parser.add_argument('--backend', type=str, default="default", choices=["default", "onednn"],
+                        help="onednn: CPU channels_last with prepacked convs")
+    parser.add_argument('--script', type=str, default="",
+                        help="test frozen torch script model file on CPU instead of checkpoint")
+    parser.add_argument('--bf16', action="store_true",
+                        help="bf16 autocast, attention maps and output stay fp32")
     args = parser.parse_args()
 
-    # get model
-    model = get_model()
-    model_load(model, args.checkpoint)
-    device = model_device()
-    model.to(device)
+    if args.script:
+        # torch script model only needs torch, model classes are not imported
+        model = load_script_model(args.script)
 
-    enable_amp(model)
+        print("Start testing ...")
+        total_psnr, count = 0.0, 0
+        for filename in tqdm(sorted(glob.glob("dataset/test/image/*"))):
+            image = image_to_tensor(Image.open(filename))
+            mask = image_to_tensor(Image.open(
+                os.path.join("dataset/test/mask", os.path.basename(filename))))
+            with torch.no_grad():
+                output = model(tile_pad(image), tile_pad(mask))
+            output = output[:, :, 0:image.size(2), 0:image.size(3)]
+            total_psnr += PSNR(output, image).item()
+            count += 1
+        print("test PSNR: {:.6f}".format(total_psnr / max(count, 1)))
+    else:
+        from data import get_data
+        from model import enable_amp, get_model, model_device, valid_epoch
 
-    print("Start testing ...")
-    test_dl = get_data(trainning=False, bs=args.bs)
-    valid_epoch(test_dl, model, device, tag='test')
+        # get model
+        model = get_model(args.checkpoint, backend=args.backend)
+        device = model_device() if args.backend == "default" else torch.device('cpu')
+        model.to(device)
+
+        enable_amp(model, torch.bfloat16 if args.bf16 else None)
+
+        print("Start testing ...")
+        test_dl = get_data(trainning=False, bs=args.bs)
+        valid_epoch(test_dl, model, device, tag='test')
@@ -16,13 +16,36 @@ import os
 import torch
 import torch.optim as optim
 
+from autotune import autotune_load, autotune_threads
 from data import get_data
-from model import (ImagePatchDiscriminator, get_model, model_device,
-                   model_load, model_save, train_epoch, valid_epoch)
+from model import (CHECKPOINT_GRANULARITY, COMPRESS_LAYERS, COMPRESS_MODES,
+                   ImagePatchDiscriminator,
+                   get_model, model_checkpoint, model_compile, model_compress,
+                   model_device, model_load, model_save, train_epoch,
+                   valid_epoch)
 
 if __name__ == "__main__":
     """Trainning model."""
 
+    # values from autotune.py on this host, {} if not tuned
+    tuned = autotune_load('train')
+
+    def compress_config(text):
+        """forward=bf16,reverse=int8 -> {'forward': 'bf16', 'reverse': 'int8'}"""
+        config = {}
+        for item in text.split(','):
+            if not item:
+                continue
+            name, _, mode = item.partition('=')
+            if name not in COMPRESS_LAYERS:
+                raise argparse.ArgumentTypeError(
+                    "'{}' is not one of {}".format(name, ', '.join(COMPRESS_LAYERS)))
+            if mode not in COMPRESS_MODES:
+                raise argparse.ArgumentTypeError(
+                    "'{}' of '{}' is not one of {}".format(mode, name, ', '.join(COMPRESS_MODES)))
+            config[name] = mode
+        return config
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--outputdir', type=str,
                         default="output", help="output directory")
@@ -33,8 +56,23 @@ if __name__ == "__main__":
     parser.add_argument('--bs', type=int, default=1, help="batch size")
     parser.add_argument('--lr', type=float, default=1e-4, help="learning rate")
     parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--grad_checkpoint', type=str, default=None,
+                        choices=CHECKPOINT_GRANULARITY[1:],
+                        help="gradient checkpointing granularity")
+    parser.add_argument('--compress', type=compress_config, default={},
+                        help="compress saved activations, like forward=bf16,reverse=int8, "
+                        "layers " + ", ".join(COMPRESS_LAYERS))
+    parser.add_argument('--compile', action="store_true",
+                        help="torch.compile model, compiled code is cached in outputdir/compile_cache")
+    parser.add_argument('--num_workers', type=int, default=tuned.get('num_workers', 4),
+                        help="data loader workers")
     args = parser.parse_args()
 
+    autotune_threads(tuned)
+
+    if args.compile and args.compress:
+        parser.error("--compile does not work with --compress")
+
     # Create directory to store weights
     if not os.path.exists(args.outputdir):
         os.makedirs(args.outputdir)
@@ -44,6 +82,10 @@ if __name__ == "__main__":
     model_load(model, args.checkpoint)
     device = model_device()
     model.to(device)
+    model_checkpoint(model, args.grad_checkpoint)
+    model_compress(model, args.compress)
+    if args.compile:
+        model_compile(model, os.path.join(args.outputdir, "compile_cache"))
 
     # construct optimizer and learning rate scheduler,
     params = [p for p in model.parameters() if p.requires_grad]
@@ -57,7 +99,7 @@ if __name__ == "__main__":
     model_d.to(device)
 
     # get data loader
-    train_dl, valid_dl = get_data(trainning=True, bs=args.bs)
+    train_dl, valid_dl = get_data(trainning=True, bs=args.bs, num_workers=args.num_workers)
 
     for epoch in range(args.epochs):
         print("Epoch {}/{}, learning rate: {} ...".format(epoch +
@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import argparse
 import torch
@@ -17,11 +18,19 @@ from models.LBAMModel import LBAMModel, VGG16FeatureExtractor
 
 import pdb
 
-torch.set_num_threads(5)
+# threads and loader workers tuned by project/autotune.py on this host
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project'))
+from autotune import autotune_load, autotune_threads
+
+tuned = autotune_load('train')
+if tuned:
+    autotune_threads(tuned)
+else:
+    torch.set_num_threads(5)
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--numOfWorkers', type=int, default=4,
+parser.add_argument('--numOfWorkers', type=int, default=tuned.get('num_workers', 4),
                     help='workers for dataloader')
 parser.add_argument('--modelsSavePath', type=str, default='',
                     help='path for saving models')